@@ -0,0 +1,156 @@
+"""Offline benchmark for assign_groups on synthetic cohorts.
+
+Runs assign_groups with instrument=True on fixtures.synthetic_cohort frames
+of several sizes and quality tiers, and records per-phase seconds next to
+the quality metrics (friend satisfaction, kår violations, lonely count,
+diversity, geo spread). No Scoutnet fetch needed, so it runs anywhere.
+
+    python benchmark.py                        # default sizes and tiers
+    python benchmark.py --sizes 500 2000 --tiers medium tempering
+    python benchmark.py --save-baseline        # overwrite benchmark_baseline.json
+    python benchmark.py --compare              # flag regressions vs the baseline
+
+Results go to stdout as JSON (engine progress goes to stderr). --compare
+exits 1 when a case lost friend satisfaction or got more than
+--time-tolerance slower than the saved baseline; timings only compare
+meaningfully on the machine that wrote the baseline."""
+
+import argparse
+import io
+import json
+import os
+import platform
+import sys
+import time
+from contextlib import redirect_stdout
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+import wsj27_utils as u
+from fixtures import synthetic_cohort
+
+BASELINE_PATH = os.path.join(HERE, 'benchmark_baseline.json')
+DEFAULT_SIZES = (500, 1500, 5000, 20000)
+DEFAULT_TIERS = ('medium', 'slow', 'tempering')
+
+
+def run_case(n, quality, seed=0, group_size=36, max_kar=6, **kwargs):
+    """Generate one cohort and time one assign_groups call on it.
+
+    Returns a JSON-ready dict keyed like the baseline file's entries."""
+    df = synthetic_cohort(n, seed=seed)
+    buf = io.StringIO()
+    with redirect_stdout(buf):
+        fw = u.build_friend_graph(df)
+        t0 = time.perf_counter()
+        df, report = u.assign_groups(df, group_size, fw, max_kar=max_kar,
+                                     quality=quality, instrument=True, **kwargs)
+        elapsed = time.perf_counter() - t0
+    sys.stderr.write(buf.getvalue())
+
+    result = report.get('result') or {}
+    return {
+        'n': n,
+        'quality': quality,
+        'seed': seed,
+        'n_groups': int(df['group'].nunique()),
+        'runtime_seconds': round(elapsed, 3),
+        'phase_seconds': {k: round(v, 3) for k, v in report['phase_s'].items()},
+        'calls': report['calls'],
+        'friend_satisfied': result.get('friend_satisfied'),
+        'friend_total': result.get('friend_total'),
+        'satisfaction_rate': round(result.get('friend_satisfied', 0)
+                                   / max(1, result.get('friend_total', 0)), 4),
+        'kar_violations': result.get('kar_violations'),
+        'lonely': result.get('lonely'),
+        'diversity': round(result.get('diversity', 0.0), 3),
+        'geo_spread': round(result.get('geo_spread', 0.0), 6),
+    }
+
+
+def case_key(case):
+    return f"{case['quality']}/{case['n']}/seed{case['seed']}"
+
+
+def compare(results, baseline, time_tolerance=0.25):
+    """Regressions of results against baseline, as a list of messages.
+
+    A case regresses when it satisfies fewer friend wishes, has more kår
+    violations, or its runtime grew by more than time_tolerance (relative).
+    Cases missing from the baseline are skipped."""
+    base = {case_key(c): c for c in baseline['cases']}
+    problems = []
+    for case in results['cases']:
+        old = base.get(case_key(case))
+        if old is None:
+            continue
+        key = case_key(case)
+        if case['friend_satisfied'] < old['friend_satisfied']:
+            problems.append(f"{key}: friend satisfaction {old['friend_satisfied']} -> "
+                            f"{case['friend_satisfied']}")
+        if case['kar_violations'] > old['kar_violations']:
+            problems.append(f"{key}: kår violations {old['kar_violations']} -> "
+                            f"{case['kar_violations']}")
+        if case['runtime_seconds'] > old['runtime_seconds'] * (1 + time_tolerance):
+            slow = [p for p, s in case['phase_seconds'].items()
+                    if s > old['phase_seconds'].get(p, 0.0) * (1 + time_tolerance) + 0.05]
+            problems.append(f"{key}: runtime {old['runtime_seconds']:.2f}s -> "
+                            f"{case['runtime_seconds']:.2f}s (slower phases: "
+                            f"{', '.join(slow) or 'none individually'})")
+    return problems
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    ap.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES))
+    ap.add_argument('--tiers', nargs='+', default=list(DEFAULT_TIERS),
+                    choices=['medium', 'slow', 'tempering'])
+    ap.add_argument('--seed', type=int, default=0, help='cohort generator seed')
+    ap.add_argument('--diversity-iterations', type=int, default=None)
+    ap.add_argument('--rotation-budget', type=int, default=None)
+    ap.add_argument('--output', help='also write the results JSON here')
+    ap.add_argument('--baseline', default=BASELINE_PATH)
+    ap.add_argument('--save-baseline', action='store_true')
+    ap.add_argument('--compare', action='store_true')
+    ap.add_argument('--time-tolerance', type=float, default=0.25)
+    args = ap.parse_args(argv)
+
+    kwargs = {}
+    if args.diversity_iterations is not None:
+        kwargs['diversity_iterations'] = args.diversity_iterations
+    if args.rotation_budget is not None:
+        kwargs['rotation_budget'] = args.rotation_budget
+
+    cases = []
+    for n in args.sizes:
+        for quality in args.tiers:
+            sys.stderr.write(f"\n### {quality} / n={n}\n")
+            cases.append(run_case(n, quality, seed=args.seed, **kwargs))
+    out = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'machine': {'python': platform.python_version(), 'platform': platform.platform(),
+                    'processor': platform.processor()},
+        'options': kwargs,
+        'cases': cases,
+    }
+    print(json.dumps(out, indent=2))
+
+    status = 0
+    if args.compare:
+        with open(args.baseline) as f:
+            problems = compare(out, json.load(f), args.time_tolerance)
+        for msg in problems:
+            sys.stderr.write(f"REGRESSION {msg}\n")
+        if not problems:
+            sys.stderr.write("No regressions against the baseline.\n")
+        status = 1 if problems else 0
+    for path in filter(None, (args.output, args.save_baseline and args.baseline)):
+        with open(path, 'w') as f:
+            json.dump(out, f, indent=2)
+        sys.stderr.write(f"\nWrote results to {path}\n")
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
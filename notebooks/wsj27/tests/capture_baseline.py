@@ -2,6 +2,7 @@
 
 Default: prints clean JSON to stdout (verbose progress redirected to stderr).
 With `--save-baseline`: also overwrites /config/notebooks/wsj27/tests/baseline_metrics.json.
+With `--offline`: uses the last cached Scoutnet payload (see fetch_participants).
 The saved JSON is the immutable comparison target — only re-save when you intend
 to re-baseline."""
 
@@ -15,7 +16,7 @@ def measure(travel):
     # Suppress wsj27_utils' verbose prints; route them to stderr instead.
     buf = io.StringIO()
     with redirect_stdout(buf):
-        raw = u.fetch_participants()
+        raw = u.fetch_participants(offline='--offline' in sys.argv)
         df_all, _ = u.build_participant_dataframe(raw)
         df = df_all[df_all['travel'] == travel].copy().reset_index(drop=True)
         u.assign_coordinates(df)
@@ -25,7 +26,7 @@ def measure(travel):
         fw = u.build_friend_graph(df)
 
         t0 = time.time()
-        df = u.assign_groups(df, 36, fw)
+        df, report = u.assign_groups(df, 36, fw, instrument=True)
         elapsed = time.time() - t0
     sys.stderr.write(buf.getvalue())
 
@@ -54,6 +55,7 @@ def measure(travel):
         'n_satisfied': n_satisfied,
         'satisfaction_rate': round(n_satisfied / max(1, n_with_wish), 4),
         'runtime_seconds': round(elapsed, 2),
+        'phase_seconds': {k: round(v, 2) for k, v in report['phase_s'].items()},
     }
 
 
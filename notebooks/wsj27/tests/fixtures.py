@@ -3,7 +3,8 @@
 Generates small, deterministic dataframes that exercise specific algorithm
 behaviors. All fixtures match the columns assign_groups expects:
 member_no, name, age, sex, kar, lat, lng, friend_1, friend_2, plus a
-hilbert column (added by add_hilbert_index)."""
+hilbert column (added by add_hilbert_index). synthetic_cohort builds large
+random travel sets for benchmark.py."""
 
 import pandas as pd
 import sys
@@ -100,3 +101,129 @@ def fixture_three_way_rotation_unblocks():
         kar = 'kar_B' if i <= 78 else 'kar_E'
         rows.append((i, kar, 61.0, 18.0 + (i - 72) * 0.001, 16, 1, 0, 0))
     return make_df(rows)
+
+
+# Population centres the synthetic kårer cluster around: (name, lat, lng,
+# relative weight). Roughly the larger Swedish towns, weighted by size.
+_SYNTH_CITIES = [
+    ('Stockholm', 59.33, 18.07, 10), ('Göteborg', 57.71, 11.97, 6),
+    ('Malmö', 55.60, 13.00, 4), ('Uppsala', 59.86, 17.64, 3),
+    ('Linköping', 58.41, 15.62, 2), ('Örebro', 59.27, 15.21, 2),
+    ('Västerås', 59.61, 16.55, 2), ('Jönköping', 57.78, 14.16, 2),
+    ('Norrköping', 58.59, 16.19, 2), ('Umeå', 63.83, 20.26, 2),
+    ('Lund', 55.70, 13.19, 2), ('Gävle', 60.67, 17.14, 1),
+    ('Karlstad', 59.38, 13.50, 1), ('Växjö', 56.88, 14.81, 1),
+    ('Sundsvall', 62.39, 17.31, 1), ('Luleå', 65.58, 22.15, 1),
+    ('Östersund', 63.18, 14.64, 1), ('Kalmar', 56.66, 16.36, 1),
+    ('Falun', 60.61, 15.63, 1), ('Visby', 57.64, 18.30, 0.5),
+]
+
+# Kår name prefixes and how often they occur; classify_parent_org reads the
+# parent organisation back out of the name, as for real kårer.
+_SYNTH_KAR_PREFIXES = [
+    ('Scoutkåren', 0.78), ('Equmenia Scout', 0.10), ('KFUM Scout', 0.06),
+    ('NSF', 0.03), ('Salt Scout', 0.02), ('FA Scout', 0.01),
+]
+
+
+def synthetic_cohort(n, seed=0, mean_kar_size=5.0, wish_rate=0.65,
+                     mutual_rate=0.45, chain_rate=0.15, cross_kar_rate=0.25,
+                     second_wish_rate=0.3):
+    """A realistic random travel set of n participants, for benchmarks.
+
+    Kårer sit around weighted Swedish population centres (a few km to a few
+    tens of km out), with geometric size mix averaging mean_kar_size, and
+    members live within a few km of their kår. Of the people in a kår,
+    about wish_rate end up wishing for someone: the kår's members are
+    walked in random order and taken as mutual pairs (mutual_rate of
+    wishers), chains of 3-4 each wishing for the next (chain_rate), or
+    one-way wishes; second_wish_rate of the wishers also name a second
+    friend. A wish goes to a neighbouring kår (by position along the
+    Hilbert curve) with probability cross_kar_rate. Ages 14-17, sex
+    mostly 1/2 with a few 3/4, and parent_org from the kår name.
+
+    Deterministic for a given (n, seed). Returns the frame sorted by
+    Hilbert index, like make_df."""
+    import numpy as np
+    rng = np.random.default_rng(seed)
+
+    weights = np.array([c[3] for c in _SYNTH_CITIES], dtype=float)
+    kar_sizes = []
+    while sum(kar_sizes) < n:
+        kar_sizes.append(int(rng.geometric(1 / mean_kar_size)))
+    kar_sizes[-1] -= sum(kar_sizes) - n
+    n_kar = len(kar_sizes)
+    city = rng.choice(len(_SYNTH_CITIES), size=n_kar, p=weights / weights.sum())
+    spread = rng.exponential(0.08, size=n_kar)  # degrees; ~10 km typical
+    kar_lat = np.array([_SYNTH_CITIES[c][1] for c in city]) + rng.normal(0, 1, n_kar) * spread
+    kar_lng = np.array([_SYNTH_CITIES[c][2] for c in city]) + rng.normal(0, 2, n_kar) * spread
+    prefixes = [p for p, _ in _SYNTH_KAR_PREFIXES]
+    prefix_p = np.array([w for _, w in _SYNTH_KAR_PREFIXES])
+    kar_prefix = rng.choice(len(prefixes), size=n_kar, p=prefix_p / prefix_p.sum())
+    kar_names = [f'{prefixes[kar_prefix[k]]} {_SYNTH_CITIES[city[k]][0]} {k}'
+                 for k in range(n_kar)]
+
+    kar_of = np.repeat(np.arange(n_kar), kar_sizes)
+    lat = np.clip(kar_lat[kar_of] + rng.normal(0, 0.02, n), *u.LAT_RANGE)
+    lng = np.clip(kar_lng[kar_of] + rng.normal(0, 0.04, n), *u.LNG_RANGE)
+    members = np.split(np.arange(n), np.cumsum(kar_sizes)[:-1])
+    # Kårer ordered along the Hilbert curve, so "neighbouring kår" is near.
+    kar_order = np.argsort(u.geo_to_hilbert(kar_lat, kar_lng))
+    kar_rank = np.empty(n_kar, dtype=int)
+    kar_rank[kar_order] = np.arange(n_kar)
+
+    wishes = [[] for _ in range(n)]
+
+    def wish(a, b):
+        if b is not None and b != a and b not in wishes[a]:
+            wishes[a].append(b)
+
+    def target(i, mates):
+        """Someone for i to wish for: a kår-mate, or a neighbouring kår's member."""
+        if len(mates) > 1 and rng.random() >= cross_kar_rate:
+            return int(rng.choice(mates))
+        r = kar_rank[kar_of[i]] + int(rng.choice([-3, -2, -1, 1, 2, 3]))
+        return int(rng.choice(members[kar_order[min(max(r, 0), n_kar - 1)]]))
+
+    for mates in members:
+        order = list(rng.permutation(mates))
+        while order:
+            if rng.random() >= wish_rate:
+                order.pop()
+                continue
+            kind = rng.random()
+            if kind < mutual_rate:
+                a = order.pop()
+                b = order.pop() if order else target(a, mates)
+                wish(a, b)
+                wish(b, a)
+            elif kind < mutual_rate + chain_rate and len(order) >= 3:
+                chain = [order.pop() for _ in range(min(len(order), int(rng.integers(3, 5))))]
+                for a, b in zip(chain, chain[1:]):
+                    wish(a, b)
+            else:
+                a = order.pop()
+                wish(a, target(a, mates))
+    for i in range(n):
+        if wishes[i] and rng.random() < second_wish_rate:
+            wish(i, target(i, members[kar_of[i]]))
+
+    member_no = [str(100000 + i) for i in range(n)]
+    friend_1 = [member_no[w[0]] if len(w) > 0 else '' for w in wishes]
+    friend_2 = [member_no[w[1]] if len(w) > 1 else '' for w in wishes]
+    df = pd.DataFrame({
+        'member_no': member_no,
+        'name': [f'Person {m}' for m in member_no],
+        'age': rng.choice([14, 15, 16, 17], size=n, p=[0.2, 0.3, 0.3, 0.2]),
+        'sex': rng.choice([1, 2, 3, 4], size=n, p=[0.47, 0.49, 0.02, 0.02]),
+        'kar': [kar_names[k] for k in kar_of],
+        'region': [_SYNTH_CITIES[city[k]][0] for k in kar_of],
+        'lat': lat,
+        'lng': lng,
+        'parent_org': [u.classify_parent_org(kar_names[k]) for k in kar_of],
+        'friend_1': friend_1,
+        'friend_2': friend_2,
+        'friend_1_name': '',
+        'friend_2_name': '',
+    })
+    return u.add_hilbert_index(df)
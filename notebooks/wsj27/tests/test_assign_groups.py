@@ -8,13 +8,24 @@ import sys
 sys.path.insert(0, '/config/notebooks/wsj27')
 sys.path.insert(0, '/config/notebooks/wsj27/tests')
 
+import importlib.util
+import json
+import math
+import os
+import tempfile
+import time
 import unittest
+from unittest import mock
 from collections import Counter
+import numpy as np
+import pandas as pd
+import numpy as np
 import wsj27_utils as u
 from fixtures import (
     fixture_two_groups_one_friend_pair,
     fixture_friend_chain_across_boundary,
     fixture_three_way_rotation_unblocks,
+    synthetic_cohort,
 )
 
 
@@ -107,6 +118,117 @@ class TestQualityTiers(unittest.TestCase):
         df = u.assign_groups(df, 36, fw, quality='slow')
         self.assertEqual(df['group'].nunique(), 2)
 
+    def test_slow_tier_parallel_matches_sequential(self):
+        # Best-of-N must not depend on worker count or completion order.
+        groups = []
+        for workers in (1, 4):
+            df = fixture_two_groups_one_friend_pair()
+            fw = u.build_friend_graph(df)
+            df = u.assign_groups(df, 36, fw, quality='slow', workers=workers,
+                                 diversity_iterations=2000)
+            groups.append(list(df['group']))
+        self.assertEqual(groups[0], groups[1])
+
+    def test_tempering_tier_returns_legal(self):
+        df = fixture_two_groups_one_friend_pair()
+        fw = u.build_friend_graph(df)
+        df = u.assign_groups(df, 36, fw, quality='tempering',
+                             diversity_iterations=2000)
+        self.assertEqual(df['group'].nunique(), 2)
+        self.assertEqual(sorted(df['group'].value_counts()), [36, 36])
+
+    def test_tempering_replica_failure_raises(self):
+        df = fixture_two_groups_one_friend_pair()
+        fw = u.build_friend_graph(df)
+        # Workers are forked, so they see the patched schedule and fail in Phase 4.
+        with mock.patch.object(u, '_ReplicaSchedule', side_effect=MemoryError('boom')):
+            with self.assertRaisesRegex(RuntimeError, 'replica 1 failed'):
+                u.assign_groups(df, 36, fw, quality='tempering', workers=2,
+                                diversity_iterations=2000)
+
+    def test_time_budget_runs_adaptive_schedule(self):
+        df = fixture_two_groups_one_friend_pair()
+        fw = u.build_friend_graph(df)
+        df = u.assign_groups(df, 36, fw, time_budget_s=0.5)
+        self.assertEqual(df['group'].nunique(), 2)
+
+    def test_time_budget_with_fixed_schedule_raises(self):
+        df = fixture_two_groups_one_friend_pair()
+        fw = u.build_friend_graph(df)
+        with self.assertRaises(ValueError):
+            u.assign_groups(df, 36, fw, schedule='fixed', time_budget_s=1)
+
+    def test_adaptive_temperature_stays_in_calibrated_band(self):
+        # Feed a stationary stream of worsening swaps through the Metropolis
+        # rule: T must cool monotonically, from T0 to about the temperature
+        # that accepts them at accept_end, without collapsing towards zero.
+        rng = np.random.default_rng(0)
+        deltas = rng.exponential(1.0, 200)
+        sched = u._AnnealSchedule('adaptive', max_iterations=30 * 500,
+                                  uphill_deltas=deltas)
+        while sched.running():
+            delta = -rng.exponential(1.0) if rng.random() < 0.9 else rng.exponential(0.1)
+            sched.record(delta, delta >= 0 or rng.random() < math.exp(delta / sched.temperature))
+        temps = [row[1] for row in sched.trajectory]
+        t_end = u._AnnealSchedule._calibrate(deltas, sched.accept_end)
+        self.assertEqual(len(temps), 30)
+        self.assertTrue(all(b <= a for a, b in zip(temps, temps[1:])))
+        self.assertLessEqual(temps[0], sched.t0)
+        self.assertGreater(sched.temperature, t_end / 10)
+        self.assertLess(sched.temperature, sched.t0 / 2)
+
+
+    def test_instrument_returns_json_report_and_same_groups(self):
+        df = fixture_two_groups_one_friend_pair()
+        fw = u.build_friend_graph(df)
+        plain = list(u.assign_groups(df.copy(), 36, fw, diversity_iterations=2000)['group'])
+        df, report = u.assign_groups(df, 36, fw, diversity_iterations=2000,
+                                     instrument=True, profile='cprofile')
+        self.assertEqual(list(df['group']), plain)
+        self.assertEqual(set(report['phase_s']), {'setup', *u._PHASES})
+        self.assertGreater(report['calls']['do_swap'], 0)
+        self.assertEqual(report['sa']['proposals'], 2000)
+        self.assertIn('cumulative', report['profile'])
+        json.dumps(report)
+
+    @unittest.skipUnless(importlib.util.find_spec('ortools'), 'needs OR-Tools')
+    def test_cpsat_engine_keeps_legal_and_reports_gap(self):
+        df = fixture_three_way_rotation_unblocks()
+        fw = u.build_friend_graph(df)
+        df, report = u.assign_groups(df, 36, fw, max_kar=8, diversity_iterations=2000,
+                                     engine='cpsat', solver_time_s=5, instrument=True)
+        self.assertEqual(sorted(df['group'].value_counts()), [36, 36, 36])
+        solver = report['solver']
+        self.assertIn(solver['status'], ('OPTIMAL', 'FEASIBLE'))
+        self.assertLessEqual(report['result']['kar_violations'],
+                             solver['before']['kar_violations'])
+        self.assertGreaterEqual(report['result']['friend_satisfied'], 1)
+        self.assertGreaterEqual(solver['gap'], 0.0)
+
+    def test_nearest_groups_by_median_centroid(self):
+        # Five groups of three along a line of longitudes. Group 4's outlier
+        # leaves its median centroid at 4.
+        lngs = np.array([0, 0, 0, 1, 1, 1, 2, 2, 2, 3, 3, 3, 4, 4, 40], dtype=float)
+        lats = np.zeros(15)
+        members = np.arange(15, dtype=np.int32).reshape(5, 3)
+        glen = np.full(5, 3, dtype=np.int32)
+        near = u._nearest_groups(members, glen, lats, lngs, np.arange(5), 2)
+        self.assertEqual(near.tolist(), [[1, 2], [0, 2], [1, 3], [2, 4], [3, 2]])
+        near = u._nearest_groups(members, glen, lats, lngs, np.array([0, 3, 4]), 8)
+        self.assertEqual(near[1].tolist(), [0, 3])
+
+    def test_uniform_sa_proposals_still_available(self):
+        df = synthetic_cohort(720, seed=4)
+        fw = u.build_friend_graph(df)
+        out = u.assign_groups(df, 36, fw, diversity_iterations=3000, sa_neighbours=0)
+        self.assertEqual(sorted(out['group'].value_counts()), [36] * 20)
+
+    def test_unknown_engine_raises(self):
+        df = fixture_two_groups_one_friend_pair()
+        fw = u.build_friend_graph(df)
+        with self.assertRaises(ValueError):
+            u.assign_groups(df, 36, fw, engine='gurobi')
+
     def test_unknown_quality_raises(self):
         df = fixture_two_groups_one_friend_pair()
         fw = u.build_friend_graph(df)
@@ -114,5 +236,505 @@ class TestQualityTiers(unittest.TestCase):
             u.assign_groups(df, 36, fw, quality='ludicrous')
 
 
+class TestCheckpoint(unittest.TestCase):
+    def test_resume_after_interrupt_matches_uninterrupted_run(self):
+        df = synthetic_cohort(330, seed=5)
+        fw = u.build_friend_graph(df)
+        kwargs = dict(diversity_iterations=3000, schedule='adaptive')
+        expected = list(u.assign_groups(df.copy(), 36, fw, **kwargs)['group'])
+        save = u._Checkpoint.save
+        saves = []
+
+        def interrupting_save(ckpt, phase, *args, **kw):
+            save(ckpt, phase, *args, **kw)
+            saves.append(phase)
+            if len(saves) == 8:  # Phases 1-3.5, then two inside Phase 4
+                raise KeyboardInterrupt
+
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'run.npz')
+            with mock.patch.object(u._Checkpoint, 'save', interrupting_save):
+                with self.assertRaises(KeyboardInterrupt):
+                    u.assign_groups(df.copy(), 36, fw, checkpoint=path,
+                                    checkpoint_every=1000, **kwargs)
+            self.assertEqual(saves[-2:], ['sa', 'sa'])
+            resumed = u.assign_groups(df.copy(), 36, fw, checkpoint=path, resume=True,
+                                      checkpoint_every=1000, **kwargs)
+            self.assertEqual(list(resumed['group']), expected)
+            again = u.assign_groups(df.copy(), 36, fw, checkpoint=path, resume=True,
+                                    **kwargs)
+            self.assertEqual(list(again['group']), expected)
+
+    def test_resume_refuses_checkpoint_of_another_run(self):
+        df = fixture_two_groups_one_friend_pair()
+        fw = u.build_friend_graph(df)
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'run.npz')
+            u.assign_groups(df.copy(), 36, fw, checkpoint=path)
+            with self.assertRaises(ValueError):
+                u.assign_groups(df.copy(), 36, fw, checkpoint=path, resume=True,
+                                div_weight=2.0)
+            moved = df.copy()
+            moved.loc[0, 'lat'] += 0.5
+            with self.assertRaises(ValueError):
+                u.assign_groups(moved, 36, fw, checkpoint=path, resume=True)
+            u.assign_groups(df.copy(), 36, fw, checkpoint=path, resume=True)
+
+    def test_resume_needs_checkpoint_path(self):
+        df = fixture_two_groups_one_friend_pair()
+        fw = u.build_friend_graph(df)
+        with self.assertRaises(ValueError):
+            u.assign_groups(df, 36, fw, resume=True)
+
+
+class TestGroupProblem(unittest.TestCase):
+    def test_friend_edges_and_round_trip(self):
+        df = fixture_friend_chain_across_boundary()
+        p = u.GroupProblem.from_dataframe(df)
+        idx = {m: i for i, m in enumerate(df['member_no'])}
+        for i, (f1, f2) in enumerate(zip(df['friend_1'], df['friend_2'])):
+            want = [idx[f] for f in (f1, f2) if f and f in idx]
+            got = p.friend_idx[p.friend_ptr[i]:p.friend_ptr[i + 1]].tolist()
+            self.assertEqual(got, want)
+            for j in want:
+                self.assertIn(i, p.rev_idx[p.rev_ptr[j]:p.rev_ptr[j + 1]].tolist())
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'problem.npz')
+            p.save(path)
+            q = u.GroupProblem.load(path)
+        self.assertEqual(q.kar.tolist(), p.kar.tolist())
+        self.assertEqual(q.friend_idx.tolist(), p.friend_idx.tolist())
+        self.assertEqual(q.kar_labels, [str(k) for k in p.kar_labels])
+        self.assertEqual(q.fingerprint(), p.fingerprint())
+
+    def test_missing_age_is_not_counted(self):
+        df = fixture_two_groups_one_friend_pair()
+        df['age'] = df['age'].astype(float)
+        df.loc[3, 'age'] = np.nan
+        fw = u.build_friend_graph(df)
+        df = u.assign_groups(df, 36, fw)
+        self.assertEqual(df['group'].nunique(), 2)
+        p = u.GroupProblem.from_dataframe(df)
+        self.assertEqual(p.age[3], -1)
+        p.metrics(df['group'].to_numpy())
+
+
+class TestIncremental(unittest.TestCase):
+    def test_changes_stay_inside_open_groups(self):
+        df = synthetic_cohort(330, seed=2)
+        fw = u.build_friend_graph(df)
+        df = u.assign_groups(df, 36, fw, diversity_iterations=2000)
+        prev = dict(zip(df['member_no'], df['group']))
+        newcomers = synthetic_cohort(340, seed=2)
+        newcomers = newcomers[~newcomers['member_no'].isin(df['member_no'])].head(6)
+        df2 = pd.concat([df.iloc[5:].drop(columns=['group']), newcomers])
+        df2 = u.add_hilbert_index(df2.reset_index(drop=True))
+        for col in ('friend_1', 'friend_2'):
+            df2.loc[~df2[col].isin(df2['member_no']), col] = ''
+        fw = u.build_friend_graph(df2)
+        df2, report = u.assign_groups(df2, 36, fw, diversity_iterations=2000,
+                                      previous=prev, instrument=True)
+        self.assertEqual(sorted(df2['group'].value_counts())[1:], [36] * 9)
+        self.assertEqual(report['result']['kar_violations'], 0)
+        inc = report['incremental']
+        self.assertEqual(inc['newcomers'], 6)
+        closed = ~df2['member_no'].map(prev).isin(inc['open_groups'])
+        old = df2['member_no'].map(prev)[closed & df2['member_no'].isin(prev)]
+        self.assertTrue((df2.loc[old.index, 'group'] == old).all())
+
+    def test_load_previous_groups_from_export_csv(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'grupper.csv')
+            with open(path, 'w', encoding='utf-8-sig') as f:
+                f.write('group,member_no,name\n1,007,A\n2,42,B\n')
+            self.assertEqual(u.load_previous_groups(path), {'007': 0, '42': 1})
+
+
+class TestParticipantCache(unittest.TestCase):
+    def _write_cache(self, path, age_s):
+        payload = {'participants': {'1': {'confirmed': True}, '2': {'cancelled': True}}}
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'fetched_at': time.time() - age_s, 'etag': None,
+                       'last_modified': None, 'payload': payload}, f)
+        return payload
+
+    def test_fresh_cache_and_offline_skip_the_network(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'participants.json')
+            payload = self._write_cache(path, age_s=60)
+            self.assertEqual(u.fetch_participants(max_age_s=600, cache_path=path), payload)
+            self._write_cache(path, age_s=10 ** 6)
+            self.assertEqual(u.fetch_participants(offline=True, cache_path=path), payload)
+
+    def test_offline_without_cache_raises(self):
+        with tempfile.TemporaryDirectory() as d:
+            with self.assertRaises(FileNotFoundError):
+                u.fetch_participants(offline=True, cache_path=os.path.join(d, 'none.json'))
+
+
+def _raw_payload():
+    def person(mid, fee, dob, **extra):
+        p = {'member_no': mid, 'confirmed': True, 'fee_id': fee, 'date_of_birth': dob,
+             'first_name': 'F', 'last_name': str(mid), 'sex': 1,
+             'primary_membership_info': {'group_name': 'Equmenia Ost',
+                                         'organisation_name': 'Scouterna'}}
+        p.update(extra)
+        return p
+    return {'participants': {str(m): p for m, p in enumerate([
+        person(1, u.DELTAGARE_RUNDRESA, '2011-07-29',
+               questions={u.Q_FRIEND_1_MEMBER_NO: ' 2 ', u.Q_FRIEND_2_MEMBER_NO: '0'}),
+        person(2, u.DELTAGARE_DIREKTRESA, '2009-07-30', questions=[]),
+        person(3, u.DELTAGARE_RUNDRESA, '2009-07-29'),          # turns 18: too old
+        person(4, u.IST_RUNDRESA, '2010-05-3'),                  # not ISO: no DOB
+        person(5, u.IST_EGEN_RESA, '20000101'),
+        person(6, u.DELTAGARE_RUNDRESA, '2011-01-01', cancelled=True),
+        person(7, u.DELTAGARE_RUNDRESA, '2011-01-01',
+               questions={u.Q_INTERNAL_STATUS: u.STATUS_RESERVE}),
+    ])}}
+
+
+class TestParticipantDataframe(unittest.TestCase):
+    def test_filters_ages_and_friend_answers(self):
+        raw = _raw_payload()
+        df, skipped = u.build_participant_dataframe(raw)
+        self.assertEqual(df['member_no'].tolist(), ['1', '2', '5'])
+        self.assertEqual(df['age'].tolist(), [16, 17, 27])
+        self.assertEqual(df['sex'].dtype, np.int64)
+        self.assertEqual(df['category'].tolist(), ['deltagare', 'deltagare', 'ist'])
+        self.assertEqual(df['travel'].tolist(), ['rundresa', 'direktresa', 'egen_resa'])
+        self.assertEqual(df['friend_1'].tolist(), ['2', '', ''])
+        self.assertEqual(df['friend_2'].tolist(), ['', '', ''])
+        self.assertEqual(set(df['parent_org']), {u.SAMVERKANSORG_EQUMENIA})
+        self.assertEqual([s.split(':')[0].strip() for s in skipped],
+                         ['DELTAGARE wrong age', 'NO DOB'])
+        df, _ = u.build_participant_dataframe(raw, include_reserves=True)
+        self.assertEqual(df['reserve'].tolist(), [False, False, False, True])
+
+    def test_snapshot_reused_until_payload_changes(self):
+        def fake_coords(df, store=None, coord_source='kar'):
+            df['lat'] = 58.0 + df.index / 10
+            df['lng'] = 15.0
+            return df
+
+        raw = _raw_payload()
+        with tempfile.TemporaryDirectory() as d, \
+                mock.patch.object(u, 'assign_coordinates', side_effect=fake_coords) as coords, \
+                mock.patch('sys.stdout'):
+            store = u.GeocodeStore(os.path.join(d, 'geo.sqlite'), legacy={})
+            df1, skipped1 = u.load_participant_snapshot(raw, include_reserves=True,
+                                                        snapshot_dir=d, store=store)
+            df2, skipped2 = u.load_participant_snapshot(raw, include_reserves=True,
+                                                        snapshot_dir=d, store=store)
+            self.assertEqual(coords.call_count, 1)
+            pd.testing.assert_frame_equal(df1, df2, check_dtype=False)
+            self.assertEqual(skipped1, skipped2)
+            self.assertEqual(df1['member_no'].tolist(), ['1', '2', '5', '7'])
+            self.assertTrue((df1['hilbert'] == df1.apply(
+                lambda r: u.geo_to_hilbert(r['lat'], r['lng']), axis=1)).all())
+
+            # Place geocodes are not an input; kår geocodes are
+            store.put('place', 'Lund', {'lat': 55.7, 'lng': 13.2})
+            u.load_participant_snapshot(raw, include_reserves=True, snapshot_dir=d, store=store)
+            self.assertEqual(coords.call_count, 1)
+            store.put('kar', 'Lunds Scoutkår', {'lat': 55.7, 'lng': 13.2})
+            u.load_participant_snapshot(raw, include_reserves=True, snapshot_dir=d, store=store)
+            self.assertEqual(coords.call_count, 2)
+
+            raw['participants']['0']['date_of_birth'] = '2012-01-01'
+            u.load_participant_snapshot(raw, include_reserves=True, snapshot_dir=d, store=store)
+            u.load_participant_snapshot(raw, snapshot_dir=d, store=store)
+            self.assertEqual(coords.call_count, 4)
+            u.load_participant_snapshot(raw, snapshot_dir=d, keep=1, store=store)
+            self.assertEqual(len([f for f in os.listdir(d) if f.endswith('.json')]), 1)
+            store.close()
+
+    def test_reserve_fill_for_several_group_sizes(self):
+        def row(mno, reserve, kar='K1', f1='', f2=''):
+            return {'member_no': mno, 'name': f'N{mno}', 'kar': kar, 'friend_1': f1,
+                    'friend_2': f2, 'reserve': reserve}
+        df = pd.DataFrame([row(str(i), False, f1='r1' if i < 2 else '') for i in range(10)] + [
+            row('r1', True, kar='K2'),                   # wished for twice: +10
+            row('r2', True, f1='3', f2='4'),             # two wishes into cohort: +6, +3 kår
+            row('r3', True),                              # kår-mates only: +3
+            row('r4', True, kar=''),                      # nothing
+        ])
+        with mock.patch('sys.stdout'):
+            by_size = u.select_top_reserves(df, [4, 5, 6])
+            single = u.select_top_reserves(df, 4)
+        self.assertEqual(sorted(by_size), [4, 5, 6])
+        pd.testing.assert_frame_equal(by_size[4], single)
+        self.assertEqual(by_size[4]['member_no'].tolist()[10:], ['r1', 'r2'])
+        self.assertEqual(len(by_size[5]), 10)
+        self.assertEqual(by_size[6]['member_no'].tolist()[10:], ['r1', 'r2'])
+
+
+class _FakeProvider:
+    def __init__(self, name, places, rate=None):
+        self.name, self.places, self.rate = name, places, rate
+        self.calls = []
+
+    def geocode(self, query):
+        self.calls.append(query)
+        if query == 'boom':
+            raise RuntimeError('provider down')
+        if query in self.places:
+            return {'lat': self.places[query][0], 'lng': self.places[query][1]}
+        return None
+
+
+class TestGeocoding(unittest.TestCase):
+    def test_provider_chain_cache_and_chunked_writes(self):
+        offline = _FakeProvider('offline', {'Lund': (55.7, 13.2)})
+        online = _FakeProvider('online', {'Kiruna': (67.9, 20.2), 'Lund': (0.0, 0.0)}, rate=200)
+        cache = {'Umeå': {'lat': 63.8, 'lng': 20.3}}
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'cache.json')
+            found, errors = u.geocode_many(['Umeå', 'Lund', 'Kiruna', 'Atlantis', 'boom', 'Lund'],
+                                           [offline, online], cache, cache_path=path, chunk=1)
+            with open(path) as f:
+                saved = json.load(f)
+        self.assertEqual(found['Lund']['source'], 'offline')
+        self.assertEqual(found['Kiruna']['source'], 'online')
+        self.assertIsNone(found['Atlantis'])
+        self.assertIsInstance(errors['boom'], RuntimeError)
+        self.assertNotIn('Umeå', offline.calls + online.calls)
+        self.assertEqual(sorted(online.calls), ['Atlantis', 'Kiruna'])
+        self.assertEqual(sorted(saved), ['Kiruna', 'Lund', 'Umeå'])
+
+    def test_token_bucket_limits_rate_across_threads(self):
+        from concurrent.futures import ThreadPoolExecutor
+        bucket = u._TokenBucket(rate=50)
+        t0 = time.monotonic()
+        with ThreadPoolExecutor(4) as pool:
+            list(pool.map(lambda _: bucket.acquire(), range(11)))
+        self.assertGreaterEqual(time.monotonic() - t0, 10 / 50 * 0.95)
+
+    def test_postnummer_provider_reads_codes_in_queries(self):
+        prov = u.PostnummerProvider({'582 20': (58.41, 15.62)})
+        self.assertEqual(prov.geocode('58220|Linköping|Sverige')['lat'], 58.41)
+        self.assertEqual(prov.geocode('582 20 Linköping')['lng'], 15.62)
+        self.assertIsNone(prov.geocode('1582201'))
+
+
+class TestCoordinateResolution(unittest.TestCase):
+    def test_priority_order_by_coord_source(self):
+        member_no = pd.Series(['1', '2', '3', '4', '5'], index=[10, 11, 12, 13, 14])
+        kar = pd.Series(['A', 'A', 'B', '', 'C'], index=member_no.index)
+        person = {'1': (60.0, 15.0)}
+        home = {'1': (1.0, 1.0), '2': (57.0, 13.0), '4': (58.0, 14.0)}
+        kars = {'A': (59.0, 18.0), 'C': (65.0, 21.0)}
+        by_kar = u._resolve_coordinates(member_no, kar, person, home, kars, 'kar')
+        self.assertEqual(by_kar['source'].tolist(), ['manual', 'kar', 'centroid', 'home', 'kar'])
+        self.assertEqual(by_kar['lat'].tolist()[:2], [60.0, 59.0])
+        self.assertTrue(np.isnan(by_kar.loc[12, 'lat']))
+        by_home = u._resolve_coordinates(member_no, kar, person, home, kars, 'home')
+        self.assertEqual(by_home['source'].tolist(), ['manual', 'home', 'centroid', 'home', 'kar'])
+        self.assertEqual(by_home[['lat', 'lng']].loc[11].tolist(), [57.0, 13.0])
+        self.assertEqual(list(by_home.index), list(member_no.index))
+
+        # A kår-name guess only fills rows that are still unresolved
+        guesses = {'A': (1.0, 1.0), 'B': (58.4, 15.6)}
+        guessed = u._resolve_coordinates(member_no, kar, person, home, {'C': (65.0, 21.0)},
+                                         'kar', kar_guess_coords=guesses)
+        self.assertEqual(guessed['source'].tolist(),
+                         ['manual', 'home', 'kar_guess', 'home', 'kar'])
+        self.assertEqual(guessed.loc[12, 'lat'], 58.4)
+
+
+class TestSpaceFillingCurves(unittest.TestCase):
+    def test_vectorized_hilbert_matches_scalar(self):
+        n = 64
+        xs, ys = np.divmod(np.arange(n * n), n)
+        d = u.hilbert_xy2d_array(n, xs, ys)
+        self.assertEqual(d.tolist(), [u.hilbert_xy2d(n, int(x), int(y)) for x, y in zip(xs, ys)])
+        self.assertEqual(sorted(d.tolist()), list(range(n * n)))
+
+        rng = np.random.default_rng(0)
+        lat, lng = rng.uniform(54, 71, 500), rng.uniform(9, 26, 500)
+        self.assertEqual(u.geo_to_hilbert(lat, lng).tolist(),
+                         [u.geo_to_hilbert(a, b) for a, b in zip(lat, lng)])
+        self.assertIsInstance(u.geo_to_hilbert(58.4, 15.6), int)
+        with self.assertRaises(ValueError):
+            u.geo_to_hilbert(float('nan'), 15.6)
+        with self.assertRaises(ValueError):
+            u.add_hilbert_index(pd.DataFrame({'lat': [58.4, np.nan], 'lng': [15.6, 15.7]}))
+
+    def test_finer_grid_and_morton(self):
+        # Two kårer ~600 m apart share a cell at the default order only
+        a, b = (58.400, 15.600), (58.405, 15.605)
+        self.assertEqual(u.geo_to_hilbert(*a), u.geo_to_hilbert(*b))
+        self.assertNotEqual(u.geo_to_hilbert(*a, n=4096), u.geo_to_hilbert(*b, n=4096))
+        self.assertEqual(u.morton_xy2d_array(4, [0, 0, 1, 1, 3], [0, 1, 0, 1, 3]).tolist(),
+                         [0, 1, 2, 3, 15])
+        df = pd.DataFrame({'lat': [60.0, 56.0, 66.0], 'lng': [15.0, 13.0, 20.0]})
+        out = u.add_hilbert_index(df, curve='morton', n=1024)
+        self.assertTrue(out['hilbert'].is_monotonic_increasing)
+        with self.assertRaises(ValueError):
+            u.geo_to_hilbert(58.4, 15.6, n=1000)
+
+
+class TestGeocodeStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'geo.sqlite')
+        self.legacy = os.path.join(self.tmp.name, 'kar.json')
+        with open(self.legacy, 'w', encoding='utf-8') as f:
+            json.dump({'Lunds Scoutkår': {'lat': 55.7, 'lng': 13.2, 'source': 'nominatim'},
+                       'Okänd kår': {'lat': None, 'lng': None, 'source': 'failed'}}, f)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def open(self):
+        with mock.patch('sys.stdout'):
+            return u.GeocodeStore(self.path, legacy={'kar': self.legacy})
+
+    def test_typed_keys_legacy_import_and_view(self):
+        store = self.open()
+        store.put('place', 'Lund', {'lat': 1.0, 'lng': 2.0})
+        self.assertEqual(store.get('kar', 'Lunds Scoutkår')['source'], 'nominatim')
+        self.assertIsNone(store.get('place', 'Lunds Scoutkår'))
+        self.assertEqual(sorted(store.get_many('kar', ['Okänd kår', 'Nope'])), ['Okänd kår'])
+        with self.assertRaises(ValueError):
+            store.put('city', 'Lund', {'lat': 1.0, 'lng': 2.0})
+
+        view = store.view('kar')
+        view['Ny kår'] = {'lat': 60.0, 'lng': 15.0}
+        self.assertIn('Okänd kår', view)
+        self.assertEqual(len(view), 3)
+        self.assertEqual(sorted(view), ['Lunds Scoutkår', 'Ny kår', 'Okänd kår'])
+        store.close()
+
+        # A second connection sees the writes. A re-import of a touched legacy
+        # file adds new keys but never overwrites stored entries.
+        store = self.open()
+        store.put('kar', 'Lunds Scoutkår', {'lat': 55.0, 'lng': 13.0})
+        store.close()
+        self.assertEqual(self.open().get('kar', 'Lunds Scoutkår')['lat'], 55.0)
+        with open(self.legacy, 'w', encoding='utf-8') as f:
+            json.dump({'Lunds Scoutkår': {'lat': 55.7, 'lng': 13.2},
+                       'Malmö Scoutkår': {'lat': 55.6, 'lng': 13.0}}, f)
+        os.utime(self.legacy, (time.time() + 10, time.time() + 10))
+        store = self.open()
+        self.assertEqual(store.get('kar', 'Lunds Scoutkår')['lat'], 55.0)
+        self.assertEqual(store.get('kar', 'Malmö Scoutkår')['lat'], 55.6)
+        store.close()
+
+    def test_geocode_places_and_assign_coordinates_use_the_store(self):
+        store = self.open()
+        store.put('place', 'Umeå', {'lat': None, 'lng': None})      # failed earlier: retried
+        store.put('place', 'Luleå', {'lat': 65.6, 'lng': 22.1,      # fuzzy: retried, kept
+                                     'source': 'gazetteer_fuzzy'})
+        provider = _FakeProvider('fake', {'Umeå': (63.8, 20.3)})
+        df = pd.DataFrame({'ort': ['Umeå', 'Umeå', 'Luleå']})
+        with mock.patch('sys.stdout'):
+            u.geocode_places(df, place_column='ort', store=store, providers=[provider])
+        self.assertEqual(sorted(provider.calls), ['Luleå', 'Umeå'])
+        self.assertEqual(store.get('place', 'Umeå')['source'], 'fake')
+        self.assertEqual(df['lat'].tolist(), [63.8, 63.8, 65.6])
+
+        people = pd.DataFrame({'member_no': ['1', '2'], 'kar': ['Lunds Scoutkår', 'Okänd kår'],
+                               'name': ['A', 'B']})
+        with mock.patch('sys.stdout'), \
+                mock.patch.object(u, '_load_home_address_coords', return_value={}):
+            u.assign_coordinates(people, store=store)
+        self.assertEqual(people['lat'].tolist(), [55.7, u.SWEDEN_LAT])
+
+
+class TestGazetteer(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        place_rows = [
+            # name, asciiname, lat, lng, feature class, population
+            ('Linköping', 'Linkoping', 58.41, 15.62, 'P', 104232),
+            ('Linköping', 'Linkoping', 58.40, 15.50, 'A', 0),        # not a populated place
+            ('Lindesberg', 'Lindesberg', 59.59, 15.23, 'P', 9000),
+            ('Lindö', 'Lindo', 58.61, 16.25, 'P', 5000),
+            ('Lindö', 'Lindo', 59.50, 18.30, 'P', 200),              # smaller namesake
+            ('Kiruna', 'Kiruna', 67.86, 20.23, 'P', 17000),
+        ]
+        post_rows = [('582 20', 'Linköping', 58.411, 15.621), ('582 22', 'Linköping', 58.413, 15.625),
+                     ('981 31', 'Kiruna', 67.85, 20.22), ('123 45', 'Farsta', 59.24, 18.09)]
+        cls.tmp = tempfile.TemporaryDirectory()
+        places = os.path.join(cls.tmp.name, 'places.txt')
+        posts = os.path.join(cls.tmp.name, 'postcodes.txt')
+        with open(places, 'w', encoding='utf-8') as f:
+            for i, (name, ascii_name, lat, lng, fclass, pop) in enumerate(place_rows):
+                f.write('\t'.join([str(i), name, ascii_name, '', str(lat), str(lng), fclass, 'PPL',
+                                   'SE', '', '', '', '', '', str(pop), '', '', 'Europe/Stockholm',
+                                   '2024-01-01']) + '\n')
+        with open(posts, 'w', encoding='utf-8') as f:
+            for code, ort, lat, lng in post_rows:
+                f.write('\t'.join(['SE', code, ort, '', '', '', '', '', '', str(lat), str(lng), '4'])
+                        + '\n')
+        with mock.patch('sys.stdout'):
+            cls.gaz = u.build_gazetteer(places, posts, out_path=os.path.join(cls.tmp.name, 'g.npz'))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    def test_exact_prefix_fuzzy_and_postnummer(self):
+        self.assertAlmostEqual(self.gaz.exact('linköping ')['lat'], 58.41, places=4)
+        self.assertAlmostEqual(self.gaz.exact('Linkoping')['lng'], 15.62, places=4)
+        self.assertAlmostEqual(self.gaz.exact('Lindö')['lat'], 58.61, places=4)
+        self.assertAlmostEqual(self.gaz.exact('Farsta')['lat'], 59.24, places=4)  # postort only
+        self.assertIsNone(self.gaz.exact('Lin'))
+        self.assertEqual([h['display'] for h in self.gaz.prefix('lin')],
+                         ['Linköping', 'Lindesberg', 'Lindö'])
+        self.assertEqual(len(self.gaz.prefix('lin', limit=2)), 2)
+        self.assertEqual(self.gaz.fuzzy('Linköpping')['display'], 'Linköping')
+        self.assertIsNone(self.gaz.fuzzy('Stockholm'))
+        self.assertAlmostEqual(self.gaz.postnummer('582 22')['lat'], 58.413, places=4)
+        self.assertIsNone(self.gaz.postnummer('58221'))
+
+    def test_providers_and_kar_guess(self):
+        self.assertEqual(u.GazetteerProvider(self.gaz).geocode('Kirunaa')['display'], 'Kiruna')
+        self.assertIsNone(u.GazetteerProvider(self.gaz, fuzzy=False).geocode('Kirunaa'))
+
+        # Fuzzy hits are stored under their own source and looked up again
+        # on the next run, where a better provider can replace them.
+        cache = {}
+        fuzzy = u.GazetteerProvider(self.gaz)
+        found, _ = u.geocode_many(['Kirunaa', 'Kiruna'], [fuzzy], cache, workers=1)
+        self.assertEqual(cache['Kirunaa']['source'], 'gazetteer_fuzzy')
+        self.assertEqual(cache['Kiruna']['source'], 'gazetteer')
+        online = _FakeProvider('nominatim', {'Kirunaa': (67.9, 20.2)})
+        u.geocode_many(['Kirunaa', 'Kiruna'], [online, fuzzy], cache, workers=1)
+        self.assertEqual(online.calls, ['Kirunaa'])
+        self.assertEqual(cache['Kirunaa']['source'], 'nominatim')
+        self.assertAlmostEqual(u.PostnummerProvider(self.gaz).geocode('98131|Kiruna|Sverige')['lat'],
+                               67.85, places=4)
+        self.assertEqual(u._kar_place_guess('Linköpings Scoutkår', self.gaz)['display'],
+                         'Linköping')
+        self.assertIsNone(u._kar_place_guess('Equmenia Ost', self.gaz))
+
+
+class TestSyntheticCohort(unittest.TestCase):
+    def test_deterministic_and_well_formed(self):
+        df = synthetic_cohort(600, seed=3)
+        self.assertTrue(df.equals(synthetic_cohort(600, seed=3)))
+        self.assertEqual(len(df), 600)
+        members = set(df['member_no'])
+        for f1, f2, m in zip(df['friend_1'], df['friend_2'], df['member_no']):
+            for f in (f1, f2):
+                self.assertTrue(f == '' or (f in members and f != m))
+            self.assertTrue(f2 == '' or (f1 and f1 != f2))
+        wish = dict(zip(df['member_no'], df['friend_1']))
+        self.assertTrue(any(wish.get(f) == m for m, f in wish.items() if f))
+        self.assertGreater(df['kar'].nunique(), 60)
+        self.assertGreater(df['parent_org'].nunique(), 1)
+
+    def test_benchmark_case_and_compare(self):
+        import benchmark
+        case = benchmark.run_case(300, 'medium', seed=1, diversity_iterations=1000)
+        self.assertEqual(case['kar_violations'], 0)
+        self.assertIn('3.5', case['phase_seconds'])
+        results = {'cases': [case]}
+        self.assertEqual(benchmark.compare(results, json.loads(json.dumps(results))), [])
+        worse = dict(case, friend_satisfied=case['friend_satisfied'] - 1)
+        self.assertEqual(len(benchmark.compare({'cases': [worse]}, results)), 1)
+
+
 if __name__ == '__main__':
     unittest.main()
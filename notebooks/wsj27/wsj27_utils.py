@@ -2,6 +2,13 @@
 WSJ 2027 - Shared utilities for group assignment notebooks.
 
 Used by: rundresa, direktresa, and ledare notebooks.
+
+Needs numpy, pandas and requests. Optional packages, imported only by
+the features that use them (pip install them into the notebook kernel;
+nothing is vendored in this repo):
+  ortools      - assign_groups(engine='cpsat')
+  pyarrow      - Parquet participant snapshots (else a pandas pickle)
+  pyinstrument - assign_groups(profile='pyinstrument')
 """
 
 import requests
@@ -9,7 +16,9 @@ import json
 import re
 import math
 import random
+import bisect
 import os
+import time
 import numpy as np
 import pandas as pd
 from collections import defaultdict, Counter
@@ -31,6 +40,19 @@ CMT_FEES = {'25697', '25693'}
 
 WSJ_START = date(2027, 7, 29)
 SCOUTNET_URL = "https://www.scoutnet.se/api/project/get/participants"
+PARTICIPANTS_CACHE_PATH = '/config/notebooks/wsj27/scoutnet_participants_cache.json'
+SNAPSHOT_DIR = '/config/notebooks/wsj27/snapshots'
+# Bump when build_participant_dataframe / assign_coordinates / the Hilbert
+# index change what they produce, so older snapshots stop matching.
+SNAPSHOT_VERSION = 1
+GAZETTEER_PATH = '/config/notebooks/wsj27/gazetteer_se.npz'
+GEOCODE_STORE_PATH = '/config/notebooks/wsj27/geocode_store.sqlite'
+# JSON caches that predate the geocode store, imported into it by kind
+LEGACY_GEOCODE_CACHES = {
+    'kar': '/config/notebooks/wsj27/scoutkar_geocode_cache.json',
+    'place': '/config/notebooks/wsj27/ledare_geocode_cache.json',
+    'address': '/config/notebooks/wsj27/adress_geocode_cache.json',
+}
 
 # Question IDs (from Scoutnet form 39188) for friend wishes
 Q_FRIEND_1_MEMBER_NO = '87660'
@@ -83,12 +105,55 @@ except ImportError:
 # 1. API and Data Loading
 # =============================================================================
 
-def fetch_participants():
-    """Fetch all participants from Scoutnet API. Returns raw API response dict."""
-    from scoutnet_secrets import SCOUTNET_API_ID, SCOUTNET_API_KEY
-    response = requests.get(SCOUTNET_URL, auth=(SCOUTNET_API_ID, SCOUTNET_API_KEY))
-    response.raise_for_status()
-    raw_data = response.json()
+def fetch_participants(max_age_s=900, offline=False, cache_path=PARTICIPANTS_CACHE_PATH):
+    """Fetch all participants from Scoutnet API. Returns raw API response dict.
+
+    Each download is kept in cache_path (JSON: the payload, its fetch time
+    and the response's ETag/Last-Modified), so a rerun, or the next travel
+    set's notebook, can skip the network:
+      - cache younger than max_age_s seconds: used as is. max_age_s=0
+        always asks Scoutnet.
+      - older: the request is conditional (If-None-Match /
+        If-Modified-Since when Scoutnet sent validators), and a 304 answer
+        reuses the cached payload. Scoutnet has no endpoint for only the
+        changed participants, so a changed payload comes down whole.
+      - offline=True: the last cached payload regardless of age, no
+        network; raises FileNotFoundError if there is none."""
+    cached = None
+    if os.path.exists(cache_path):
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            cached = json.load(f)
+    if offline and cached is None:
+        raise FileNotFoundError(f"offline=True but no cached participants at {cache_path}")
+
+    age_s = time.time() - cached['fetched_at'] if cached else None
+    if offline or (cached and age_s < max_age_s):
+        raw_data = cached['payload']
+        fetched = time.strftime('%Y-%m-%d %H:%M', time.localtime(cached['fetched_at']))
+        print(f"Using cached participants from {fetched} ({age_s / 60:.0f} min old)")
+    else:
+        from scoutnet_secrets import SCOUTNET_API_ID, SCOUTNET_API_KEY
+        headers = {}
+        if cached and cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached and cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+        response = requests.get(SCOUTNET_URL, auth=(SCOUTNET_API_ID, SCOUTNET_API_KEY),
+                                headers=headers)
+        if response.status_code == 304:
+            raw_data = cached['payload']
+            print("Participants unchanged since last fetch (304); using cache")
+        else:
+            response.raise_for_status()
+            raw_data = response.json()
+        tmp = cache_path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'fetched_at': time.time(),
+                       'etag': response.headers.get('ETag') or (cached or {}).get('etag'),
+                       'last_modified': (response.headers.get('Last-Modified')
+                                         or (cached or {}).get('last_modified')),
+                       'payload': raw_data}, f, ensure_ascii=False)
+        os.replace(tmp, cache_path)
     participants_raw = raw_data.get('participants', {})
 
     cancelled = sum(1 for p in participants_raw.values() if p.get('cancelled'))
@@ -186,6 +251,46 @@ def load_samverkansorganisation_lookup(input_dir='/config/notebooks/wsj27/input'
     return lookup
 
 
+def _participant_columns(participants_raw):
+    """Flatten the API's participant dicts into one array per field, one
+    comprehension per field. Missing or non-dict `questions` and
+    `primary_membership_info` read as empty; answers come back as
+    stripped strings ('' when missing)."""
+    ps = list(participants_raw.values())
+    qs = [q if isinstance(q, dict) else {} for q in (p.get('questions', {}) for p in ps)]
+    ms = [m if isinstance(m, dict) else {}
+          for m in (p.get('primary_membership_info', {}) for p in ps)]
+
+    def column(values):
+        arr = np.empty(len(values), dtype=object)
+        arr[:] = values
+        return arr
+
+    def answers(qid):
+        return column(['' if v is None else str(v).strip()
+                       for v in [q.get(qid, '') for q in qs]])
+
+    return {
+        'cancelled': np.array([bool(p.get('cancelled')) for p in ps], dtype=bool),
+        'confirmed': np.array([bool(p.get('confirmed')) for p in ps], dtype=bool),
+        'status': column([str(q.get(Q_INTERNAL_STATUS, '')) for q in qs]),
+        'fee_id': column([str(p.get('fee_id', '')) for p in ps]),
+        'date_of_birth': column([p.get('date_of_birth', '') for p in ps]),
+        'name': column([f"{p.get('first_name', '')} {p.get('last_name', '')}" for p in ps]),
+        'sex': np.array([p.get('sex', 0) for p in ps]),
+        'member_no': column([str(p.get('member_no', mid))
+                             for mid, p in participants_raw.items()]),
+        'kar': column([m.get('group_name', '') for m in ms]),
+        'district': column([m.get('district_name', '') for m in ms]),
+        'region': column([m.get('region_name', '') for m in ms]),
+        'org_api': column([m.get('organisation_name', '') for m in ms]),
+        'friend_1': answers(Q_FRIEND_1_MEMBER_NO),
+        'friend_2': answers(Q_FRIEND_2_MEMBER_NO),
+        'friend_1_name': answers(Q_FRIEND_1_NAME),
+        'friend_2_name': answers(Q_FRIEND_2_NAME),
+    }
+
+
 def build_participant_dataframe(raw_data, include_reserves=False):
     """Build DataFrame from API response with age validation.
 
@@ -200,139 +305,106 @@ def build_participant_dataframe(raw_data, include_reserves=False):
     """
     participants_raw = raw_data.get('participants', {})
     org_lookup = load_samverkansorganisation_lookup()
-
-    def exact_age(birth_date, ref_date):
-        """Calculate exact age in whole years at ref_date."""
-        years = ref_date.year - birth_date.year
-        if (ref_date.month, ref_date.day) < (birth_date.month, birth_date.day):
-            years -= 1
-        return years
-
-    def get_question(questions, qid):
-        """Safely get a question answer, handling list/dict."""
-        if not isinstance(questions, dict):
-            return ''
-        val = questions.get(qid, '')
-        if val is None:
-            return ''
-        return str(val).strip()
-
-    rows = []
-    skipped = []
-    skipped_unconfirmed = 0
-    skipped_status = 0
-
-    for mid, p in participants_raw.items():
-        if p.get('cancelled'):
-            continue
-
-        # Skip unconfirmed registrations
-        if not p.get('confirmed'):
-            skipped_unconfirmed += 1
-            continue
-
-        # Skip denied; optionally allow reservlista through (marked below)
-        questions_for_status = p.get('questions', {})
-        status_val = (questions_for_status.get(Q_INTERNAL_STATUS, '')
-                      if isinstance(questions_for_status, dict) else '')
-        status_str = str(status_val)
-        is_reserve = (status_str == STATUS_RESERVE)
-        if status_str == STATUS_DENIED:
-            skipped_status += 1
-            continue
-        if is_reserve and not include_reserves:
-            skipped_status += 1
-            continue
-
-        fee_id = str(p.get('fee_id', ''))
-        dob = p.get('date_of_birth', '')
-        name = f"{p.get('first_name', '')} {p.get('last_name', '')}"
-
-        birth = None
-        if dob:
+    c = _participant_columns(participants_raw)
+
+    # Filters, in the order the per-person checks used to run.
+    active = ~c['cancelled']
+    unconfirmed = active & ~c['confirmed']
+    status = c['status']
+    is_reserve = status == STATUS_RESERVE
+    status_out = active & ~unconfirmed & ((status == STATUS_DENIED)
+                                          | (is_reserve & (not include_reserves)))
+    checked = active & ~unconfirmed & ~status_out
+    skipped_unconfirmed = int(unconfirmed.sum())
+    skipped_status = int(status_out.sum())
+
+    # Birth dates: plain 'YYYY-MM-DD' parsed in bulk, anything else (other
+    # ISO spellings, junk) through date.fromisoformat one by one.
+    # The length check keeps out unpadded dates that strptime would take.
+    dob = c['date_of_birth']
+    dob_str = dob.astype(str)
+    plain = checked & (np.char.str_len(dob_str) == 10)
+    parsed = pd.to_datetime(pd.Series(np.where(plain, dob_str, '')), format='%Y-%m-%d',
+                            errors='coerce')
+    year, month, day = (np.array(part.to_numpy(dtype=float, na_value=np.nan))
+                        for part in (parsed.dt.year, parsed.dt.month, parsed.dt.day))
+    for i in np.flatnonzero(checked & np.isnan(year)):
+        if dob[i]:
             try:
-                birth = date.fromisoformat(dob)
+                birth = date.fromisoformat(dob[i])
             except ValueError:
-                pass
-
-        # Age validation
-        if birth is None:
-            skipped.append(f"  NO DOB: {name} fee={fee_id}")
-            continue
-
-        age = exact_age(birth, WSJ_START)
-
-        if fee_id in DELTAGARE_FEES and (age < 14 or age >= 18):
-            skipped.append(f"  DELTAGARE wrong age: {name} born {dob} (age {age})")
-            continue
-        if fee_id in IST_FEES and age < 18:
-            skipped.append(f"  IST too young: {name} born {dob} (age {age})")
-            continue
+                continue
+            year[i], month[i], day[i] = birth.year, birth.month, birth.day
+    has_dob = ~np.isnan(year)
+    age = np.where(has_dob, WSJ_START.year - np.nan_to_num(year), 0).astype(int)
+    age -= has_dob & ((WSJ_START.month < month)
+                      | ((WSJ_START.month == month) & (WSJ_START.day < day)))
+
+    fee = c['fee_id']
+    is_deltagare_fee = np.isin(fee, list(DELTAGARE_FEES))
+    is_ist_fee = np.isin(fee, list(IST_FEES))
+    no_dob = checked & ~has_dob
+    wrong_age = checked & has_dob & is_deltagare_fee & ((age < 14) | (age >= 18))
+    too_young = checked & has_dob & ~wrong_age & is_ist_fee & (age < 18)
+    keep = checked & has_dob & ~wrong_age & ~too_young
 
-        # Determine category
-        if fee_id in CMT_FEES:
-            category = 'cmt'
-        elif fee_id in DELTAGARE_FEES:
-            category = 'deltagare'
-        elif fee_id in IST_FEES:
-            category = 'ist'
-        else:
-            category = 'deltagare' if 14 <= age <= 17 else 'ist'
-
-        # Extract kar info
-        membership = p.get('primary_membership_info', {})
-        if isinstance(membership, dict):
-            kar = membership.get('group_name', '')
-            district = membership.get('district_name', '')
-            region = membership.get('region_name', '')
-            org_api = membership.get('organisation_name', '')
-        else:
-            kar, district, region, org_api = '', '', '', ''
-        # Parent organisation: prefer the authoritative Excel export
-        # (Samverkansorganisation column), fall back to kår-name heuristic.
-        # The API's organisation_name only distinguishes Scouterna vs Gäster.
-        member_no_str = str(p.get('member_no', mid))
-        if member_no_str in org_lookup:
-            parent_org = org_lookup[member_no_str]
+    skipped = []
+    for i in np.flatnonzero(no_dob | wrong_age | too_young):
+        name = c['name'][i]
+        if no_dob[i]:
+            skipped.append(f"  NO DOB: {name} fee={fee[i]}")
+        elif wrong_age[i]:
+            skipped.append(f"  DELTAGARE wrong age: {name} born {dob[i]} (age {age[i]})")
         else:
-            parent_org = classify_parent_org(kar, org_api)
-
-        # Extract friend wishes from questions
-        questions = p.get('questions', {})
-        friend_1 = get_question(questions, Q_FRIEND_1_MEMBER_NO)
-        friend_2 = get_question(questions, Q_FRIEND_2_MEMBER_NO)
-        friend_1_name = get_question(questions, Q_FRIEND_1_NAME)
-        friend_2_name = get_question(questions, Q_FRIEND_2_NAME)
-
-        # Clean friend member numbers (ignore '0' and empty)
-        friend_1 = friend_1 if friend_1 and friend_1 != '0' else ''
-        friend_2 = friend_2 if friend_2 and friend_2 != '0' else ''
-
-        rows.append({
-            'member_no': str(p.get('member_no', mid)),
-            'name': name,
-            'birth_date': dob,
-            'age': age,
-            'sex': p.get('sex', 0),
-            'fee_id': fee_id,
-            'category': category,
-            'travel': ('rundresa' if fee_id in (DELTAGARE_RUNDRESA, IST_RUNDRESA)
-                       else ('direktresa' if fee_id == DELTAGARE_DIREKTRESA
-                             else ('egen_resa' if fee_id == IST_EGEN_RESA
-                                   else 'other'))),
-            'kar': kar,
-            'district': district,
-            'region': region,
-            'parent_org': parent_org,
-            'friend_1': friend_1,
-            'friend_2': friend_2,
-            'friend_1_name': friend_1_name,
-            'friend_2_name': friend_2_name,
-            'reserve': is_reserve,
-            'group': None,  # To be assigned
-        })
-
-    df = pd.DataFrame(rows)
+            skipped.append(f"  IST too young: {name} born {dob[i]} (age {age[i]})")
+
+    rows = np.flatnonzero(keep)
+    fee, age = fee[rows], age[rows]
+    category = np.select(
+        [np.isin(fee, list(CMT_FEES)), is_deltagare_fee[rows], is_ist_fee[rows],
+         (age >= 14) & (age <= 17)],
+        ['cmt', 'deltagare', 'ist', 'deltagare'], 'ist')
+    travel = np.select(
+        [np.isin(fee, [DELTAGARE_RUNDRESA, IST_RUNDRESA]), fee == DELTAGARE_DIREKTRESA,
+         fee == IST_EGEN_RESA],
+        ['rundresa', 'direktresa', 'egen_resa'], 'other')
+
+    # Parent organisation: prefer the authoritative Excel export
+    # (Samverkansorganisation column), fall back to the kår-name heuristic,
+    # evaluated once per distinct (kår, API organisation).
+    # The API's organisation_name only distinguishes Scouterna vs Gäster.
+    member_no = c['member_no'][rows]
+    kar_org = list(zip(c['kar'][rows], c['org_api'][rows]))
+    heuristic = {pair: classify_parent_org(*pair) for pair in dict.fromkeys(kar_org)}
+    parent_org = [org_lookup[m] if m in org_lookup else heuristic[pair]
+                  for m, pair in zip(member_no, kar_org)]
+
+    # Friend member numbers: '0' and empty mean no wish.
+    friends = {}
+    for col in ('friend_1', 'friend_2'):
+        vals = c[col][rows]
+        friends[col] = np.where(vals == '0', '', vals)
+
+    df = pd.DataFrame({
+        'member_no': member_no,
+        'name': c['name'][rows],
+        'birth_date': dob[rows],
+        'age': age,
+        'sex': c['sex'][rows],
+        'fee_id': fee,
+        'category': category,
+        'travel': travel,
+        'kar': c['kar'][rows],
+        'district': c['district'][rows],
+        'region': c['region'][rows],
+        'parent_org': parent_org,
+        'friend_1': friends['friend_1'],
+        'friend_2': friends['friend_2'],
+        'friend_1_name': c['friend_1_name'][rows],
+        'friend_2_name': c['friend_2_name'][rows],
+        'reserve': is_reserve[rows],
+        'group': [None] * len(rows),  # To be assigned
+    })
 
     n_reserves = int(df['reserve'].sum()) if len(df) else 0
     print(f"Total participants: {len(df)} ({len(df) - n_reserves} confirmed, {n_reserves} reservlista)")
@@ -357,6 +429,31 @@ def build_participant_dataframe(raw_data, include_reserves=False):
     return df, skipped
 
 
+def _score_reserves(confirmed, reserves):
+    """Score reserves against the confirmed cohort (see select_top_reserves).
+
+    Returns reserves' member_no/name/kar plus a 'score' column, best first
+    (ties broken by member_no, name and kår, descending)."""
+    wished = pd.concat([confirmed['friend_1'], confirmed['friend_2']], ignore_index=True)
+    incoming = wished[wished != ''].value_counts()
+    confirmed_member_nos = pd.Index(confirmed['member_no'].unique())
+    kar_counts = confirmed['kar'].value_counts()
+
+    out = reserves[['member_no', 'name', 'kar']].reset_index(drop=True)
+    # +5 per confirmed deltagare who wished for this reserve
+    score = 5.0 * out['member_no'].map(incoming).fillna(0).to_numpy(dtype=float)
+    # +3 per outgoing wish to a confirmed deltagare
+    for col in ('friend_1', 'friend_2'):
+        fid = reserves[col].reset_index(drop=True)
+        score += 3.0 * ((fid != '') & fid.isin(confirmed_member_nos)).to_numpy()
+    # +0.5 per kår-mate already in cohort (capped at +3)
+    mates = out['kar'].map(kar_counts).fillna(0).to_numpy(dtype=float)
+    score += np.where(out['kar'] != '', np.minimum(3.0, 0.5 * mates), 0.0)
+    out['score'] = score
+    return out.sort_values(['score', 'member_no', 'name', 'kar'],
+                           ascending=False).reset_index(drop=True)
+
+
 def select_top_reserves(df_target, group_size, df_full=None):
     """Pick the best reserves to fill the last partial group.
 
@@ -376,72 +473,63 @@ def select_top_reserves(df_target, group_size, df_full=None):
 
     df_target: dataframe of confirmed + reserve candidates for one grouping
                (already filtered by travel/category)
-    group_size: target group size (e.g. 36)
+    group_size: target group size (e.g. 36), or a list of sizes to compare
+                (e.g. [36, 40]) — the reserves are scored once
     df_full: full participant df (for resolving cross-cohort friend wishes
              during scoring; defaults to df_target if not provided)
 
-    Returns df_target with non-selected reserves removed.
+    Returns df_target with non-selected reserves removed; for a list of
+    sizes, a dict {group_size: that dataframe}.
     """
     if df_full is None:
         df_full = df_target
 
     confirmed = df_target[~df_target['reserve']].copy()
     reserves = df_target[df_target['reserve']].copy()
+    sizes = [group_size] if np.ndim(group_size) == 0 else list(group_size)
     if len(reserves) == 0:
         print("(no reserves available)")
-        return confirmed
+        return confirmed if np.ndim(group_size) == 0 else {g: confirmed.copy() for g in sizes}
 
+    scores = _score_reserves(confirmed, reserves)
     n_confirmed = len(confirmed)
-    remainder = n_confirmed % group_size
-    needed = (group_size - remainder) % group_size
-    if needed == 0:
-        print(f"(confirmed cohort {n_confirmed} already fills groups; skipping reserves)")
-        return confirmed
-    take = min(needed, len(reserves))
-
-    # Build sets for scoring
-    confirmed_member_nos = set(confirmed['member_no'].values)
-    # Map member_no -> incoming wishes (who wished for me)
-    incoming = defaultdict(list)
-    for _, row in confirmed.iterrows():
-        for fid in (row['friend_1'], row['friend_2']):
-            if fid:
-                incoming[fid].append(row['member_no'])
-    kar_counts = Counter(confirmed['kar'].values)
-
-    scores = []
-    for _, r in reserves.iterrows():
-        score = 0.0
-        # +5 per confirmed deltagare who wished for this reserve
-        score += 5.0 * len(incoming.get(r['member_no'], []))
-        # +3 per outgoing wish to a confirmed deltagare
-        for fid in (r['friend_1'], r['friend_2']):
-            if fid and fid in confirmed_member_nos:
-                score += 3.0
-        # +0.5 per kår-mate already in cohort (capped at +3)
-        if r['kar']:
-            score += min(3.0, 0.5 * kar_counts.get(r['kar'], 0))
-        scores.append((score, r['member_no'], r['name'], r['kar']))
-
-    scores.sort(reverse=True)
-
-    selected_mnos = {s[1] for s in scores[:take]}
-    selected = reserves[reserves['member_no'].isin(selected_mnos)]
-    dropped = reserves[~reserves['member_no'].isin(selected_mnos)]
-
-    result = pd.concat([confirmed, selected], ignore_index=True)
-
-    print(f"=== Reserve selection ===")
-    print(f"  Confirmed: {n_confirmed}, slots to fill: {needed} (group_size={group_size})")
-    print(f"  Reserves available: {len(reserves)}, taken: {take}")
-    print(f"  Selected (score, member_no, name, kår):")
-    for s, mno, name, kar in scores[:take]:
-        print(f"    {s:5.1f}  {mno}  {name}  ({kar})")
-    if len(dropped) > 0:
-        print(f"  Dropped ({len(dropped)}):")
-        for s, mno, name, kar in scores[take:]:
-            print(f"    {s:5.1f}  {mno}  {name}  ({kar})")
-    return result
+    results = {}
+    for size in sizes:
+        remainder = n_confirmed % size
+        needed = (size - remainder) % size
+        if needed == 0:
+            print(f"(confirmed cohort {n_confirmed} already fills groups; skipping reserves)")
+            results[size] = confirmed.copy()
+            continue
+        take = min(needed, len(reserves))
+
+        selected_mnos = set(scores['member_no'].iloc[:take])
+        is_selected = reserves['member_no'].isin(selected_mnos)
+        selected = reserves[is_selected]
+        dropped = reserves[~is_selected]
+        results[size] = pd.concat([confirmed, selected], ignore_index=True)
+
+        print(f"=== Reserve selection ===")
+        print(f"  Confirmed: {n_confirmed}, slots to fill: {needed} (group_size={size})")
+        print(f"  Reserves available: {len(reserves)}, taken: {take}")
+        print(f"  Selected (score, member_no, name, kår):")
+        for r in scores.iloc[:take].itertuples():
+            print(f"    {r.score:5.1f}  {r.member_no}  {r.name}  ({r.kar})")
+        if len(dropped) > 0:
+            print(f"  Dropped ({len(dropped)}):")
+            for r in scores.iloc[take:].itertuples():
+                print(f"    {r.score:5.1f}  {r.member_no}  {r.name}  ({r.kar})")
+
+    if np.ndim(group_size) == 0:
+        return results[group_size]
+    if len(sizes) > 1:
+        print(f"=== Reserve fill by group size ===")
+        for size, df in results.items():
+            n = len(df)
+            print(f"  {size}: {n} participants, {n // size} full groups"
+                  f"{f' + 1 x {n % size}' if n % size else ''}, "
+                  f"{len(df) - n_confirmed} reserves taken")
+    return results
 
 
 # =============================================================================
@@ -570,6 +658,154 @@ def apply_manual_placement(df_target):
     return df_target
 
 
+class GeocodeStore:
+    """All geocodes in one SQLite file, keyed by (kind, key):
+      'kar'      kår name -> kår location
+      'place'    cleaned place name (ledare bostadsort) -> place
+      'address'  'postnummer|postort|land' -> postal location
+    Entries are dicts {'lat', 'lng'} plus 'display' and 'source' when
+    known; lat/lng None records a lookup that failed. Lookups hit the
+    primary-key index instead of loading the file, writes are single-row
+    upserts, and WAL mode lets notebooks read while another one writes.
+
+    On open, a legacy JSON cache (LEGACY_GEOCODE_CACHES) is imported
+    whenever it is newer than its last import, so the old files keep
+    working as an input until they are retired. An import only adds keys
+    the store does not have yet; it never overwrites a stored entry."""
+
+    KINDS = ('kar', 'place', 'address')
+
+    def __init__(self, path=GEOCODE_STORE_PATH, legacy=LEGACY_GEOCODE_CACHES):
+        import sqlite3
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS geocode ('
+                          'kind TEXT NOT NULL, key TEXT NOT NULL, lat REAL, lng REAL, '
+                          'display TEXT, source TEXT, updated REAL, '
+                          'PRIMARY KEY (kind, key)) WITHOUT ROWID')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS imports ('
+                          'path TEXT PRIMARY KEY, mtime REAL)')
+        self.conn.commit()
+        for kind, legacy_path in (legacy or {}).items():
+            self._import_legacy(kind, legacy_path)
+
+    def _import_legacy(self, kind, path):
+        if not os.path.exists(path):
+            return
+        mtime = os.path.getmtime(path)
+        row = self.conn.execute('SELECT mtime FROM imports WHERE path = ?', (path,)).fetchone()
+        if row and row[0] >= mtime:
+            return
+        with open(path, 'r', encoding='utf-8') as f:
+            entries = json.load(f)
+        before = self.count(kind)
+        self.put_many(kind, entries.items(), commit=False, replace=False)
+        self.conn.execute('INSERT OR REPLACE INTO imports VALUES (?, ?)', (path, mtime))
+        self.conn.commit()
+        print(f"Imported {self.count(kind) - before} new of {len(entries)} {kind} geocodes "
+              f"from {os.path.basename(path)}")
+
+    @staticmethod
+    def _entry(lat, lng, display, source):
+        entry = {'lat': lat, 'lng': lng}
+        if display is not None:
+            entry['display'] = display
+        if source is not None:
+            entry['source'] = source
+        return entry
+
+    def get(self, kind, key):
+        row = self.conn.execute('SELECT lat, lng, display, source FROM geocode '
+                                'WHERE kind = ? AND key = ?', (kind, key)).fetchone()
+        return self._entry(*row) if row else None
+
+    def get_many(self, kind, keys):
+        """{key: entry} for the keys that are stored."""
+        keys = list(dict.fromkeys(keys))
+        out = {}
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            marks = ','.join('?' * len(chunk))
+            for key, *row in self.conn.execute(
+                    f'SELECT key, lat, lng, display, source FROM geocode '
+                    f'WHERE kind = ? AND key IN ({marks})', (kind, *chunk)):
+                out[key] = self._entry(*row)
+        return out
+
+    def put_many(self, kind, items, commit=True, replace=True):
+        """Store (key, entry) pairs. replace=False keeps entries that are
+        already stored."""
+        if kind not in self.KINDS:
+            raise ValueError(f"kind must be one of {self.KINDS}, got {kind!r}")
+        now = time.time()
+        self.conn.executemany(
+            f"INSERT OR {'REPLACE' if replace else 'IGNORE'} INTO geocode "
+            f"VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(kind, key, e.get('lat'), e.get('lng'), e.get('display'), e.get('source'), now)
+             for key, e in items])
+        if commit:
+            self.conn.commit()
+
+    def put(self, kind, key, entry):
+        self.put_many(kind, [(key, entry)])
+
+    def stamp(self, kind):
+        """(count, newest 'updated') of one kind. Any write to that kind
+        changes it; writes to other kinds do not."""
+        return tuple(self.conn.execute('SELECT COUNT(*), MAX(updated) FROM geocode '
+                                       'WHERE kind = ?', (kind,)).fetchone())
+
+    def keys(self, kind):
+        return [k for (k,) in self.conn.execute(
+            'SELECT key FROM geocode WHERE kind = ? ORDER BY key', (kind,))]
+
+    def count(self, kind):
+        return self.conn.execute('SELECT COUNT(*) FROM geocode WHERE kind = ?',
+                                 (kind,)).fetchone()[0]
+
+    def view(self, kind):
+        """A dict-like view of one kind, for code written against the old
+        JSON dicts (cache.get(key), cache[key] = entry, key in cache)."""
+        return _GeocodeView(self, kind)
+
+    def close(self):
+        self.conn.close()
+
+
+class _GeocodeView:
+    def __init__(self, store, kind):
+        self.store, self.kind = store, kind
+
+    def get(self, key, default=None):
+        entry = self.store.get(self.kind, key)
+        return default if entry is None else entry
+
+    def __getitem__(self, key):
+        entry = self.store.get(self.kind, key)
+        if entry is None:
+            raise KeyError(key)
+        return entry
+
+    def __setitem__(self, key, entry):
+        self.store.put(self.kind, key, entry)
+
+    def __contains__(self, key):
+        return self.store.get(self.kind, key) is not None
+
+    def __len__(self):
+        return self.store.count(self.kind)
+
+    def __iter__(self):
+        return iter(self.store.keys(self.kind))
+
+    def items(self):
+        return self.store.get_many(self.kind, self.store.keys(self.kind)).items()
+
+    def values(self):
+        return [entry for _, entry in self.items()]
+
+
 def _newest_participants_csv(input_dir='/config/notebooks/wsj27/input'):
     """Return the path of the newest participants_*.{csv,txt} export, or None."""
     import glob
@@ -580,38 +816,45 @@ def _newest_participants_csv(input_dir='/config/notebooks/wsj27/input'):
     return max(candidates, key=os.path.getmtime)
 
 
-def _load_home_address_coords(
-        csv_path=None,
-        cache_path='/config/notebooks/wsj27/adress_geocode_cache.json'):
-    """Build member_no → (lat, lng) from the address CSV + postnummer cache.
+def _load_home_address_coords(csv_path=None, store=None, gazetteer=None):
+    """Build member_no → (lat, lng) from the address CSV + the 'address'
+    geocodes in the geocode store (default: GeocodeStore()).
 
-    Returns an empty dict if either file is missing. csv_path defaults to the
-    newest `participants_*.csv` / `.txt` in the input directory."""
+    Addresses missing from the store fall back to the offline gazetteer's
+    postnummer centroid, then its postort (gazetteer defaults to the built
+    GAZETTEER_PATH, if any). Returns an empty dict if the CSV is missing.
+    csv_path defaults to the newest `participants_*.csv` / `.txt` in the
+    input directory."""
     if csv_path is None:
         csv_path = _newest_participants_csv()
-    if csv_path is None or not os.path.exists(cache_path):
+    if csv_path is None:
         return {}
+    if gazetteer is None:
+        gazetteer = _default_gazetteer()
     try:
         df_addr = pd.read_csv(csv_path, encoding='utf-8')
     except Exception as e:
         print(f"  (couldn't read address CSV {csv_path}: {e})")
         return {}
-    with open(cache_path, 'r', encoding='utf-8') as f:
-        cache = json.load(f)
+    addresses = []
+    for _, r in df_addr.iterrows():
+        mno = str(r.get('Medlemsnummer', '')).strip()
+        pnr = str(r.get('Postnummer', '')).strip()
+        pcity = str(r.get('Postort', '')).strip()
+        pland = str(r.get('Land', '')).strip()
+        if mno and pnr:
+            addresses.append((mno, pnr, pcity, f'{pnr}|{pcity}|{pland}'))
+    cache = (store or GeocodeStore()).get_many('address', [a[3] for a in addresses])
     # Sweden bbox: lat 54.5-70.5, lng 10-25 — covers the country with margin.
     # Reject addresses geocoded outside this; they fall through to kår-coords.
     SE_LAT_MIN, SE_LAT_MAX = 54.5, 70.5
     SE_LNG_MIN, SE_LNG_MAX = 10.0, 25.0
     out = {}
     rejected = 0
-    for _, r in df_addr.iterrows():
-        mno = str(r.get('Medlemsnummer', '')).strip()
-        pnr = str(r.get('Postnummer', '')).strip()
-        pcity = str(r.get('Postort', '')).strip()
-        pland = str(r.get('Land', '')).strip()
-        if not (mno and pnr):
-            continue
-        entry = cache.get(f'{pnr}|{pcity}|{pland}')
+    for mno, pnr, pcity, key in addresses:
+        entry = cache.get(key)
+        if (not entry or entry.get('lat') is None) and gazetteer is not None:
+            entry = gazetteer.postnummer(pnr) or gazetteer.exact(pcity)
         if entry and entry.get('lat') is not None:
             lat, lng = entry['lat'], entry['lng']
             if SE_LAT_MIN <= lat <= SE_LAT_MAX and SE_LNG_MIN <= lng <= SE_LNG_MAX:
@@ -623,8 +866,51 @@ def _load_home_address_coords(
     return out
 
 
-def assign_coordinates(df, geocode_cache_path='/config/notebooks/wsj27/scoutkar_geocode_cache.json',
-                       coord_source='kar'):
+def _resolve_coordinates(member_no, kar, person_coords, home_coords, kar_coords,
+                         coord_source='kar', kar_guess_coords=None):
+    """Pick each row's coordinates by priority (see assign_coordinates).
+
+    member_no, kar: aligned Series. person_coords and home_coords map
+    member_no -> (lat, lng); kar_coords and kar_guess_coords (places
+    guessed from kår names, the last fallback) map kår -> (lat, lng).
+    Each table is joined onto the rows and the results are combined with
+    combine_first in priority order. Returns a DataFrame on member_no's
+    index with lat, lng (NaN when unresolved) and source
+    ('manual' / 'home' / 'kar' / 'kar_guess' / 'centroid')."""
+    def joined(keys, table, source):
+        coords = pd.DataFrame.from_dict(table, orient='index', columns=['lat', 'lng'],
+                                        dtype=float)
+        coords = coords[~coords.index.duplicated()].reindex(keys.to_numpy())
+        coords = coords.reset_index(drop=True)
+        coords['source'] = pd.Series(source, index=coords.index).where(coords['lat'].notna())
+        return coords
+
+    manual = joined(member_no, person_coords, 'manual')
+    home = joined(member_no, home_coords, 'home')
+    by_kar = joined(kar, kar_coords, 'kar')
+    order = [manual, home, by_kar] if coord_source == 'home' else [manual, by_kar, home]
+    order.append(joined(kar, kar_guess_coords or {}, 'kar_guess'))
+    resolved = order[0]
+    for fallback in order[1:]:
+        resolved = resolved.combine_first(fallback)
+    resolved['source'] = resolved['source'].fillna('centroid')
+    return resolved[['lat', 'lng', 'source']].set_axis(member_no.index)
+
+
+def _kar_place_guess(kar, gazetteer):
+    """Gazetteer hit for the place a kår is named after, or None. Tries each
+    word left after strip_kar_noise, as is and without a genitive -s."""
+    for word in strip_kar_noise(kar).split():
+        word = word.strip('.,();:-')
+        if len(word) < 4:
+            continue
+        hit = gazetteer.exact(word) or (word.endswith('s') and gazetteer.exact(word[:-1]))
+        if hit:
+            return hit
+    return None
+
+
+def assign_coordinates(df, store=None, coord_source='kar'):
     """Add lat/lng columns to df.
 
     coord_source:
@@ -634,16 +920,26 @@ def assign_coordinates(df, geocode_cache_path='/config/notebooks/wsj27/scoutkar_
                home, kår used only as fallback.
 
     Resolution order per row when coord_source='kar':
-      1. MANUAL_PERSON_COORDS  2. kår geocode  3. home address  4. Sweden centroid
+      1. MANUAL_PERSON_COORDS  2. kår geocode  3. home address
+      4. kår-name guess  5. Sweden centroid
     When coord_source='home':
-      1. MANUAL_PERSON_COORDS  2. home address  3. kår geocode  4. Sweden centroid
+      1. MANUAL_PERSON_COORDS  2. home address  3. kår geocode
+      4. kår-name guess  5. Sweden centroid
+
+    Kår and home-address geocodes come from the geocode store (default:
+    GeocodeStore()); only the kårer and addresses in df are read. With the
+    offline gazetteer built (see build_gazetteer), kårer missing from the
+    store get a guess: the place their name points at ("Linköpings
+    Scoutkår" -> Linköping). A guess is only used for people with no home
+    address either, and is reported as source 'kar_guess'.
 
     Modifies df in-place and returns it.
     """
     if coord_source not in ('kar', 'home'):
         raise ValueError(f"coord_source must be 'kar' or 'home', got {coord_source!r}")
-    with open(geocode_cache_path, 'r', encoding='utf-8') as f:
-        geocode_cache = json.load(f)
+    store = store or GeocodeStore()
+    gazetteer = _default_gazetteer()
+    geocode_cache = store.get_many('kar', df['kar'].unique().tolist())
 
     # Manual overrides — applied at runtime so edits to
     # manual_friend_overrides.py take effect immediately.
@@ -662,47 +958,36 @@ def assign_coordinates(df, geocode_cache_path='/config/notebooks/wsj27/scoutkar_
     except ImportError:
         pass
 
-    home_coords = _load_home_address_coords()
-
-    def lookup(row):
-        # 1. Explicit person override wins.
-        if row['member_no'] in person_coords:
-            return person_coords[row['member_no']], 'manual'
-        if coord_source == 'home':
-            # 2a. Home address (more accurate per-person).
-            if row['member_no'] in home_coords:
-                return home_coords[row['member_no']], 'home'
-            # 3a. Kår-based geocoding fallback.
-            geo = geocode_cache.get(row['kar'], {})
-            if geo.get('lat') is not None:
-                return (geo['lat'], geo['lng']), 'kar'
-        else:
-            # 2b. Kår-based geocoding (clusters kår-mates).
-            geo = geocode_cache.get(row['kar'], {})
-            if geo.get('lat') is not None:
-                return (geo['lat'], geo['lng']), 'kar'
-            # 3b. Home-address fallback for uncached kår.
-            if row['member_no'] in home_coords:
-                return home_coords[row['member_no']], 'home'
-        # 4. Sweden centroid (caller fills nan later).
-        return (None, None), 'centroid'
-
-    results = df.apply(lookup, axis=1)
-    df['lat'] = [r[0][0] for r in results]
-    df['lng'] = [r[0][1] for r in results]
-    sources = [r[1] for r in results]
-
-    src_counter = Counter(sources)
-    no_coords_mask = df['lat'].isna()
+    kar_guess = {}
+    if gazetteer is not None:
+        for kar in df['kar'].unique():
+            if kar and geocode_cache.get(kar, {}).get('lat') is None:
+                hit = _kar_place_guess(kar, gazetteer)
+                if hit:
+                    kar_guess[kar] = (hit['lat'], hit['lng'])
+
+    home_coords = _load_home_address_coords(store=store, gazetteer=gazetteer)
+
+    kar_coords = {k: (v['lat'], v['lng']) for k, v in geocode_cache.items()
+                  if v.get('lat') is not None}
+    resolved = _resolve_coordinates(df['member_no'], df['kar'], person_coords,
+                                    home_coords, kar_coords, coord_source, kar_guess)
+    df['lat'] = resolved['lat'].to_numpy()
+    df['lng'] = resolved['lng'].to_numpy()
+
+    src_counter = resolved['source'].value_counts()
+    no_coords_mask = (resolved['source'] == 'centroid').to_numpy()
     no_coords = int(no_coords_mask.sum())
     print(f"Coords by source: home={src_counter.get('home', 0)}, "
           f"kår={src_counter.get('kar', 0)}, "
+          f"kår-name guess={src_counter.get('kar_guess', 0)}, "
           f"manual={src_counter.get('manual', 0)}")
     if no_coords:
         print("Without coordinates (Sweden centroid):")
-        for _, r in df[no_coords_mask].iterrows():
-            kar_label = f"kår={r['kar']!r}" if r['kar'] else "no kår"
-            print(f"  {r['name']} ({r['member_no']}) — {kar_label}")
+        missing = df.loc[no_coords_mask]
+        for name, mno, kar in zip(missing['name'], missing['member_no'], missing['kar']):
+            kar_label = f"kår={kar!r}" if kar else "no kår"
+            print(f"  {name} ({mno}) — {kar_label}")
     df['lat'] = df['lat'].fillna(SWEDEN_LAT)
     df['lng'] = df['lng'].fillna(SWEDEN_LNG)
 
@@ -712,14 +997,389 @@ def assign_coordinates(df, geocode_cache_path='/config/notebooks/wsj27/scoutkar_
     return df
 
 
-def geocode_places(df, place_column='Bostadsort',
-                   cache_path='/config/notebooks/wsj27/ledare_geocode_cache.json',
-                   manual_overrides=None):
-    """Geocode place names to lat/lng using geopy with file cache.
+class _TokenBucket:
+    """Thread-safe token bucket: acquire() blocks until a token is free.
+    Tokens refill at `rate` per second up to `burst`."""
+
+    def __init__(self, rate, burst=1):
+        import threading
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class NominatimProvider:
+    """Online geocoding through geopy's Nominatim. rate is requests per
+    second; Nominatim's usage policy allows at most one."""
+    name = 'nominatim'
+
+    def __init__(self, user_agent='wsj27-geocoder', country='Sweden', rate=1 / 1.1,
+                 timeout=10):
+        self.user_agent = user_agent
+        self.country = country
+        self.rate = rate
+        self.timeout = timeout
+        self._geocoder = None
+
+    def geocode(self, query):
+        if self._geocoder is None:
+            from geopy.geocoders import Nominatim
+            self._geocoder = Nominatim(user_agent=self.user_agent)
+        loc = self._geocoder.geocode(f"{query}, {self.country}", timeout=self.timeout)
+        if loc:
+            return {'lat': loc.latitude, 'lng': loc.longitude, 'display': loc.address}
+        return None
+
+
+def _gazetteer_key(name):
+    return ' '.join(str(name).lower().split())
+
+
+def _pack_strings(values):
+    return np.frombuffer('\n'.join(values).encode('utf-8'), dtype=np.uint8)
+
+
+def _unpack_strings(blob):
+    text = blob.tobytes().decode('utf-8')
+    return np.array(text.split('\n') if text else [], dtype=str)
+
+
+def build_gazetteer(places_path=None, postcodes_path=None, out_path=GAZETTEER_PATH,
+                    feature_class='P'):
+    """Build the offline gazetteer file from GeoNames' open Swedish dumps.
+
+    places_path: the SE.txt place dump (download.geonames.org/export/dump/SE.zip);
+        rows of `feature_class` (P = populated places) are indexed under
+        both their name and ASCII name. When two places share a name the
+        most populous one wins.
+    postcodes_path: the SE.txt postal-code dump (download.geonames.org/export/zip/SE.zip);
+        gives postnummer centroids, and the mean of each postort's
+        centroids for postort names the place dump lacks.
+
+    Writes out_path (.npz): sorted name keys and postnummer codes with
+    float32 coordinates, strings packed as UTF-8 blobs. Returns a
+    Gazetteer on the new file."""
+    places = {}
+    if places_path:
+        cols = ['geonameid', 'name', 'asciiname', 'alternatenames', 'lat', 'lng',
+                'feature_class', 'feature_code', 'country', 'cc2', 'admin1', 'admin2',
+                'admin3', 'admin4', 'population', 'elevation', 'dem', 'timezone', 'modified']
+        df = pd.read_csv(places_path, sep='\t', header=None, names=cols, quoting=3,
+                         usecols=['name', 'asciiname', 'lat', 'lng', 'feature_class',
+                                  'population'],
+                         keep_default_na=False, encoding='utf-8')
+        df = df[df['feature_class'] == feature_class]
+        df = df.sort_values('population', ascending=False, kind='stable')
+        for name, ascii_name, lat, lng, pop in zip(df['name'], df['asciiname'], df['lat'],
+                                                   df['lng'], df['population']):
+            for key in (_gazetteer_key(name), _gazetteer_key(ascii_name)):
+                if key and key not in places:
+                    places[key] = (name, lat, lng, int(pop or 0))
+
+    postnummer = {}
+    if postcodes_path:
+        cols = ['country', 'postnummer', 'ort', 'admin_name1', 'admin_code1', 'admin_name2',
+                'admin_code2', 'admin_name3', 'admin_code3', 'lat', 'lng', 'accuracy']
+        df = pd.read_csv(postcodes_path, sep='\t', header=None, names=cols, quoting=3,
+                         usecols=['postnummer', 'ort', 'lat', 'lng'], dtype={'postnummer': str},
+                         keep_default_na=False, encoding='utf-8')
+        df['postnummer'] = df['postnummer'].str.replace(r'\s', '', regex=True)
+        for code, lat, lng in zip(df['postnummer'], df['lat'], df['lng']):
+            if code.isdigit():
+                postnummer[int(code)] = (lat, lng)
+        orter = df.groupby('ort', sort=False)[['lat', 'lng']].mean()
+        for ort, (lat, lng) in zip(orter.index, orter.to_numpy()):
+            key = _gazetteer_key(ort)
+            if key and key not in places:
+                places[key] = (ort, lat, lng, 0)
+
+    keys = sorted(places)
+    codes = np.array(sorted(postnummer), dtype=np.int32)
+    np.savez(out_path,
+             keys=_pack_strings(keys),
+             names=_pack_strings([places[k][0] for k in keys]),
+             lat=np.array([places[k][1] for k in keys], dtype=np.float32),
+             lng=np.array([places[k][2] for k in keys], dtype=np.float32),
+             population=np.array([places[k][3] for k in keys], dtype=np.int32),
+             postnummer=codes,
+             post_lat=np.array([postnummer[c][0] for c in codes.tolist()], dtype=np.float32),
+             post_lng=np.array([postnummer[c][1] for c in codes.tolist()], dtype=np.float32))
+    print(f"Gazetteer: {len(keys)} place names, {len(codes)} postnummer -> {out_path}")
+    return Gazetteer(out_path)
+
+
+class Gazetteer:
+    """Offline Swedish place/postnummer index (see build_gazetteer).
+
+    Lookups binary-search sorted arrays: exact(name), prefix(text),
+    fuzzy(name) (difflib ratio against names sharing the first letter) and
+    postnummer(code). Each hit is {'lat', 'lng', 'display'}. Names are
+    matched case- and whitespace-insensitively."""
+
+    def __init__(self, path=GAZETTEER_PATH):
+        with np.load(path) as z:
+            self.keys = _unpack_strings(z['keys'])
+            self.names = _unpack_strings(z['names'])
+            self.lat, self.lng = z['lat'].astype(float), z['lng'].astype(float)
+            self.population = z['population']
+            self.codes = z['postnummer']
+            self.post_lat, self.post_lng = z['post_lat'].astype(float), z['post_lng'].astype(float)
+        self._by_initial = {}
+
+    @classmethod
+    def from_places(cls, places):
+        """In-memory index from a dict name -> (lat, lng)."""
+        self = cls.__new__(cls)
+        entries = sorted((_gazetteer_key(k), str(k), float(v[0]), float(v[1]))
+                         for k, v in places.items())
+        self.keys = np.array([e[0] for e in entries], dtype=str)
+        self.names = np.array([e[1] for e in entries], dtype=str)
+        self.lat = np.array([e[2] for e in entries])
+        self.lng = np.array([e[3] for e in entries])
+        self.population = np.zeros(len(entries), dtype=np.int32)
+        self.codes = np.zeros(0, dtype=np.int32)
+        self.post_lat = self.post_lng = np.zeros(0)
+        self._by_initial = {}
+        return self
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _hit(self, i):
+        return {'lat': float(self.lat[i]), 'lng': float(self.lng[i]),
+                'display': str(self.names[i])}
+
+    def exact(self, name):
+        key = _gazetteer_key(name)
+        i = int(np.searchsorted(self.keys, key))
+        if i < len(self.keys) and self.keys[i] == key:
+            return self._hit(i)
+        return None
+
+    def prefix(self, text, limit=10):
+        """Places whose name (or ASCII name) starts with text, most
+        populous first, each place once."""
+        key = _gazetteer_key(text)
+        lo = int(np.searchsorted(self.keys, key, side='left'))
+        hi = int(np.searchsorted(self.keys, key + '\U0010ffff', side='left'))
+        hits = {}
+        for i in lo + np.argsort(-self.population[lo:hi], kind='stable'):
+            hit = self._hit(i)
+            hits.setdefault((hit['display'], hit['lat'], hit['lng']), hit)
+            if len(hits) == limit:
+                break
+        return list(hits.values())
+
+    def fuzzy(self, name, threshold=0.85):
+        """Closest place name by difflib ratio (>= threshold), or None."""
+        from difflib import get_close_matches
+        key = _gazetteer_key(name)
+        if not key:
+            return None
+        initial = key[0]
+        if initial not in self._by_initial:
+            lo = int(np.searchsorted(self.keys, initial, side='left'))
+            hi = int(np.searchsorted(self.keys, initial + '\U0010ffff', side='left'))
+            self._by_initial[initial] = (lo, self.keys[lo:hi].tolist())
+        lo, block = self._by_initial[initial]
+        match = get_close_matches(key, block, n=1, cutoff=threshold)
+        if not match:
+            return None
+        return self._hit(lo + bisect.bisect_left(block, match[0]))
+
+    def postnummer(self, code):
+        digits = re.sub(r'\s', '', str(code))
+        if not digits.isdigit():
+            return None
+        i = int(np.searchsorted(self.codes, int(digits)))
+        if i < len(self.codes) and self.codes[i] == int(digits):
+            return {'lat': float(self.post_lat[i]), 'lng': float(self.post_lng[i]),
+                    'display': digits}
+        return None
+
+    def lookup(self, name, fuzzy=True):
+        """exact(name), falling back to fuzzy(name)."""
+        return self.exact(name) or (self.fuzzy(name) if fuzzy else None)
+
+
+def _as_gazetteer(source):
+    if isinstance(source, Gazetteer):
+        return source
+    if isinstance(source, str) and source.endswith('.npz'):
+        return Gazetteer(source)
+    if isinstance(source, str):
+        table = pd.read_csv(source, encoding='utf-8')
+        source = dict(zip(table['name'], zip(table['lat'], table['lng'])))
+    return Gazetteer.from_places(source)
+
+
+def _default_gazetteer():
+    """Gazetteer at GAZETTEER_PATH, or None if it hasn't been built."""
+    if not os.path.exists(GAZETTEER_PATH):
+        return None
+    return Gazetteer(GAZETTEER_PATH)
+
+
+class GazetteerProvider:
+    """Offline place-name lookup: exact match, then fuzzy (unless
+    fuzzy=False). Fuzzy hits carry source 'gazetteer_fuzzy', which
+    geocode_many treats as provisional. places: a Gazetteer, the path of a
+    built gazetteer (.npz), a dict name -> (lat, lng), or a CSV with name,
+    lat, lng columns."""
+    name = 'gazetteer'
+    rate = None
+
+    def __init__(self, places=GAZETTEER_PATH, fuzzy=True):
+        self.index = _as_gazetteer(places)
+        self.fuzzy = fuzzy
+
+    def geocode(self, query):
+        hit = self.index.exact(query)
+        if hit is None and self.fuzzy:
+            hit = self.index.fuzzy(query)
+            if hit is not None:
+                hit['source'] = 'gazetteer_fuzzy'
+        return hit
+
+
+class PostnummerProvider:
+    """Offline postnummer centroids. Answers queries that contain a Swedish
+    postnummer ("582 20", "58220 Linköping", "58220|Linköping|Sverige").
+    table: a Gazetteer or built gazetteer path (.npz), a dict postnummer ->
+    (lat, lng), or a CSV with postnummer, lat, lng columns."""
+    name = 'postnummer'
+    rate = None
+    _PNR = re.compile(r'(?<!\d)(\d{3})\s?(\d{2})(?!\d)')
+
+    def __init__(self, table=GAZETTEER_PATH):
+        if isinstance(table, Gazetteer) or (isinstance(table, str) and table.endswith('.npz')):
+            self.table = _as_gazetteer(table)
+            return
+        if isinstance(table, str):
+            df = pd.read_csv(table, encoding='utf-8', dtype={'postnummer': str})
+            table = dict(zip(df['postnummer'], zip(df['lat'], df['lng'])))
+        self.table = {re.sub(r'\s', '', str(k)): (float(lat), float(lng))
+                      for k, (lat, lng) in table.items()}
+
+    def geocode(self, query):
+        m = self._PNR.search(str(query))
+        if not m:
+            return None
+        if isinstance(self.table, Gazetteer):
+            return self.table.postnummer(m.group(1) + m.group(2))
+        hit = self.table.get(m.group(1) + m.group(2))
+        if hit:
+            return {'lat': hit[0], 'lng': hit[1]}
+        return None
+
+
+def _write_json_atomic(path, obj):
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(obj, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
 
-    Adds lat/lng columns to df. Uses Nominatim with Sweden bias.
-    Only successful geocodes are persisted to the cache, so failed
-    lookups are retried on subsequent runs.
+
+# Geocode sources that are kept but retried on the next geocode_many run.
+_PROVISIONAL_SOURCES = ('gazetteer_fuzzy',)
+
+
+def geocode_many(queries, providers, cache, cache_path=None, workers=4, chunk=25):
+    """Geocode queries through a chain of providers, concurrently.
+
+    Each query is tried against providers in order until one answers.
+    Providers with a `rate` (requests/s) share one token bucket per
+    provider across the worker threads, so e.g. Nominatim stays at its
+    allowed rate while offline providers run unthrottled. Queries already
+    in cache with coordinates never reach a provider or a limiter, unless
+    their source is provisional (_PROVISIONAL_SOURCES): those are looked up
+    again on every run.
+
+    New hits go into cache (with a 'source' field naming the provider,
+    unless the hit names its own);
+    with cache_path set the cache is written every `chunk` new hits and at
+    the end, so an interrupted run keeps what it already fetched.
+
+    Returns (results, errors): results maps every query to its cache entry
+    or None when no provider found it; errors maps queries whose provider
+    raised to the exception."""
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    results, todo = {}, []
+    for q in dict.fromkeys(queries):
+        hit = cache.get(q)
+        if (hit and hit.get('lat') is not None
+                and hit.get('source') not in _PROVISIONAL_SOURCES):
+            results[q] = hit
+        else:
+            todo.append(q)
+    if not todo:
+        return results, {}
+
+    limiters = [_TokenBucket(p.rate) if getattr(p, 'rate', None) else None
+                for p in providers]
+
+    def resolve(query):
+        for provider, limiter in zip(providers, limiters):
+            if limiter is not None:
+                limiter.acquire()
+            hit = provider.geocode(query)
+            if hit:
+                return {'source': provider.name, **hit}
+        return None
+
+    errors = {}
+    unsaved = 0
+    pool = ThreadPoolExecutor(max_workers=max(1, workers))
+    try:
+        futures = {pool.submit(resolve, q): q for q in todo}
+        for fut in as_completed(futures):
+            q = futures[fut]
+            try:
+                hit = fut.result()
+            except Exception as e:
+                errors[q] = e
+                hit = None
+            results[q] = hit
+            if hit:
+                cache[q] = hit
+                unsaved += 1
+                if cache_path and unsaved >= chunk:
+                    _write_json_atomic(cache_path, cache)
+                    unsaved = 0
+    finally:
+        # On an interrupt, drop the queued queries but keep what arrived.
+        pool.shutdown(wait=True, cancel_futures=True)
+        if cache_path and unsaved:
+            _write_json_atomic(cache_path, cache)
+    return results, errors
+
+
+def geocode_places(df, place_column='Bostadsort', store=None,
+                   manual_overrides=None, providers=None, workers=4):
+    """Geocode place names to lat/lng, cached as 'place' entries in the
+    geocode store (default: GeocodeStore()).
+
+    Adds lat/lng columns to df. Uncached places go through geocode_many
+    with `providers`. The default, when the offline gazetteer has been
+    built (see build_gazetteer), is its exact names, then Nominatim with
+    Sweden bias, then the gazetteer's fuzzy match as a last resort;
+    without it, Nominatim alone. Only successful geocodes are persisted
+    to the cache, so failed lookups are retried on subsequent runs, and
+    fuzzy matches (source 'gazetteer_fuzzy') are retried too.
 
     manual_overrides: dict[str, str] mapping cleaned place names that fail
         automatic geocoding to a target city. Use 'okänt' to default to
@@ -728,17 +1388,16 @@ def geocode_places(df, place_column='Bostadsort',
 
     Modifies df in-place and returns it.
     """
-    import time
-
     manual_overrides = manual_overrides or {}
+    if providers is None:
+        providers = [NominatimProvider(user_agent='wsj27-ledare-geocoder')]
+        if os.path.exists(GAZETTEER_PATH):
+            gazetteer = Gazetteer(GAZETTEER_PATH)
+            providers = [GazetteerProvider(gazetteer, fuzzy=False), *providers,
+                         GazetteerProvider(gazetteer)]
 
-    # Load cache and drop legacy None entries (we no longer cache failures)
-    if os.path.exists(cache_path):
-        with open(cache_path, 'r', encoding='utf-8') as f:
-            cache = json.load(f)
-        cache = {k: v for k, v in cache.items() if v.get('lat') is not None}
-    else:
-        cache = {}
+    store = store or GeocodeStore()
+    cache = store.view('place')
 
     # Clean place names: extract the main city
     def clean_place(raw):
@@ -756,21 +1415,11 @@ def geocode_places(df, place_column='Bostadsort',
             place = place.split(' / ')[0].strip()
         return place
 
-    geocoder = [None]
-    def geocode_one(name):
-        if geocoder[0] is None:
-            from geopy.geocoders import Nominatim
-            geocoder[0] = Nominatim(user_agent='wsj27-ledare-geocoder')
-        loc = geocoder[0].geocode(f"{name}, Sweden", timeout=10)
-        time.sleep(1.1)
-        if loc:
-            return {'lat': loc.latitude, 'lng': loc.longitude, 'display': loc.address}
-        return None
-
     # Resolve manual overrides up front (fail fast on bad targets)
     override_coords = {}
     if manual_overrides:
         print(f"Resolving {len(manual_overrides)} manuella overrides...")
+        targets = {}
         for raw_key, target in manual_overrides.items():
             target_str = (target or '').strip()
             city = 'Stockholm' if target_str.lower() == 'okänt' else target_str
@@ -779,17 +1428,16 @@ def geocode_places(df, place_column='Bostadsort',
                     f"Manuell override för {raw_key!r} är tom — "
                     f"ange 'okänt' eller ett stadsnamn."
                 )
-            cached = cache.get(city)
-            if cached and cached.get('lat') is not None:
-                coords = cached
-            else:
-                coords = geocode_one(city)
-                if coords is None:
-                    raise ValueError(
-                        f"Manuell override för {raw_key!r}: kunde inte geocoda {city!r}. "
-                        f"Kontrollera stavningen eller välj en annan stad."
-                    )
-                cache[city] = coords
+            targets[raw_key] = (city, target_str)
+        found, errors = geocode_many([city for city, _ in targets.values()], providers,
+                                     cache, workers=workers)
+        for raw_key, (city, target_str) in targets.items():
+            coords = found.get(city)
+            if coords is None:
+                raise ValueError(
+                    f"Manuell override för {raw_key!r}: kunde inte geocoda {city!r}. "
+                    f"Kontrollera stavningen eller välj en annan stad."
+                ) from errors.get(city)
             override_coords[raw_key] = coords
             target_label = f"okänt -> {city}" if target_str.lower() == 'okänt' else city
             print(f"  {raw_key!r} -> {target_label} ({coords['lat']:.4f}, {coords['lng']:.4f})")
@@ -800,24 +1448,26 @@ def geocode_places(df, place_column='Bostadsort',
         if cleaned:
             unique_places.add(cleaned)
 
-    # Geocode uncached, non-overridden places
-    uncached = [p for p in unique_places
-                if p not in cache and p not in override_coords]
+    # Geocode uncached, non-overridden places (stored failures and fuzzy
+    # matches are retried; a fuzzy match stays in use if the retry fails)
+    stored = {k: v for k, v in store.get_many('place', unique_places).items()
+              if v.get('lat') is not None}
+    known = {k: v for k, v in stored.items() if v.get('source') not in _PROVISIONAL_SOURCES}
+    uncached = sorted(p for p in unique_places
+                      if p not in known and p not in override_coords)
     if uncached:
         print(f"Geocoding {len(uncached)} new places...")
-        for place in sorted(uncached):
-            try:
-                result = geocode_one(place)
-                if result:
-                    cache[place] = result
-                    print(f"  {place} -> {result['lat']:.4f}, {result['lng']:.4f}")
-                else:
-                    print(f"  {place} -> NOT FOUND (ej cachelagrad — lägg till i MANUAL_OVERRIDES)")
-            except Exception as e:
-                print(f"  {place} -> ERROR: {e}")
-
-    with open(cache_path, 'w', encoding='utf-8') as f:
-        json.dump(cache, f, ensure_ascii=False, indent=2)
+        found, errors = geocode_many(uncached, providers, cache, workers=workers)
+        known.update((k, found.get(k) or stored.get(k)) for k in uncached
+                     if found.get(k) or k in stored)
+        for place in uncached:
+            result = found.get(place)
+            if place in errors:
+                print(f"  {place} -> ERROR: {errors[place]}")
+            elif result:
+                print(f"  {place} -> {result['lat']:.4f}, {result['lng']:.4f}")
+            else:
+                print(f"  {place} -> NOT FOUND (ej cachelagrad — lägg till i MANUAL_OVERRIDES)")
 
     # Assign coordinates
     def get_coords(raw):
@@ -825,8 +1475,8 @@ def geocode_places(df, place_column='Bostadsort',
         if cleaned in override_coords:
             c = override_coords[cleaned]
             return c['lat'], c['lng']
-        if cleaned and cleaned in cache and cache[cleaned].get('lat') is not None:
-            return cache[cleaned].get('lat'), cache[cleaned].get('lng')
+        if cleaned in known:
+            return known[cleaned]['lat'], known[cleaned]['lng']
         return None, None
 
     df['lat'] = df[place_column].apply(lambda p: get_coords(p)[0])
@@ -872,21 +1522,177 @@ def hilbert_xy2d(n, x, y):
     return d
 
 
-def geo_to_hilbert(lat, lng):
-    """Convert lat/lng to Hilbert curve index."""
-    x = int((lat - LAT_RANGE[0]) / (LAT_RANGE[1] - LAT_RANGE[0]) * (HILBERT_N - 1))
-    y = int((lng - LNG_RANGE[0]) / (LNG_RANGE[1] - LNG_RANGE[0]) * (HILBERT_N - 1))
-    x = max(0, min(HILBERT_N - 1, x))
-    y = max(0, min(HILBERT_N - 1, y))
-    return hilbert_xy2d(HILBERT_N, x, y)
+def hilbert_xy2d_array(n, x, y):
+    """hilbert_xy2d for whole integer arrays at once (same distances).
+    n must be a power of two up to 2**31."""
+    x = np.asarray(x, dtype=np.int64)
+    y = np.asarray(y, dtype=np.int64)
+    d = np.zeros(np.broadcast(x, y).shape, dtype=np.int64)
+    s = n // 2
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((3 * rx) ^ ry)
+        flip = ~ry & rx
+        x = np.where(flip, s - 1 - x, x)
+        y = np.where(flip, s - 1 - y, y)
+        x, y = np.where(ry, x, y), np.where(ry, y, x)
+        s //= 2
+    return d
 
 
-def add_hilbert_index(df):
-    """Add 'hilbert' column and return df sorted by it."""
-    df['hilbert'] = df.apply(lambda r: geo_to_hilbert(r['lat'], r['lng']), axis=1)
+def _spread_bits(v):
+    """Put bit i of each (32-bit) value at bit 2i."""
+    v = np.asarray(v).astype(np.uint64) & np.uint64(0xFFFFFFFF)
+    for shift, mask in ((16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF),
+                        (4, 0x0F0F0F0F0F0F0F0F), (2, 0x3333333333333333),
+                        (1, 0x5555555555555555)):
+        v = (v | (v << np.uint64(shift))) & np.uint64(mask)
+    return v
+
+
+def morton_xy2d_array(n, x, y):
+    """Z-order (Morton) distance in an n x n grid: x and y bits
+    interleaved, x in the higher bit of each pair. Cheaper than Hilbert
+    but with jumps between quadrants, for comparing the two orders."""
+    return ((_spread_bits(x) << np.uint64(1)) | _spread_bits(y)).astype(np.int64)
+
+
+_CURVES = {'hilbert': hilbert_xy2d_array, 'morton': morton_xy2d_array}
+
+
+def geo_to_hilbert(lat, lng, n=HILBERT_N, curve='hilbert'):
+    """Convert lat/lng to Hilbert curve index.
+
+    lat/lng may be scalars (returns an int) or arrays (returns an int64
+    array). n is the grid side (a power of two, up to 2**31): the default
+    256 cells over LAT_RANGE x LNG_RANGE are ~6 km, so a finer grid such as
+    4096 keeps neighbouring kårer in separate cells. curve='morton' gives
+    the Z-order index instead. NaN or infinite coordinates raise
+    ValueError: there is no sensible place on the curve for them."""
+    if n & (n - 1) or not 2 <= n <= 2 ** 31:
+        raise ValueError(f"n must be a power of two between 2 and 2**31, got {n}")
+    if curve not in _CURVES:
+        raise ValueError(f"curve must be one of {sorted(_CURVES)}, got {curve!r}")
+    lat = np.asarray(lat, dtype=float)
+    lng = np.asarray(lng, dtype=float)
+    bad = ~(np.isfinite(lat) & np.isfinite(lng))
+    if bad.any():
+        raise ValueError(f"geo_to_hilbert needs finite lat/lng; {int(bad.sum())} "
+                         f"coordinate pair(s) are NaN or infinite")
+    # Clipping before the cast truncates toward zero like int() did.
+    x = np.clip((lat - LAT_RANGE[0]) / (LAT_RANGE[1] - LAT_RANGE[0]) * (n - 1), 0, n - 1)
+    y = np.clip((lng - LNG_RANGE[0]) / (LNG_RANGE[1] - LNG_RANGE[0]) * (n - 1), 0, n - 1)
+    d = _CURVES[curve](n, x.astype(np.int64), y.astype(np.int64))
+    return int(d) if d.ndim == 0 else d
+
+
+def add_hilbert_index(df, sort=True, n=HILBERT_N, curve='hilbert'):
+    """Add 'hilbert' column and return df sorted by it (sort=False keeps
+    the row order and modifies df in-place). n and curve as in
+    geo_to_hilbert."""
+    df['hilbert'] = geo_to_hilbert(df['lat'].to_numpy(dtype=float),
+                                   df['lng'].to_numpy(dtype=float), n=n, curve=curve)
+    if not sort:
+        return df
     return df.sort_values('hilbert').reset_index(drop=True)
 
 
+def _snapshot_key(raw_data, include_reserves, coord_source, store):
+    """Hash of everything the participant snapshot is derived from: the
+    Scoutnet payload, the build options, SNAPSHOT_VERSION, the stamps of
+    the 'kar' and 'address' geocodes in the store (see GeocodeStore.stamp;
+    'place' writes do not count) and the (mtime, size) of the side input
+    files — manual overrides, gazetteer, address CSV and
+    samverkansorganisation export."""
+    import glob
+    import hashlib
+    base = '/config/notebooks/wsj27'
+    side_inputs = [os.path.join(base, 'manual_friend_overrides.py'),
+                   GAZETTEER_PATH, _newest_participants_csv()]
+    side_inputs += glob.glob(os.path.join(base, 'input', '*Deltagare*Funktionar*.xlsx'))
+    h = hashlib.sha256()
+    h.update(json.dumps(raw_data, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+    h.update(repr((SNAPSHOT_VERSION, bool(include_reserves), coord_source)).encode())
+    h.update(repr([store.stamp(kind) for kind in ('kar', 'address')]).encode())
+    for path in sorted(filter(None, side_inputs)):
+        if os.path.exists(path):
+            st = os.stat(path)
+            h.update(f'{path}|{st.st_mtime_ns}|{st.st_size}'.encode())
+    return h.hexdigest()[:16]
+
+
+def load_participant_snapshot(raw_data, include_reserves=False, coord_source='kar',
+                              snapshot_dir=SNAPSHOT_DIR, keep=8, store=None):
+    """build_participant_dataframe + assign_coordinates + a 'hilbert' column,
+    cached on disk. Returns (df_all, skipped) like build_participant_dataframe,
+    with lat/lng/hilbert filled in and the row order unchanged.
+
+    The snapshot is keyed by a hash of the payload, the options and the side
+    inputs (see _snapshot_key), so a changed payload, kår or address
+    geocode, or manual override rebuilds it; otherwise opening a notebook
+    is one file read. store is the geocode store (default: GeocodeStore()).
+    Stored as Parquet (memory-mapped on load) when pyarrow is installed,
+    else as a pandas pickle. Only the newest `keep` snapshots are kept.
+
+    Filter df_all and sort the subset with
+    df.sort_values('hilbert').reset_index(drop=True) — the same order
+    assign_coordinates + add_hilbert_index give on that subset."""
+    try:
+        import pyarrow  # noqa: F401
+        ext = '.parquet'
+    except ImportError:
+        ext = '.pkl'
+    store = store or GeocodeStore()
+    key = _snapshot_key(raw_data, include_reserves, coord_source, store)
+    data_path = os.path.join(snapshot_dir, f'participants_{key}{ext}')
+    meta_path = os.path.join(snapshot_dir, f'participants_{key}.json')
+
+    meta = None
+    if os.path.exists(data_path) and os.path.exists(meta_path):
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+    if meta is not None and meta.get('version') == SNAPSHOT_VERSION:
+        if ext == '.parquet':
+            df_all = pd.read_parquet(data_path, memory_map=True)
+        else:
+            df_all = pd.read_pickle(data_path)
+        skipped = meta['skipped']
+        os.utime(meta_path)
+        print(f"Loaded participant snapshot {key} ({len(df_all)} participants, "
+              f"built {meta['created']})")
+    else:
+        df_all, skipped = build_participant_dataframe(raw_data,
+                                                      include_reserves=include_reserves)
+        assign_coordinates(df_all, store=store, coord_source=coord_source)
+        add_hilbert_index(df_all, sort=False)
+
+        os.makedirs(snapshot_dir, exist_ok=True)
+        tmp = data_path + '.tmp'
+        if ext == '.parquet':
+            df_all.to_parquet(tmp, index=False)
+        else:
+            df_all.to_pickle(tmp)
+        os.replace(tmp, data_path)
+        with open(meta_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'version': SNAPSHOT_VERSION, 'key': key,
+                       'created': time.strftime('%Y-%m-%d %H:%M'),
+                       'include_reserves': bool(include_reserves),
+                       'coord_source': coord_source,
+                       'rows': len(df_all), 'skipped': skipped}, f, ensure_ascii=False)
+        os.replace(meta_path + '.tmp', meta_path)
+
+    import glob
+    metas = sorted(glob.glob(os.path.join(snapshot_dir, 'participants_*.json')),
+                   key=os.path.getmtime, reverse=True)
+    for old in metas[keep:]:
+        stem = old[:-len('.json')]
+        for path in (old, stem + '.parquet', stem + '.pkl'):
+            if os.path.exists(path):
+                os.remove(path)
+    return df_all, skipped
+
+
 def print_intake_summary(df, group_size):
     """Print intake stats: count, group projection, region/age/sex distributions.
 
@@ -1370,13 +2176,29 @@ def build_friend_graph(df_target):
 def assign_groups(df_sorted, group_size, friend_wishes, max_kar=6,
                   quality='medium', weight_profile='balanced',
                   diversity_iterations=None, geo_weight=None, seed=None,
-                  friend_weight=None, div_weight=None, lonely_weight=None):
+                  friend_weight=None, div_weight=None, lonely_weight=None,
+                  workers=None, rotation_budget=None, schedule=None,
+                  time_budget_s=None, instrument=False, profile=None,
+                  profile_path=None, engine='heuristic', solver_time_s=60,
+                  previous=None, move_penalty=None, sa_neighbours=None,
+                  checkpoint=None, checkpoint_every=5000, resume=False):
     """Assign participants to groups. Public entry point.
 
     quality:
       'medium' - single run, ~1-3 min for 1500 people. Default.
       'slow'   - 8 independent restarts with different seeds; returns the
-                 assignment with the highest friend-satisfied count. ~10-30 min.
+                 assignment with the highest friend-satisfied count (ties go
+                 to the lowest seed). Restarts run on a process pool of
+                 `workers` processes (default: one per restart, capped at
+                 the CPU count); workers=1 runs them one after another.
+      'tempering' - Phases 1-3.5 once, then Phase 4 as parallel tempering:
+                 8 SA replicas in worker processes on a temperature ladder,
+                 exchanging temperatures between neighbours every 500
+                 proposals (see _parallel_tempering). The replicas run
+                 concurrently, so there are at most `workers` of them
+                 (default: the CPU count). Each replica runs
+                 diversity_iterations proposals, or time_budget_s seconds;
+                 schedule does not apply.
 
     weight_profile (controls Phase 4 SA scoring):
       'balanced'   - friend=5, div=1, geo=2, lonely=2. Default; respects all
@@ -1396,13 +2218,89 @@ def assign_groups(df_sorted, group_size, friend_wishes, max_kar=6,
     targets these directly; the SA scoring penalises any swap that
     increases the lonely count.
 
+    schedule (Phase 4 SA temperature schedule):
+      'fixed'    - T decays by 0.9995 per swap over diversity_iterations
+                   proposals. Default; reproducible for a given seed.
+      'adaptive' - T0 calibrated from sampled score deltas, then cooled to
+                   track a falling acceptance ratio. Stops at the horizon
+                   (time_budget_s, else diversity_iterations proposals) or
+                   earlier once the score plateaus.
+
+    time_budget_s: wall-clock seconds for the Phase 4 SA of each run
+    (each restart, in the slow tier). Implies schedule='adaptive'. Results
+    then depend on machine speed, so they are not reproducible.
+
+    sa_neighbours: Phase 4 draws most swap partners from the first
+    person's sa_neighbours geographically nearest groups (default 8), which
+    raises the acceptance rate several-fold; 0 proposes uniformly random
+    pairs across the whole travel set, as before.
+
+    rotation_budget: how many C candidates (nearest to A's group first) the
+    Phase 2.5 rotation search tries per (A, B) pair. None (default) tries
+    all of them, which finds every rotation the exhaustive search would;
+    set a number to trade rotations for speed on very large travel sets.
+
+    engine:
+      'heuristic' - Phases 1-4 as chosen by quality. Default.
+      'cpsat'     - the heuristic result, then re-solved exactly by OR-Tools
+                    CP-SAT (optional dependency) for up to solver_time_s
+                    seconds, warm-started from it (see _cpsat_polish). The
+                    model covers group sizes, max_kar, friend wishes,
+                    kår-konsolation and geography, but not diversity. It
+                    prints the solution's optimality gap; instrument=True
+                    also returns it under report['solver']. Meant for the
+                    small travel sets (ledare, IST, direktresa).
+
+    previous: incremental mode. The published assignment as a mapping
+    member_no -> 0-indexed group (a dict or Series, e.g. from
+    load_previous_groups). Members keep their group, newcomers fill the
+    holes left by cancellations (see _incremental_start), and Phases 2-4
+    then only swap within the groups that took someone in and the groups
+    of those people's friends. Moving a published member costs
+    move_penalty score points (default: friend_weight, i.e. one member
+    moved weighs as much as one wish satisfied). Works with the medium
+    and slow tiers and with engine='cpsat' (which sees the penalty but may
+    touch any group).
+
+    checkpoint: a file path (.npz). The run saves its state there after
+    every phase and every checkpoint_every Phase 4 proposals: assignment,
+    RNG state, swap counters and SA schedule (see _Checkpoint). After a
+    kernel restart, call again with the same arguments and resume=True to
+    carry on from the last save; the result is the same as that of an
+    uninterrupted run (time_budget_s runs excepted, as they never repeat
+    exactly). Resuming a checkpoint written for other participants or
+    other engine parameters raises ValueError. The slow tier keeps one
+    file per restart, named <stem>.restart<k>.npz. Not available for the
+    tempering tier.
+
+    instrument=True returns (df_sorted, report) instead of df_sorted.
+    report is a JSON-serialisable dict: 'phase_s' (wall seconds per phase,
+    plus 'setup'), 'calls' (do_swap / friend_satisfied / group_diversity
+    call counts), 'swaps' per phase, 'sa' (Phase 4 schedule, acceptance
+    counts, stop reason and per-epoch trajectory), 'result' (final
+    metrics) and 'wall_s' for the whole call. In the slow tier, phase_s
+    and calls are summed over restarts and 'restarts' holds each
+    restart's own report; the tempering tier reports Phases 1-3.5 at the
+    top, each replica under 'replicas' and the exchange statistics under
+    'tempering'. Counting calls adds a little overhead to the timings.
+
+    profile: 'cprofile' or 'pyinstrument' (optional dependency) runs the
+    call under that profiler and implies instrument=True; the top of the
+    profile goes in report['profile'] as text, and profile_path, if set,
+    gets the raw dump (pstats file, or pyinstrument HTML). Only the calling
+    process is profiled, so use workers=1 to profile the slow tier.
+
     Legacy kwargs (diversity_iterations, geo_weight, seed, friend_weight,
     div_weight, lonely_weight) override the corresponding preset/profile
     value when set explicitly.
     """
     presets = {
-        'medium': {'diversity_iterations': 15000, 'seed': 42, 'n_restarts': 1},
-        'slow':   {'diversity_iterations': 15000, 'seed': 42, 'n_restarts': 8},
+        'medium': {'diversity_iterations': 15000, 'seed': 42, 'n_restarts': 1,
+                   'schedule': 'fixed', 'sa_neighbours': 8},
+        'slow':   {'diversity_iterations': 15000, 'seed': 42, 'n_restarts': 8,
+                   'schedule': 'fixed', 'sa_neighbours': 8},
+        'tempering': {'diversity_iterations': 15000, 'seed': 42, 'n_restarts': 1,
+                      'n_replicas': 8, 'schedule': 'fixed', 'sa_neighbours': 8},
     }
     profiles = {
         'balanced':   {'friend_weight': 5.0,  'div_weight': 1.0, 'geo_weight': 2.0,
@@ -1411,7 +2309,8 @@ def assign_groups(df_sorted, group_size, friend_wishes, max_kar=6,
                        'lonely_weight': 3.0},
     }
     if quality not in presets:
-        raise ValueError(f"unknown quality {quality!r}; expected 'medium' or 'slow'")
+        raise ValueError(f"unknown quality {quality!r}; expected 'medium', 'slow' "
+                         f"or 'tempering'")
     if weight_profile not in profiles:
         raise ValueError(f"unknown weight_profile {weight_profile!r}; expected 'balanced' or 'friend_geo'")
     p = dict(presets[quality])
@@ -1428,47 +2327,1379 @@ def assign_groups(df_sorted, group_size, friend_wishes, max_kar=6,
         p['lonely_weight'] = lonely_weight
     if seed is not None:
         p['seed'] = seed
+    if sa_neighbours is not None:
+        p['sa_neighbours'] = sa_neighbours
+    p['rotation_budget'] = rotation_budget
+    if time_budget_s is not None:
+        p['schedule'] = 'adaptive'
+        p['time_budget_s'] = time_budget_s
+    if schedule is not None:
+        p['schedule'] = schedule
+    if p['schedule'] not in ('fixed', 'adaptive'):
+        raise ValueError(f"unknown schedule {p['schedule']!r}; expected 'fixed' or 'adaptive'")
+    if p['schedule'] == 'fixed' and time_budget_s is not None:
+        raise ValueError("time_budget_s needs schedule='adaptive'")
+    if engine not in ('heuristic', 'cpsat'):
+        raise ValueError(f"unknown engine {engine!r}; expected 'heuristic' or 'cpsat'")
+    if previous is not None and quality == 'tempering':
+        raise ValueError("previous= works with quality='medium' or 'slow', not 'tempering'")
+    if checkpoint is not None and quality == 'tempering':
+        raise ValueError("checkpoint= works with quality='medium' or 'slow', not 'tempering'")
+    if resume and checkpoint is None:
+        raise ValueError("resume=True needs checkpoint=<path>")
+    if checkpoint is not None:
+        p.update(checkpoint=os.fspath(checkpoint), checkpoint_every=checkpoint_every,
+                 resume=resume)
 
     n_restarts = p.pop('n_restarts')
+    n_replicas = p.pop('n_replicas', 0)
+    if profile is not None:
+        instrument = True
+    stats = _RunStats() if instrument else None
+    t_start = time.perf_counter()
+    problem = GroupProblem.from_dataframe(df_sorted)
+
+    if previous is not None:
+        prev = df_sorted['member_no'].map(previous).fillna(-1).astype(int).values
+        print(f"\n=== Incremental start from {int((prev >= 0).sum())} published members ===")
+        start, open_groups, anchor = _incremental_start(problem, prev, group_size, max_kar)
+        p.update(start_phase='2', start_group_of=start, open_groups=open_groups,
+                 anchor=anchor, move_penalty=(p['friend_weight'] if move_penalty is None
+                                              else move_penalty))
+
+    def run():
+        if previous is not None and not p['open_groups'].any():
+            group_of = p['start_group_of']
+        elif n_replicas:
+            group_of = _parallel_tempering(problem, group_size, max_kar, p, n_replicas,
+                                           workers=workers, stats=stats)
+        elif n_restarts == 1:
+            group_of = _assign_groups_problem(problem, group_size, max_kar=max_kar,
+                                              stats=stats, **p)
+        else:
+            group_of = _restart_tier(problem, group_size, max_kar, p, n_restarts, workers,
+                                     stats=stats)
+        if engine == 'cpsat':
+            group_of = _cpsat_polish(problem, group_of, max_kar, p,
+                                     time_limit_s=solver_time_s, stats=stats)
+        return group_of
+
+    if profile is not None:
+        group_of, profile_text = _profile_call(profile, profile_path, run)
+    else:
+        group_of = run()
+    df_sorted['group'] = group_of
+    if previous is not None:
+        moved = int(((p['anchor'] >= 0) & (group_of != p['anchor'])).sum())
+        print(f"\nIncremental: {moved} of {int((p['anchor'] >= 0).sum())} published "
+              f"members moved")
+        if stats is not None:
+            stats.extra['incremental'] = {
+                'published': int((p['anchor'] >= 0).sum()), 'moved': moved,
+                'newcomers': int((p['anchor'] < 0).sum()),
+                'open_groups': np.flatnonzero(p['open_groups']).tolist()}
+    if not instrument:
+        return df_sorted
+    report = {'quality': quality, 'n': problem.n, 'wall_s': time.perf_counter() - t_start}
+    report.update(stats.as_dict())
+    if profile is not None:
+        report['profile'] = profile_text
+    return df_sorted, report
+
+
+def _restart_tier(problem, group_size, max_kar, p, n_restarts, workers, stats=None):
+    """The slow tier: n_restarts full runs with seeds p['seed'], +1, ...
+    Returns the group_of with the most satisfied friend wishes."""
+    if workers is None:
+        workers = min(n_restarts, os.cpu_count() or 1)
+    instrument = stats is not None
+    restart_params = [dict(p, seed=p['seed'] + r) for r in range(n_restarts)]
+    if p.get('checkpoint'):
+        stem = os.path.splitext(p['checkpoint'])[0]
+        for r, attempt_p in enumerate(restart_params):
+            attempt_p['checkpoint'] = f"{stem}.restart{r}.npz"
+
+    print(f"\n{'#' * 60}\n# Slow tier: {n_restarts} restarts on {workers} worker(s)\n{'#' * 60}")
+    if workers <= 1:
+        results = []
+        for r, attempt_p in enumerate(restart_params):
+            print(f"\n----- Restart {r + 1}/{n_restarts} (seed={attempt_p['seed']}) -----")
+            run_stats = _RunStats() if instrument else None
+            group_of = _assign_groups_problem(problem, group_size, max_kar=max_kar,
+                                              stats=run_stats, **attempt_p)
+            sat = problem.count_friend_satisfied(group_of)
+            print(f"  -> friend-satisfied: {sat}")
+            results.append((group_of, sat, run_stats.as_dict() if instrument else None))
+    else:
+        results = _parallel_restarts(problem, group_size, max_kar, restart_params, workers,
+                                     instrument=instrument)
+
+    # Highest satisfaction wins; ties go to the lowest restart (= lowest
+    # seed), so the pick doesn't depend on which worker finished first.
+    best_r = max(range(n_restarts), key=lambda r: (results[r][1], -r))
+    best_group_of, best_sat, _ = results[best_r]
+    print(f"\n{'#' * 60}\n# Best of {n_restarts}: {best_sat} satisfied "
+          f"(restart {best_r + 1}, seed={restart_params[best_r]['seed']})\n{'#' * 60}")
+    if instrument:
+        for _, _, d in results:
+            stats.absorb(d)
+        stats.result = results[best_r][2].get('result')
+        stats.extra['restarts'] = [d for _, _, d in results]
+        stats.extra['best_restart'] = best_r
+    return best_group_of
+
+
+class _QueueLineWriter:
+    """stdout stand-in for worker processes: forwards each complete line to
+    a queue, prefixed with a tag, so the parent can print it as it arrives."""
+
+    def __init__(self, queue, tag):
+        self.queue = queue
+        self.tag = tag
+        self._buf = ''
+
+    def write(self, text):
+        self._buf += text
+        while '\n' in self._buf:
+            line, self._buf = self._buf.split('\n', 1)
+            self.queue.put(self.tag + line)
+        return len(text)
+
+    def flush(self):
+        pass
 
-    if n_restarts == 1:
-        return _assign_groups_once(df_sorted, group_size, friend_wishes,
-                                   max_kar=max_kar, **p)
-
-    print(f"\n{'#' * 60}\n# Slow tier: {n_restarts} restarts\n{'#' * 60}")
-    best_df, best_sat = None, -1
-    for r in range(n_restarts):
-        print(f"\n----- Restart {r + 1}/{n_restarts} (seed={p['seed'] + r}) -----")
-        attempt_p = dict(p, seed=p['seed'] + r)
-        attempt = _assign_groups_once(df_sorted.copy(), group_size, friend_wishes,
-                                      max_kar=max_kar, **attempt_p)
-        # Count satisfaction inline (cheap on already-assigned df)
-        m2g = dict(zip(attempt['member_no'], attempt['group']))
-        ms = set(attempt['member_no'])
-        sat = 0
-        for _, row in attempt.iterrows():
-            f1, f2 = row['friend_1'], row['friend_2']
-            if not ((f1 and f1 in ms) or (f2 and f2 in ms)):
-                continue
-            if (m2g.get(f1) == row['group']) or (m2g.get(f2) == row['group']):
-                sat += 1
+
+def _restart_worker(problem, group_size, max_kar, params, restart, queue,
+                    instrument=False):
+    """Process-pool entry point: one full run. Returns (restart, group_of,
+    sat, report), report being the run's _RunStats dict or None."""
+    from contextlib import redirect_stdout
+    writer = _QueueLineWriter(queue, f"[restart {restart + 1}, seed={params['seed']}] ")
+    stats = _RunStats() if instrument else None
+    with redirect_stdout(writer):
+        group_of = _assign_groups_problem(problem, group_size, max_kar=max_kar,
+                                          stats=stats, **params)
+        sat = problem.count_friend_satisfied(group_of)
         print(f"  -> friend-satisfied: {sat}")
-        if sat > best_sat:
-            best_sat, best_df = sat, attempt
-    print(f"\n{'#' * 60}\n# Best of {n_restarts}: {best_sat} satisfied\n{'#' * 60}")
-    df_sorted['group'] = best_df['group'].values
-    return df_sorted
-
-
-def _assign_groups_once(df_sorted, group_size, friend_wishes, max_kar=6,
-                        diversity_iterations=15000, geo_weight=2.0,
-                        friend_weight=5.0, div_weight=1.0, seed=42,
-                        lonely_weight=2.0):
-    """Single run of the full Phase 1-4 pipeline. See assign_groups for the
-    public entry point with quality tiers."""
+    return restart, group_of, sat, stats.as_dict() if instrument else None
+
+
+class _ReplicaFailure:
+    """Sent by a replica in place of its next message when it raises."""
+
+    def __init__(self, text):
+        self.text = text
+
+
+def _replica_worker(problem, group_size, max_kar, params, start_group_of, replica,
+                    conn, queue, epoch, instrument=False):
+    """Process entry point for one parallel-tempering replica: Phase 4 from
+    start_group_of, driven by the coordinator over conn. Sends back
+    (group_of, best score, report or None) when told to stop, or a
+    _ReplicaFailure with the traceback if the run raises."""
+    import traceback
+    from contextlib import redirect_stdout
+    try:
+        sched = _ReplicaSchedule(conn, epoch)
+        stats = _RunStats() if instrument else None
+        with redirect_stdout(_QueueLineWriter(queue, f"[replica {replica + 1}] ")):
+            group_of = _assign_groups_problem(problem, group_size, max_kar=max_kar,
+                                              start_phase='4', start_group_of=start_group_of,
+                                              schedule=sched, stats=stats, **params)
+        conn.send((group_of, sched.best, stats.as_dict() if instrument else None))
+    except BaseException:
+        try:
+            conn.send(_ReplicaFailure(traceback.format_exc()))
+        except (OSError, EOFError):
+            pass
+        raise
+
+
+def _parallel_tempering(problem, group_size, max_kar, params, n_replicas, workers=None,
+                        epoch=500, accept_cold=1e-9, accept_hot=1e-4, stats=None):
+    """Phases 1-3.5 once, then Phase 4 as parallel tempering (replica
+    exchange). Returns group_of.
+
+    Each replica is a worker process running the Phase 4 SA from the same
+    Phase 3.5 assignment, at one rung of a geometric temperature ladder.
+    The ladder spans the temperatures at which the replicas' pooled
+    calibration samples of worsening swaps would be accepted with mean
+    probability accept_cold and accept_hot. Every `epoch` proposals,
+    neighbouring rungs (even and odd pairs alternately) swap
+    temperatures with the usual Metropolis probability
+    min(1, exp((S_hot - S_cold) * (1/T_cold - 1/T_hot))), where S is the
+    score relative to the shared start. The run ends after
+    diversity_iterations proposals per replica, or time_budget_s seconds
+    when set. Each replica keeps the best assignment it saw, and the best
+    of those wins (ties go to the lowest replica). With stats, Phases 1-3.5
+    are timed into it directly and the replicas' reports are added.
+
+    All replicas run at once, so n_replicas is capped at workers (default:
+    the CPU count). A replica that raises or dies makes the whole call
+    raise RuntimeError with its traceback or exit code."""
+    import multiprocessing
+    import queue as _queue
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    n_replicas = max(1, min(n_replicas, workers))
+
+    def recv(r):
+        try:
+            msg = conns[r].recv()
+        except EOFError:
+            procs[r].join(timeout=5)
+            raise RuntimeError(f"tempering replica {r + 1} exited without a result "
+                               f"(exit code {procs[r].exitcode})") from None
+        if isinstance(msg, _ReplicaFailure):
+            raise RuntimeError(f"tempering replica {r + 1} failed:\n{msg.text}")
+        return msg
+
+    def drain(q):
+        while True:
+            try:
+                print(q.get_nowait())
+            except _queue.Empty:
+                return
+
+    params = dict(params)
+    params.pop('schedule', None)
+    time_budget_s = params.pop('time_budget_s', None)
+    rounds = max(1, math.ceil(params['diversity_iterations'] / epoch))
+
+    print(f"\n{'#' * 60}\n# Tempering tier: Phases 1-3.5 once, then {n_replicas} "
+          f"replicas\n{'#' * 60}")
+    start = _assign_groups_problem(problem, group_size, max_kar=max_kar,
+                                   stop_phase='3.5', stats=stats, **params)
+
+    q = multiprocessing.Queue()
+    conns, procs = [], []
+    for r in range(n_replicas):
+        parent, child = multiprocessing.Pipe()
+        proc = multiprocessing.Process(
+            target=_replica_worker, daemon=True,
+            args=(problem, group_size, max_kar, dict(params, seed=params['seed'] + r),
+                  start, r, child, q, epoch, stats is not None))
+        proc.start()
+        # Only the worker holds the child end now, so its exit shows up as
+        # EOFError in recv() instead of a hang.
+        child.close()
+        conns.append(parent)
+        procs.append(proc)
+    try:
+        uphill = [d for r in range(n_replicas) for d in recv(r)]
+        t_cold = _AnnealSchedule._calibrate(uphill, accept_cold)
+        t_hot = max(_AnnealSchedule._calibrate(uphill, accept_hot), t_cold)
+        ladder = [t_cold * (t_hot / t_cold) ** (k / max(n_replicas - 1, 1))
+                  for k in range(n_replicas)]
+        rung = list(range(n_replicas))  # replica -> ladder index
+        for conn, t in zip(conns, ladder):
+            conn.send(t)
+
+        rng = random.Random(params['seed'])
+        t_start = time.perf_counter()
+        tried = exchanged = 0
+        rnd, done = 0, False
+        while not done:
+            scores = [recv(r)[0] for r in range(n_replicas)]
+            drain(q)
+            at_rung = sorted(range(n_replicas), key=rung.__getitem__)
+            for k in range(rnd % 2, n_replicas - 1, 2):
+                cold, hot = at_rung[k], at_rung[k + 1]
+                x = (scores[hot] - scores[cold]) * (1 / ladder[k] - 1 / ladder[k + 1])
+                tried += 1
+                if x >= 0 or rng.random() < math.exp(x):
+                    rung[cold], rung[hot] = rung[hot], rung[cold]
+                    exchanged += 1
+            if time_budget_s is not None:
+                done = time.perf_counter() - t_start >= time_budget_s
+            else:
+                done = rnd + 1 >= rounds
+            for r, conn in enumerate(conns):
+                conn.send(None if done else ladder[rung[r]])
+            rnd += 1
+        results = [recv(r) for r in range(n_replicas)]
+        for proc in procs:
+            proc.join()
+        drain(q)
+    finally:
+        for proc in procs:
+            if proc.is_alive():
+                proc.terminate()
+
+    best_r = max(range(n_replicas), key=lambda r: (results[r][1], -r))
+    print(f"\n{'#' * 60}\n# Tempering: T {t_cold:.4g}..{t_hot:.4g}, {rnd} rounds, "
+          f"{exchanged}/{tried} exchanges accepted\n# Best replica: {best_r + 1} "
+          f"(score {results[best_r][1]:+.2f}, "
+          f"{problem.count_friend_satisfied(results[best_r][0])} satisfied)\n{'#' * 60}")
+    if stats is not None:
+        for _, _, d in results:
+            stats.absorb(d)
+        stats.result = results[best_r][2].get('result')
+        stats.extra['replicas'] = [d for _, _, d in results]
+        stats.extra['tempering'] = {'t_cold': t_cold, 't_hot': t_hot, 'rounds': rnd,
+                                    'exchanges_tried': tried, 'exchanges_accepted': exchanged,
+                                    'best_replica': best_r}
+    return results[best_r][0]
+
+
+def _parallel_restarts(problem, group_size, max_kar, restart_params, workers,
+                       instrument=False):
+    """Run one _assign_groups_problem per entry of restart_params on a process
+    pool, printing the workers' progress lines as they arrive.
+
+    Returns [(group_of, sat, report), ...] in restart order; report is None
+    unless instrument is set."""
+    import multiprocessing
+    import queue as _queue
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+    def drain(q):
+        while True:
+            try:
+                print(q.get_nowait())
+            except _queue.Empty:
+                return
+
+    results = [None] * len(restart_params)
+    with multiprocessing.Manager() as manager, \
+            ProcessPoolExecutor(max_workers=workers) as pool:
+        q = manager.Queue()
+        pending = {pool.submit(_restart_worker, problem, group_size, max_kar, params, r, q,
+                               instrument)
+                   for r, params in enumerate(restart_params)}
+        while pending:
+            done, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+            drain(q)
+            for fut in done:
+                r, group_of, sat, report = fut.result()
+                results[r] = (group_of, sat, report)
+        drain(q)
+    return results
+
+
+def _incremental_start(problem, previous, group_size, max_kar):
+    """Warm start for an incremental run from a published assignment.
+
+    previous holds each row's published group (-1 for newcomers). Everyone
+    else keeps their group. If the travel set now needs fewer groups, the
+    emptiest ones are dissolved, and surviving groups numbered past the new
+    group count take over the freed numbers. Overfull groups shed members
+    without a friend in the group, farthest from its median first.
+    Everyone left unplaced then takes the free slot that puts them with
+    the most friends (wishes either way), preferring groups with room in
+    their kår, then the nearest group median.
+
+    Returns (start_group_of, open_groups, anchor). open_groups marks the
+    groups that took in people, plus the groups of their friends, so
+    that repair can reunite them; anchor is previous after renumbering,
+    with -1 for members of dissolved groups."""
+    n = problem.n
+    total_groups = math.ceil(n / group_size)
+    remainder = n % group_size
+    prev = np.asarray(previous, dtype=np.int64).copy()
+    prev[prev < 0] = -1
+
+    labels, counts = np.unique(prev[prev >= 0], return_counts=True)
+    order = sorted(range(len(labels)), key=lambda j: (-counts[j], labels[j]))
+    keep = sorted(int(labels[j]) for j in order[:total_groups])
+    for j in order[total_groups:]:
+        print(f"  Group {labels[j] + 1} dissolved; its {counts[j]} member(s) are re-placed")
+        prev[prev == labels[j]] = -1
+    free = iter(sorted(set(range(total_groups)) - set(keep)))
+    for old in keep:
+        if old >= total_groups:
+            new = next(free)
+            print(f"  Group {old + 1} is renumbered to {new + 1}")
+            prev[prev == old] = new
+    anchor = prev.copy()
+    group_of = prev.copy()
+
+    size = np.bincount(group_of[group_of >= 0], minlength=total_groups)
+    capacity = np.full(total_groups, group_size)
+    if remainder:
+        # The smallest group (the highest number on ties) becomes the short one.
+        capacity[total_groups - 1 - int(np.argmin(size[::-1]))] = remainder
+
+    def friends_in(i, g):
+        f = problem.friend_idx[problem.friend_ptr[i]:problem.friend_ptr[i + 1]]
+        w = problem.rev_idx[problem.rev_ptr[i]:problem.rev_ptr[i + 1]]
+        return int((group_of[f] == g).sum() + (group_of[w] == g).sum())
+
+    for g in np.flatnonzero(size > capacity):
+        gm = np.flatnonzero(group_of == g)
+        d = ((problem.lat[gm] - np.median(problem.lat[gm]))**2
+             + (problem.lng[gm] - np.median(problem.lng[gm]))**2)
+        linked = np.array([friends_in(i, g) > 0 for i in gm])
+        shed = gm[np.lexsort((-d, linked))][:size[g] - capacity[g]]
+        group_of[shed] = -1
+        size[g] -= len(shed)
+
+    has_kar = problem.kar >= 0
+    kar_counts = np.zeros((total_groups, max(len(problem.kar_labels), 1)), dtype=np.int64)
+    placed = group_of >= 0
+    np.add.at(kar_counts, (group_of[placed & has_kar], problem.kar[placed & has_kar]), 1)
+    unplaced = np.flatnonzero(group_of < 0)
+    links = np.diff(problem.friend_ptr)[unplaced] + np.diff(problem.rev_ptr)[unplaced]
+    touched = np.zeros(total_groups, dtype=bool)
+    for i in unplaced[np.lexsort((unplaced, -links))]:
+        best, best_key = -1, None
+        for g in np.flatnonzero(size < capacity):
+            gm = np.flatnonzero(group_of == g)
+            d = (((problem.lat[i] - np.median(problem.lat[gm]))**2
+                  + (problem.lng[i] - np.median(problem.lng[gm]))**2) if len(gm)
+                 else float('inf'))
+            kar_ok = problem.kar[i] < 0 or kar_counts[g, problem.kar[i]] < max_kar
+            key = (friends_in(i, g), kar_ok, -d)
+            if best_key is None or key > best_key:
+                best, best_key = int(g), key
+        group_of[i] = best
+        size[best] += 1
+        touched[best] = True
+        if problem.kar[i] >= 0:
+            kar_counts[best, problem.kar[i]] += 1
+
+    open_groups = touched.copy()
+    for i in unplaced:
+        near = np.concatenate([problem.friend_idx[problem.friend_ptr[i]:problem.friend_ptr[i + 1]],
+                               problem.rev_idx[problem.rev_ptr[i]:problem.rev_ptr[i + 1]]])
+        open_groups[group_of[near]] = True
+    print(f"  Kept {int((group_of == anchor).sum())} of {int((anchor >= 0).sum())} "
+          f"published members in place; placed {len(unplaced)}; "
+          f"{int(open_groups.sum())}/{total_groups} groups open for repair")
+    return group_of, open_groups, anchor
+
+
+def _cpsat_polish(problem, group_of, max_kar, params, time_limit_s=60.0, stats=None):
+    """Re-solve an assignment with OR-Tools CP-SAT, warm-started from
+    group_of (the heuristic result). Returns the better of the two.
+
+    x[i, g] says person i is in group g. Group sizes are fixed to the
+    warm start's, and each kår gets at most max_kar people per group (or
+    the fewest its size allows, if more). The objective is the Phase 4
+    score without the diversity term, with group centres held at the warm
+    start's medians so that it stays linear:
+
+        friend_weight * (people with a wish satisfied)
+      + lonely_weight * (eligible people with a satisfied wish or a kår-mate)
+      - geo_weight * sum_g mean_{i in g} (squared distance from i to centre g)
+
+    scaled to integers. A wish pair is together only if, for every g,
+    x[i, g] <= x[j, g] allows it; "has a kår-mate" is bounded the same way
+    by the kår's head count in the group. CP-SAT runs for time_limit_s
+    seconds and reports its incumbent with a proven bound; the relative
+    gap (bound - objective) / objective is printed and, with stats,
+    recorded under stats.extra['solver'] with the before/after metrics.
+    CP-SAT searches on several threads, so runs that hit the time limit
+    are not reproducible."""
+    try:
+        from ortools.sat.python import cp_model
+    except ImportError:
+        raise ImportError("engine='cpsat' needs OR-Tools (pip install ortools)")
+
+    scale = 10 ** 6
+    friend_w = round(params['friend_weight'] * scale)
+    lonely_w = round(params['lonely_weight'] * scale)
+    t_start = time.perf_counter()
+    group_of = np.asarray(group_of)
+    n = problem.n
+    sizes = np.bincount(group_of)
+    n_groups = len(sizes)
+    groups = range(n_groups)
+    centre_lat = np.array([np.median(problem.lat[group_of == g]) for g in groups])
+    centre_lng = np.array([np.median(problem.lng[group_of == g]) for g in groups])
+    geo_cost = ((problem.lat[:, None] - centre_lat)**2 + (problem.lng[:, None] - centre_lng)**2)
+    geo_cost = np.rint(params['geo_weight'] * scale * geo_cost / sizes).astype(np.int64)
+
+    print(f"\n=== CP-SAT polish (time limit {time_limit_s:g}s) ===")
+    model = cp_model.CpModel()
+    x = [[model.NewBoolVar(f'x{i}_{g}') for g in groups] for i in range(n)]
+    for i in range(n):
+        model.AddExactlyOne(x[i])
+    for g in groups:
+        model.Add(sum(x[i][g] for i in range(n)) == int(sizes[g]))
+
+    kar_members = defaultdict(list)
+    for i, k in enumerate(problem.kar.tolist()):
+        if k >= 0:
+            kar_members[k].append(i)
+    kar_count = {}
+    warm_feasible = True
+    for k, members in kar_members.items():
+        if len(members) < 2:
+            continue
+        cap = max(max_kar, math.ceil(len(members) / n_groups))
+        if len(members) > cap:
+            warm_feasible &= bool(np.bincount(group_of[members]).max() <= cap)
+        for g in groups:
+            kar_count[k, g] = count = model.NewIntVar(0, len(members), f'kar{k}_{g}')
+            model.Add(count == sum(x[i][g] for i in members))
+            if len(members) > cap:
+                model.Add(count <= cap)
+
+    # One "together" flag per unordered wish pair, shared by mutual wishes.
+    together = {}
+    wish_flags = [[] for _ in range(n)]
+    for i in range(n):
+        for j in problem.friend_idx[problem.friend_ptr[i]:problem.friend_ptr[i + 1]].tolist():
+            pair = (min(i, j), max(i, j))
+            if pair not in together:
+                together[pair] = flag = model.NewBoolVar(f'pair{pair[0]}_{pair[1]}')
+                for g in groups:
+                    model.Add(flag + x[i][g] - x[j][g] <= 1)
+            wish_flags[i].append(together[pair])
+
+    objective = []
+    satisfied, consoled = {}, {}
+    for i in range(n):
+        if wish_flags[i]:
+            satisfied[i] = s = model.NewBoolVar(f'sat{i}')
+            model.Add(s <= sum(wish_flags[i]))
+            objective.append(friend_w * s)
+        k = int(problem.kar[i])
+        if k >= 0 and len(kar_members[k]) >= 2:
+            mate = model.NewBoolVar(f'mate{i}')
+            for g in groups:
+                model.Add(mate + 2 * x[i][g] - kar_count[k, g] <= 1)
+            consoled[i] = c = model.NewBoolVar(f'consoled{i}')
+            if i in satisfied:
+                model.Add(c <= mate + satisfied[i])
+            else:
+                model.Add(c <= mate)
+            objective.append(lonely_w * c)
+    objective.extend(-int(geo_cost[i, g]) * x[i][g] for i in range(n) for g in groups)
+    # Incremental runs: staying in the published group earns move_penalty.
+    anchor = params.get('anchor')
+    stay_w = round(params.get('move_penalty', 0.0) * scale) if anchor is not None else 0
+    stayers = ([i for i in range(n) if 0 <= anchor[i] < n_groups] if stay_w else [])
+    objective.extend(stay_w * x[i][int(anchor[i])] for i in stayers)
+    model.Maximize(sum(objective))
+
+    def score(assign):
+        """The model's objective for a full assignment, in scaled units."""
+        m = problem.metrics(assign, max_kar)
+        return (friend_w * m['friend_satisfied'] + lonely_w * (len(consoled) - m['lonely'])
+                - int(geo_cost[np.arange(n), assign].sum())
+                + stay_w * sum(1 for i in stayers if assign[i] == anchor[i]))
+
+    for i in range(n):
+        for g in groups:
+            model.AddHint(x[i][g], int(group_of[i] == g))
+
+    solver = cp_model.CpSolver()
+    solver.parameters.max_time_in_seconds = float(time_limit_s)
+    solver.parameters.random_seed = int(params.get('seed', 0))
+    status = solver.Solve(model)
+    status_name = solver.StatusName(status)
+
+    warm_score = score(group_of)
+    result = group_of
+    best_score = warm_score
+    if status in (cp_model.OPTIMAL, cp_model.FEASIBLE):
+        solved = np.array([next(g for g in groups if solver.BooleanValue(x[i][g]))
+                           for i in range(n)], dtype=group_of.dtype)
+        solved_score = score(solved)
+        # A warm start over a kår cap loses to any solution, as in Phase 3.
+        if solved_score > warm_score or not warm_feasible:
+            result, best_score = solved, solved_score
+        bound = solver.BestObjectiveBound()
+    else:
+        bound = None
+    gap = (None if bound is None
+           else max(0.0, bound - best_score) / max(abs(best_score), 1))
+    before, after = problem.metrics(group_of, max_kar), problem.metrics(result, max_kar)
+    print(f"  Model: {len(x) * n_groups} assignment vars, {len(together)} wish pairs, "
+          f"{len(consoled)} kår-konsolation candidates")
+    print(f"  Status: {status_name} after {solver.WallTime():.1f}s; objective "
+          f"{best_score / scale:.2f} (warm start {warm_score / scale:.2f}"
+          + ("" if warm_feasible else ", over a kår cap") + ")"
+          + (f", bound {bound / scale:.2f}, gap {gap * 100:.2f}%" if bound is not None else ""))
+    print(f"  Friend satisfaction: {before['friend_satisfied']} -> {after['friend_satisfied']}"
+          f"/{after['friend_total']}")
+    print(f"  Lonely:              {before['lonely']} -> {after['lonely']}")
+    print(f"  Kar violations:      {before['kar_violations']} -> {after['kar_violations']}")
+    print(f"  Avg geo spread:      {before['geo_spread']:.4f} -> {after['geo_spread']:.4f}")
+    print(f"  Diversity score:     {before['diversity']:.2f} -> {after['diversity']:.2f}")
+    if stats is not None:
+        stats.phase_s['cpsat'] = time.perf_counter() - t_start
+        stats.result = after
+        stats.extra['solver'] = {
+            'engine': 'cpsat', 'status': status_name, 'time_limit_s': time_limit_s,
+            'wall_s': solver.WallTime(), 'objective': best_score / scale,
+            'warm_start_objective': warm_score / scale, 'warm_start_feasible': warm_feasible,
+            'bound': None if bound is None else bound / scale, 'gap': gap,
+            'improved': result is not group_of, 'before': before,
+        }
+    return result
+
+
+# Diversity/geo deltas smaller than this are float noise from the running
+# sums, not a real change in the group.
+_SA_DELTA_EPS = 1e-9
+
+# Share of Phase 4 proposals (with sa_neighbours > 0) whose second person
+# comes from one of the first person's nearest groups; the rest stay
+# uniform so far-apart swaps remain reachable.
+_SA_LOCAL_SHARE = 0.8
+
+
+def _entropy(counts):
+    """Shannon entropy (bits) of a histogram given as an iterable of counts."""
+    counts = [c for c in counts if c > 0]
+    total = sum(counts)
+    if not total:
+        return 0.0
+    return -sum((c / total) * math.log2(c / total) for c in counts)
+
+
+def _code_entropy(codes):
+    """Entropy of an array of _factorize codes. Code -1 (missing) is not
+    counted, as in the Phase 4 SA histograms."""
+    return _entropy(np.bincount(codes[codes >= 0]).tolist())
+
+
+def _entropy_after_replace(counts, old, new):
+    """Entropy of histogram `counts` (list indexed by code) after one `old`
+    is replaced by `new`.
+
+    A code of -1 means "not counted" (e.g. no parent_org). Only reads the
+    histogram; cost is O(number of bins)."""
+    counts = list(counts)
+    if old >= 0:
+        counts[old] -= 1
+    if new >= 0:
+        counts[new] += 1
+    return _entropy(counts)
+
+
+def _kth_after_replace(vals, old, new, k):
+    """k-th smallest element of sorted list `vals` after removing one `old`
+    and inserting `new`, without building the new list. O(log n)."""
+    pa = bisect.bisect_left(vals, old)
+    pb = bisect.bisect_left(vals, new)
+    if pb > pa:
+        pb -= 1  # position of `new` in vals-without-old
+    if k == pb:
+        return new
+    j = k if k < pb else k - 1  # index into vals-without-old
+    return vals[j] if j < pa else vals[j + 1]
+
+
+def _median_after_replace(vals, old, new):
+    """np.median of sorted list `vals` with one `old` replaced by `new`."""
+    n = len(vals)
+    if n % 2:
+        return _kth_after_replace(vals, old, new, n // 2)
+    return (_kth_after_replace(vals, old, new, n // 2 - 1)
+            + _kth_after_replace(vals, old, new, n // 2)) / 2
+
+
+def _sq_dev(n, s, ss, c):
+    """Sum of squared deviations from c, given count n, sum s, sum of squares ss."""
+    return ss - 2 * c * s + n * c * c
+
+
+class _AnnealSchedule:
+    """Temperature control and stopping rule for the Phase 4 SA.
+
+    'fixed' is the original schedule: T starts at 1.0 and decays by 0.9995
+    per legal proposal, for exactly max_iterations proposals, with
+    acceptance using max(T, 0.01).
+
+    'adaptive' calibrates T0 from sampled score deltas, so that worsening
+    swaps are accepted with mean probability accept_start. After every
+    epoch of legal proposals, T is moved towards the temperature at which
+    that epoch's worsening swaps would be accepted with mean probability
+    equal to a target, but never upwards. The target decays geometrically
+    from accept_start to accept_end over the horizon, which is time_budget_s seconds if
+    set, else max_iterations proposals. The
+    run stops at the horizon, or earlier on a plateau: past half the
+    horizon with no new best score for plateau_epochs epochs in a row.
+
+    Call running() before each proposal and record() after each legal one.
+    trajectory gets one row per epoch: (proposals, temperature, accepted,
+    rejected, uphill acceptance, score relative to the start)."""
+
+    def __init__(self, mode='fixed', max_iterations=15000, time_budget_s=None,
+                 uphill_deltas=(), accept_start=0.001, accept_end=1e-5,
+                 epoch=500, plateau_epochs=20):
+        self.mode = mode
+        self.max_iterations = max_iterations
+        self.time_budget_s = time_budget_s
+        self.accept_start, self.accept_end = accept_start, accept_end
+        self.epoch, self.plateau_epochs = epoch, plateau_epochs
+        if mode == 'fixed':
+            self.t0, self.t_min = 1.0, 0.01
+        else:
+            self.t0, self.t_min = self._calibrate(uphill_deltas, accept_start), 0.0
+        self.temperature = self.t0
+        self.proposals = self.accepted = self.rejected = 0
+        self.score = self.best = 0.0
+        self.trajectory = []
+        self.stop_reason = None
+        self._ep = [0, 0, 0, 0]  # accepted, rejected, uphill tried, uphill accepted
+        self._uphill = []  # this epoch's worsening deltas, as magnitudes
+        self._improved = False
+        self._since_best = 0
+        self._start = time.perf_counter()
+
+    @staticmethod
+    def _calibrate(uphill_deltas, accept):
+        """Temperature at which the sampled worsening swaps (given as positive
+        magnitudes) are accepted with mean probability `accept`. Bisection
+        in log T; the mean is monotone in T."""
+        d = np.asarray(uphill_deltas, dtype=float)
+        if len(d) == 0:
+            return 1.0
+        lo, hi = math.log(d.min()) - 10, math.log(d.max()) + 10
+        for _ in range(60):
+            mid = (lo + hi) / 2
+            if np.exp(-d / math.exp(mid)).mean() > accept:
+                hi = mid
+            else:
+                lo = mid
+        return math.exp(hi)
+
+    def elapsed(self):
+        return time.perf_counter() - self._start
+
+    def progress(self):
+        """Fraction of the horizon used so far."""
+        if self.time_budget_s is not None:
+            return self.elapsed() / self.time_budget_s
+        return self.proposals / max(self.max_iterations, 1)
+
+    def running(self):
+        """Count one proposal, or return False once the run should stop."""
+        if self.stop_reason is None:
+            if self.time_budget_s is not None:
+                if self.progress() >= 1:
+                    self.stop_reason = 'time budget'
+            elif self.proposals >= self.max_iterations:
+                self.stop_reason = 'iteration budget'
+        if self.stop_reason is not None:
+            return False
+        self.proposals += 1
+        return True
+
+    def record(self, delta, accepted):
+        """Fold in one legal proposal with score change delta. Returns True
+        when it took the score to a new best."""
+        new_best = False
+        ep = self._ep
+        if delta < 0:
+            ep[2] += 1
+            ep[3] += accepted
+            self._uphill.append(-delta)
+        if accepted:
+            ep[0] += 1
+            self.accepted += 1
+            self.score += delta
+            if self.score > self.best + _SA_DELTA_EPS:
+                self.best = self.score
+                self._improved = new_best = True
+        else:
+            ep[1] += 1
+            self.rejected += 1
+        if self.mode == 'fixed':
+            self.temperature *= 0.9995
+        if ep[0] + ep[1] >= self.epoch:
+            self._end_epoch(adapt=True)
+        return new_best
+
+    def finish(self):
+        """Close a partial last epoch; call once after the loop."""
+        if self._ep[0] + self._ep[1]:
+            self._end_epoch(adapt=False)
+        if self.stop_reason is None:
+            self.stop_reason = 'iteration budget'
+
+    def _end_epoch(self, adapt):
+        acc, rej, up, up_acc = self._ep
+        self.trajectory.append((self.proposals, self.temperature, acc, rej,
+                                up_acc / up if up else 0.0, self.score))
+        self._ep = [0, 0, 0, 0]
+        uphill, self._uphill = self._uphill, []
+        if self.mode != 'adaptive' or not adapt:
+            return
+        p = min(self.progress(), 1.0)
+        target = self.accept_start * (self.accept_end / self.accept_start) ** p
+        if uphill:
+            # Expected acceptance of this epoch's worsening swaps is exact
+            # for any T, unlike the sampled ratio (mostly 0 at low targets),
+            # so re-solve for T and cool part of the way there. T never
+            # rises: late in a run the worsening swaps left are mostly big
+            # friend losses, which would otherwise pull T back up.
+            t_new = self._calibrate(uphill, target)
+            self.temperature *= max(0.5, min(1.0, (t_new / self.temperature) ** 0.5))
+        self._since_best = 0 if self._improved else self._since_best + 1
+        self._improved = False
+        if self._since_best >= self.plateau_epochs and p >= 0.5:
+            self.stop_reason = 'plateau'
+
+
+class _ReplicaSchedule(_AnnealSchedule):
+    """Phase 4 schedule for one parallel-tempering replica (see
+    _parallel_tempering). The coordinator owns the temperature: start()
+    sends it the calibration sample and receives T0, and after every
+    `epoch` proposals the replica reports (score, best) and gets back
+    its temperature, which may have been exchanged with a neighbour, or
+    None to stop."""
+
+    def __init__(self, conn, epoch=500):
+        # Epochs count all proposals here, legal or not, so a replica that
+        # rarely finds a legal swap still reports in on time.
+        super().__init__('tempering', max_iterations=0, epoch=float('inf'))
+        self.conn = conn
+        self.sync_every = epoch
+
+    def start(self, uphill_deltas):
+        self.conn.send(list(uphill_deltas))
+        self.t0 = self.temperature = self.conn.recv()
+
+    def running(self):
+        if self.proposals and self.proposals % self.sync_every == 0:
+            self._end_epoch(adapt=False)
+            self.conn.send((self.score, self.best))
+            temperature = self.conn.recv()
+            if temperature is None:
+                self.stop_reason = 'coordinator stop'
+                return False
+            self.temperature = temperature
+        self.proposals += 1
+        return True
+
+
+class _Checkpoint:
+    """Engine state on disk, so an interrupted run can resume (see
+    assign_groups' checkpoint/resume).
+
+    One .npz per run: arrays (the group slot layout, and in mid-Phase 4
+    saves the SA running sums and neighbour table) plus a JSON string with
+    the rest: the last finished phase ('4' once done, 'sa' inside Phase 4),
+    the RNG state, swap counters, SA schedule state and the run key (see
+    run_key), which a resume must match. Saves go to a temp file that is
+    then renamed over the old one, so a kill mid-write leaves the previous
+    checkpoint intact."""
+
+    # Schedule attributes that carry a Phase 4 run across a resume.
+    _SCHED_FIELDS = ('t0', 't_min', 'temperature', 'proposals', 'accepted', 'rejected',
+                     'score', 'best', 'trajectory', 'stop_reason', '_ep', '_uphill',
+                     '_improved', '_since_best')
+
+    def __init__(self, path, every=5000):
+        self.path = path
+        self.every = every
+
+    def save(self, phase, arrays, **state):
+        state['phase'] = phase
+        rng = random.getstate()
+        state['rng'] = [rng[0], list(rng[1]), rng[2]]
+        tmp = self.path + '.tmp.npz'
+        np.savez_compressed(tmp, state=np.array(json.dumps(state)), **arrays)
+        os.replace(tmp, self.path)
+
+    def load(self):
+        """(arrays, state) from the last save, with the RNG restored, or
+        None when there is no checkpoint yet."""
+        if not os.path.exists(self.path):
+            return None
+        with np.load(self.path, allow_pickle=False) as z:
+            arrays = {k: z[k] for k in z.files if k != 'state'}
+            state = json.loads(str(z['state']))
+        version, internal, gauss = state.pop('rng')
+        random.setstate((version, tuple(internal), gauss))
+        return arrays, state
+
+    @staticmethod
+    def run_key(problem, params):
+        """Hex digest of a GroupProblem and the engine parameters of a run.
+        Array parameters (start_group_of, open_groups, anchor) are hashed by
+        value, a schedule object by its class name."""
+        import hashlib
+        h = hashlib.sha256(problem.fingerprint().encode())
+        for name, value in sorted(params.items()):
+            if isinstance(value, (np.ndarray, list, tuple)):
+                value = hashlib.sha256(np.ascontiguousarray(value).tobytes()).hexdigest()
+            elif not isinstance(value, (str, int, float, type(None))):
+                value = type(value).__name__
+            h.update(f'{name}={value!r}|'.encode())
+        return h.hexdigest()
+
+    @classmethod
+    def sched_state(cls, sched):
+        state = {f: getattr(sched, f) for f in cls._SCHED_FIELDS}
+        state['elapsed'] = sched.elapsed()
+        return state
+
+    @classmethod
+    def restore_sched(cls, sched, state):
+        for f in cls._SCHED_FIELDS:
+            setattr(sched, f, state[f])
+        sched.trajectory = [tuple(row) for row in sched.trajectory]
+        sched._start = time.perf_counter() - state['elapsed']
+
+
+class _RunStats:
+    """Opt-in instrumentation for one engine run (see assign_groups'
+    instrument argument).
+
+    lap(name) charges the wall time since the previous lap to `name`, so
+    the engine calls it once at the end of setup and of every phase it
+    runs. counted(fn) wraps a closure so each call is counted under its
+    name; the wrapper costs a little per call, which shows up in the
+    phase times. as_dict() returns everything as plain JSON-able values."""
+
+    def __init__(self):
+        self.phase_s = {}
+        self.calls = Counter()
+        self.swaps = {}
+        self.sa = None
+        self.result = None
+        self.extra = {}
+        self._last = time.perf_counter()
+
+    def lap(self, name):
+        now = time.perf_counter()
+        self.phase_s[name] = self.phase_s.get(name, 0.0) + now - self._last
+        self._last = now
+
+    def counted(self, fn):
+        calls, name = self.calls, fn.__name__
+
+        def wrapper(*args):
+            calls[name] += 1
+            return fn(*args)
+        wrapper.__name__ = name
+        return wrapper
+
+    def record_schedule(self, sched, n_calibration, swaps):
+        traj_cols = ('proposals', 'temperature', 'accepted', 'rejected',
+                     'uphill_accept', 'score')
+        self.sa = {
+            'schedule': sched.mode, 't0': sched.t0,
+            'calibration_samples': n_calibration,
+            'proposals': sched.proposals, 'accepted': sched.accepted,
+            'rejected': sched.rejected, 'swaps': swaps,
+            'acceptance': sched.accepted / max(1, sched.accepted + sched.rejected),
+            'stop_reason': sched.stop_reason, 'elapsed_s': sched.elapsed(),
+            'final_score': sched.score, 'best_score': sched.best,
+            'trajectory': [dict(zip(traj_cols, row)) for row in sched.trajectory],
+        }
+
+    def absorb(self, report):
+        """Add another run's as_dict() phase times and call counts to this one's."""
+        for name, sec in report['phase_s'].items():
+            self.phase_s[name] = self.phase_s.get(name, 0.0) + sec
+        self.calls.update(report['calls'])
+
+    def as_dict(self):
+        d = {'phase_s': dict(self.phase_s),
+             'total_s': sum(self.phase_s.values()),
+             'calls': dict(self.calls),
+             'swaps': dict(self.swaps)}
+        if self.sa is not None:
+            d['sa'] = self.sa
+        if self.result is not None:
+            d['result'] = self.result
+        d.update(self.extra)
+        return d
+
+
+def _profile_call(profile, profile_path, fn, *args, **kwargs):
+    """Run fn under cProfile ('cprofile') or pyinstrument ('pyinstrument').
+    Returns (fn's result, text summary); with profile_path set, also dumps
+    the raw profile there (pstats file, or pyinstrument's HTML). Only the
+    calling process is profiled, not worker processes."""
+    import io
+    if profile == 'cprofile':
+        import cProfile
+        import pstats
+        prof = cProfile.Profile()
+        prof.enable()
+        try:
+            out = fn(*args, **kwargs)
+        finally:
+            prof.disable()
+        if profile_path:
+            prof.dump_stats(profile_path)
+        buf = io.StringIO()
+        pstats.Stats(prof, stream=buf).sort_stats('cumulative').print_stats(30)
+        return out, buf.getvalue()
+    if profile == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            raise ImportError("profile='pyinstrument' needs the pyinstrument package "
+                              "(pip install pyinstrument)")
+        prof = Profiler()
+        prof.start()
+        try:
+            out = fn(*args, **kwargs)
+        finally:
+            prof.stop()
+        if profile_path:
+            with open(profile_path, 'w', encoding='utf-8') as fh:
+                fh.write(prof.output_html())
+        return out, prof.output_text()
+    raise ValueError(f"unknown profile {profile!r}; expected 'cprofile' or 'pyinstrument'")
+
+
+def _factorize(values, blank_is_missing=False):
+    """Map values to int32 codes 0..k-1 in order of first appearance.
+
+    Returns (codes, labels). NaN always maps to -1; with blank_is_missing,
+    so do falsy values like '' (used for kår and parent_org, where a blank
+    means "none" rather than a category of its own)."""
+    values = list(values)
+    if blank_is_missing:
+        values = [v if v else None for v in values]
+    codes, labels = pd.factorize(pd.Series(values, dtype=object))
+    return codes.astype(np.int32), list(labels)
+
+
+def _csr_reverse(ptr, idx, n):
+    """Transpose a CSR edge list (i -> idx[ptr[i]:ptr[i+1]]) into its reverse,
+    keeping each (target, source) pair once. Sources come out ascending."""
+    src = np.repeat(np.arange(n, dtype=np.int64), np.diff(ptr))
+    key = np.unique(idx.astype(np.int64) * n + src)
+    rev_idx = (key % n).astype(np.int32)
+    rev_ptr = np.zeros(n + 1, dtype=np.int32)
+    np.cumsum(np.bincount(key // n, minlength=n), out=rev_ptr[1:])
+    return rev_ptr, rev_idx
+
+
+def _friend_components(ptr, idx, n):
+    """Connected-component label per row of a CSR friend graph (edges taken
+    as undirected), each component labelled by its lowest row index.
+
+    Min-label propagation over the edge arrays plus pointer jumping, so the
+    loop count grows with component diameter rather than with n."""
+    labels = np.arange(n)
+    src = np.repeat(np.arange(n), np.diff(ptr))
+    dst = np.asarray(idx, dtype=np.int64)
+    while True:
+        low = np.minimum(labels[src], labels[dst])
+        new = labels.copy()
+        np.minimum.at(new, src, low)
+        np.minimum.at(new, dst, low)
+        while True:
+            jumped = new[new]
+            if np.array_equal(jumped, new):
+                break
+            new = jumped
+        if np.array_equal(new, labels):
+            return labels
+        labels = new
+
+
+def _nearest_groups(group_members, group_len, lats, lngs, groups, k):
+    """(total_groups, k') table of each group's k' = min(k, len(groups) - 1)
+    nearest groups among `groups`, by distance between median centroids,
+    nearest first (ties in `groups` order). Rows of groups outside `groups`
+    are filled the same way.
+
+    Groups number in the hundreds, so the full centroid distance matrix
+    is small; it is built in row blocks to keep memory flat regardless."""
+    total = len(group_len)
+    c_lat = np.array([np.median(lats[group_members[g, :group_len[g]]]) for g in range(total)])
+    c_lng = np.array([np.median(lngs[group_members[g, :group_len[g]]]) for g in range(total)])
+    groups = np.asarray(groups)
+    k = min(k, len(groups) - 1)
+    out = np.empty((total, k), dtype=np.int64)
+    for lo in range(0, total, 256):
+        rows = np.arange(lo, min(lo + 256, total))
+        d = ((c_lat[rows, None] - c_lat[groups]) ** 2
+             + (c_lng[rows, None] - c_lng[groups]) ** 2)
+        d[rows[:, None] == groups] = np.inf
+        out[rows] = groups[np.argsort(d, axis=1, kind='stable')[:, :k]]
+    return out
+
+
+class _CapacityIndex:
+    """Remaining capacity per group as a max segment tree, so Phase 1 finds
+    the nearest group (by index) with room for a cluster in O(log groups)
+    instead of scanning them all."""
+
+    def __init__(self, capacity):
+        self.size = 1
+        while self.size < len(capacity):
+            self.size *= 2
+        self.tree = [-1] * (2 * self.size)
+        self.tree[self.size:self.size + len(capacity)] = capacity
+        for node in range(self.size - 1, 0, -1):
+            self.tree[node] = max(self.tree[2 * node], self.tree[2 * node + 1])
+
+    def set(self, g, value):
+        node = self.size + g
+        self.tree[node] = value
+        node //= 2
+        while node:
+            self.tree[node] = max(self.tree[2 * node], self.tree[2 * node + 1])
+            node //= 2
+
+    def first_at_least(self, lo, need):
+        """Lowest group index >= lo with capacity >= need, or -1."""
+        return self._first(1, 0, self.size - 1, lo, need)
+
+    def last_at_most(self, hi, need):
+        """Highest group index <= hi with capacity >= need, or -1."""
+        return self._last(1, 0, self.size - 1, hi, need)
+
+    def _first(self, node, left, right, lo, need):
+        if right < lo or self.tree[node] < need:
+            return -1
+        if left == right:
+            return left
+        mid = (left + right) // 2
+        found = self._first(2 * node, left, mid, lo, need)
+        return found if found >= 0 else self._first(2 * node + 1, mid + 1, right, lo, need)
+
+    def _last(self, node, left, right, hi, need):
+        if left > hi or self.tree[node] < need:
+            return -1
+        if left == right:
+            return left
+        mid = (left + right) // 2
+        found = self._last(2 * node + 1, mid + 1, right, hi, need)
+        return found if found >= 0 else self._last(2 * node, left, mid, hi, need)
+
+
+def _csr_pad(ptr, idx, n):
+    """Dense (n + 1, max degree) copy of a CSR edge list, padded with -1.
+    Row n is all -1, so padded entries can themselves be used as row
+    indices and come back as empty rows."""
+    deg = np.diff(ptr)
+    out = np.full((n + 1, max(int(deg.max(initial=0)), 1)), -1, dtype=np.int32)
+    rows = np.repeat(np.arange(n), deg)
+    out[rows, np.arange(len(idx)) - np.repeat(ptr[:-1], deg)] = idx
+    return out
+
+
+class GroupProblem:
+    """Integer-coded, array-backed form of one group-assignment problem.
+
+    Built once per travel set with GroupProblem.from_dataframe. kår, age,
+    sex and parent_org become small int32 codes (-1 = no kår / no org), and
+    friend wishes become CSR arrays over row indices: person i wishes for
+    friend_idx[friend_ptr[i]:friend_ptr[i + 1]], and is wished for by
+    rev_idx[rev_ptr[i]:rev_ptr[i + 1]]. Only wishes that point inside the
+    travel set are kept. The engine therefore never hashes member-number
+    strings in its hot loops.
+
+    Everything is plain NumPy, so a problem pickles cheaply to worker
+    processes and round-trips to disk with save()/load(). Labels are kept
+    for display only; load() returns them as strings."""
+
+    _FIELDS = ('member_no', 'lat', 'lng', 'kar', 'age', 'sex', 'org',
+               'friend_ptr', 'friend_idx',
+               'kar_labels', 'age_labels', 'sex_labels', 'org_labels')
+
+    def __init__(self, member_no, lat, lng, kar, age, sex, org,
+                 friend_ptr, friend_idx, kar_labels, age_labels, sex_labels,
+                 org_labels):
+        self.member_no = np.asarray(member_no)
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lng = np.asarray(lng, dtype=np.float64)
+        self.kar = np.asarray(kar, dtype=np.int32)
+        self.age = np.asarray(age, dtype=np.int32)
+        self.sex = np.asarray(sex, dtype=np.int32)
+        self.org = np.asarray(org, dtype=np.int32)
+        self.friend_ptr = np.asarray(friend_ptr, dtype=np.int32)
+        self.friend_idx = np.asarray(friend_idx, dtype=np.int32)
+        self.kar_labels = list(kar_labels)
+        self.age_labels = list(age_labels)
+        self.sex_labels = list(sex_labels)
+        self.org_labels = list(org_labels)
+
+        self.n = len(self.member_no)
+        self.rev_ptr, self.rev_idx = _csr_reverse(self.friend_ptr, self.friend_idx, self.n)
+        has_kar = self.kar >= 0
+        self.kar_global = np.bincount(self.kar[has_kar], minlength=len(self.kar_labels))
+
+    @classmethod
+    def from_dataframe(cls, df):
+        """Compile a participant DataFrame (lat, lng, kar, age, sex, member_no,
+        friend_1, friend_2, optional parent_org) in its current row order."""
+        member_no = df['member_no'].values.copy()
+        member_to_idx = {m: i for i, m in enumerate(member_no)}
+        friend_ptr = [0]
+        friend_idx = []
+        for f1, f2 in zip(df['friend_1'].values, df['friend_2'].values):
+            for fid in (f1, f2):
+                if fid and fid in member_to_idx:
+                    friend_idx.append(member_to_idx[fid])
+            friend_ptr.append(len(friend_idx))
+
+        kar, kar_labels = _factorize(df['kar'].values, blank_is_missing=True)
+        age, age_labels = _factorize(df['age'].values)
+        sex, sex_labels = _factorize(df['sex'].values)
+        orgs = (df['parent_org'].values if 'parent_org' in df.columns
+                else [''] * len(df))
+        org, org_labels = _factorize(orgs, blank_is_missing=True)
+        return cls(member_no, df['lat'].values, df['lng'].values, kar, age, sex, org,
+                   friend_ptr, friend_idx, kar_labels, age_labels, sex_labels,
+                   org_labels)
+
+    def save(self, path):
+        """Write the problem to a compressed .npz file (loadable without pickle)."""
+        data = {}
+        for name in self._FIELDS:
+            value = getattr(self, name)
+            if name.endswith('_labels') or name == 'member_no':
+                value = np.array([str(v) for v in value], dtype=str)
+            data[name] = value
+        np.savez_compressed(path, **data)
+
+    @classmethod
+    def load(cls, path):
+        """Read a problem written by save()."""
+        with np.load(path, allow_pickle=False) as z:
+            return cls(**{name: z[name] for name in cls._FIELDS})
+
+    def fingerprint(self):
+        """Hex digest of all fields, equal for a problem and its save()/load()
+        round trip (labels and member numbers are hashed as strings)."""
+        import hashlib
+        h = hashlib.sha256()
+        for name in self._FIELDS:
+            value = getattr(self, name)
+            if name.endswith('_labels') or name == 'member_no':
+                value = json.dumps([str(v) for v in value], ensure_ascii=False).encode('utf-8')
+            else:
+                value = np.ascontiguousarray(value).tobytes()
+            h.update(f'{name}|{len(value)}|'.encode())
+            h.update(value)
+        return h.hexdigest()
+
+    def count_friend_satisfied(self, group_of):
+        """Number of people with a friend wish in the set who share a group
+        with at least one wished friend."""
+        group_of = np.asarray(group_of)
+        src = np.repeat(np.arange(self.n), np.diff(self.friend_ptr))
+        ok = group_of[src] == group_of[self.friend_idx]
+        return int(np.unique(src[ok]).size)
+
+    def metrics(self, group_of, max_kar=6):
+        """Quality of an assignment, computed the way the engine's FINAL
+        RESULTS block does: friend_satisfied / friend_total, kar_violations
+        (members above max_kar, summed over kår and group), lonely (could
+        have a kår-mate, but has neither that nor a satisfied wish),
+        diversity (age + sex + org entropy summed over groups) and
+        geo_spread (mean over groups of the mean squared distance to the
+        group's median point)."""
+        group_of = np.asarray(group_of)
+        n_groups = int(group_of.max()) + 1
+        src = np.repeat(np.arange(self.n), np.diff(self.friend_ptr))
+        sat = np.zeros(self.n, dtype=bool)
+        sat[src[group_of[src] == group_of[self.friend_idx]]] = True
+        has_kar = self.kar >= 0
+        counts = np.zeros((n_groups, max(len(self.kar_labels), 1)), dtype=np.int64)
+        np.add.at(counts, (group_of[has_kar], self.kar[has_kar]), 1)
+        mate = np.zeros(self.n, dtype=bool)
+        mate[has_kar] = counts[group_of[has_kar], self.kar[has_kar]] >= 2
+        eligible = has_kar & (self.kar_global[np.maximum(self.kar, 0)] >= 2)
+        diversity, spreads = 0.0, []
+        for g in range(n_groups):
+            gm = np.flatnonzero(group_of == g)
+            diversity += (_code_entropy(self.age[gm]) + _code_entropy(self.sex[gm])
+                          + _code_entropy(self.org[gm]))
+            if len(gm) <= 1:
+                spreads.append(0.0)
+                continue
+            glat, glng = self.lat[gm], self.lng[gm]
+            spreads.append(float(np.mean((glat - np.median(glat))**2
+                                         + (glng - np.median(glng))**2)))
+        return {'friend_satisfied': int(sat.sum()),
+                'friend_total': int((np.diff(self.friend_ptr) > 0).sum()),
+                'kar_violations': int(np.maximum(counts - max_kar, 0).sum()),
+                'lonely': int((eligible & ~sat & ~mate).sum()),
+                'diversity': float(diversity),
+                'geo_spread': float(np.mean(spreads))}
+
+
+# Pipeline phases in run order, as printed in the engine's section headers.
+_PHASES = ('1', '2', '2.5', '3', '2b', '3.5', '4')
+
+
+def _assign_groups_problem(problem, group_size, max_kar=6,
+                           diversity_iterations=15000, geo_weight=2.0,
+                           friend_weight=5.0, div_weight=1.0, seed=42,
+                           lonely_weight=2.0, rotation_budget=None,
+                           schedule='fixed', time_budget_s=None,
+                           start_phase='1', stop_phase='4', start_group_of=None,
+                           stats=None, open_groups=None, anchor=None, move_penalty=0.0,
+                           sa_neighbours=0, checkpoint=None, checkpoint_every=5000,
+                           resume=False):
+    """Run Phase 1-4 on a GroupProblem and return group_of (one 0-indexed
+    group per participant, in problem row order).
+
+    start_phase/stop_phase (names from _PHASES) run only part of the
+    pipeline. Starting after Phase 1 needs start_group_of, the assignment
+    to continue from. schedule is 'fixed', 'adaptive' or a ready-made
+    _AnnealSchedule (the parallel-tempering replicas pass their own).
+    stats, a _RunStats, collects phase timings, call counts and SA
+    statistics for the run.
+
+    Incremental runs (see _incremental_start) pass open_groups, a mask of
+    the groups allowed to change (swaps need both groups open), and
+    anchor, each person's published group (-1 = none). Moving someone
+    away from their anchor group then costs move_penalty in the Phase 4
+    score, and move_penalty / friend_weight wishes in the repair phases.
+
+    sa_neighbours > 0 makes most Phase 4 proposals local: the second
+    person is drawn from one of the first person's sa_neighbours nearest
+    groups (by median centroid, see _nearest_groups) instead of from
+    anyone.
+
+    checkpoint, a file path, saves the run's state (see _Checkpoint) after
+    every phase and every checkpoint_every Phase 4 proposals. resume=True
+    continues from that file when it exists, with the same result as an
+    uninterrupted run; a checkpoint of a finished run returns its
+    assignment straight away."""
+    if start_phase != '1' and start_group_of is None:
+        raise ValueError(f"start_phase={start_phase!r} needs start_group_of")
+    run_from, run_to = _PHASES.index(start_phase), _PHASES.index(stop_phase)
+    ckpt = _Checkpoint(checkpoint, checkpoint_every) if checkpoint else None
+
+    def _runs(phase):
+        return run_from <= _PHASES.index(phase) <= run_to
+
+    def lap(name):
+        if stats is not None:
+            stats.lap(name)
+
     random.seed(seed)
 
-    n = len(df_sorted)
+    n = problem.n
+    run_key = None
+    if ckpt is not None:
+        run_key = _Checkpoint.run_key(problem, dict(
+            group_size=group_size, max_kar=max_kar, seed=seed,
+            diversity_iterations=diversity_iterations, geo_weight=geo_weight,
+            friend_weight=friend_weight, div_weight=div_weight,
+            lonely_weight=lonely_weight, rotation_budget=rotation_budget,
+            schedule=schedule, time_budget_s=time_budget_s, start_phase=start_phase,
+            stop_phase=stop_phase, start_group_of=start_group_of,
+            open_groups=open_groups, anchor=anchor, move_penalty=move_penalty,
+            sa_neighbours=sa_neighbours))
+    resumed = ckpt.load() if ckpt is not None and resume else None
+    if resumed is not None:
+        ck_arrays, ck = resumed
+        if ck.get('run_key') != run_key:
+            raise ValueError(f"checkpoint {checkpoint} was written for another run "
+                             f"(n={ck['n']}, group_size={ck['group_size']}, seed={ck['seed']}); "
+                             f"the problem or engine parameters differ")
+        if ck['phase'] == '4':
+            print(f"Resumed finished run from {checkpoint}")
+            return ck_arrays['group_of']
+        if ck['phase'] == 'sa':
+            run_from = _PHASES.index('4')
+            print(f"Resuming from {checkpoint} in Phase 4 at proposal "
+                  f"{ck['sched']['proposals']}")
+        else:
+            run_from = _PHASES.index(ck['phase']) + 1
+            print(f"Resuming from {checkpoint} after Phase {ck['phase']}")
     n_full_groups = n // group_size
     remainder = n % group_size
     total_groups = n_full_groups + (1 if remainder > 0 else 0)
@@ -1476,154 +3707,185 @@ def _assign_groups_once(df_sorted, group_size, friend_wishes, max_kar=6,
     print(f"Participants: {n}")
     print(f"Groups: {n_full_groups} x {group_size} + 1 x {remainder} = {total_groups} total")
 
-    # Fast lookup arrays (avoid pandas overhead in hot loops)
-    lats = df_sorted['lat'].values.copy()
-    lngs = df_sorted['lng'].values.copy()
-    kars_arr = df_sorted['kar'].values.copy()
-    ages_arr = df_sorted['age'].values.copy()
-    sexes_arr = df_sorted['sex'].values.copy()
-    orgs_arr = (df_sorted['parent_org'].values.copy()
-                if 'parent_org' in df_sorted.columns
-                else np.array([''] * len(df_sorted)))
-    member_arr = df_sorted['member_no'].values.copy()
-    f1_arr = df_sorted['friend_1'].values.copy()
-    f2_arr = df_sorted['friend_2'].values.copy()
-    member_to_idx = {m: i for i, m in enumerate(member_arr)}
-    rundresa_set = set(member_arr)
-
-    # Reverse friend index: who depends on each participant for their friend wish
-    friend_of = defaultdict(set)
-    for i in range(n):
-        if f1_arr[i] and f1_arr[i] in rundresa_set:
-            friend_of[f1_arr[i]].add(i)
-        if f2_arr[i] and f2_arr[i] in rundresa_set:
-            friend_of[f2_arr[i]].add(i)
+    # Per-person attributes as Python lists of ints/floats: scalar reads
+    # from lists are several times faster than from NumPy arrays in the
+    # loops below. Group state further down stays in NumPy arrays.
+    lats, lngs = problem.lat, problem.lng
+    lat_l, lng_l = lats.tolist(), lngs.tolist()
+    kars_arr = problem.kar.tolist()
+    ages_arr = problem.age.tolist()
+    sexes_arr = problem.sex.tolist()
+    orgs_arr = problem.org.tolist()
+    f_ptr, f_idx = problem.friend_ptr, problem.friend_idx
+    r_ptr, r_idx = problem.rev_ptr, problem.rev_idx
+    # friends[i]: row indices i wished for; wished_by[i]: who wished for i
+    # (the people whose friend satisfaction depends on where i is).
+    friends = [f_idx[f_ptr[i]:f_ptr[i + 1]].tolist() for i in range(n)]
+    wished_by = [r_idx[r_ptr[i]:r_ptr[i + 1]].tolist() for i in range(n)]
+    # Padded (n + 1, degree) copies of the same edges for batched scans.
+    friend_pad = _csr_pad(f_ptr, f_idx, n)
+    wished_pad = _csr_pad(r_ptr, r_idx, n)
+    global_kar_counts = problem.kar_global.tolist()
+    n_kar = len(global_kar_counts)
+    lap('setup')
 
     # -----------------------------------------------------------------------
     # Phase 1: Friend-cluster-aware initial placement (two-phase)
     # -----------------------------------------------------------------------
-    # 1. Build connected components in the friend graph using union-find.
-    parent = list(range(n))
-    def _find(x):
-        while parent[x] != x:
-            parent[x] = parent[parent[x]]
-            x = parent[x]
-        return x
-    def _union(x, y):
-        rx, ry = _find(x), _find(y)
-        if rx != ry:
-            parent[rx] = ry
-    for i in range(n):
-        for fid in (f1_arr[i], f2_arr[i]):
-            if fid and fid in member_to_idx:
-                _union(i, member_to_idx[fid])
-    cluster_of_idx = [_find(i) for i in range(n)]
-    clusters = defaultdict(list)
-    for i, c in enumerate(cluster_of_idx):
-        clusters[c].append(i)
+    # 1. Connected components of the friend graph, labelled by their lowest
+    #    member index, and the clusters' members in ascending index order.
+    comp = _friend_components(f_ptr, f_idx, n)
+    order = np.argsort(comp, kind='stable')
+    starts = np.flatnonzero(np.r_[True, comp[order][1:] != comp[order][:-1]])
+    sizes = np.diff(np.r_[starts, n])
 
     # 2. Capacities per group: group_size for full groups, remainder for last.
     capacity = [group_size] * n_full_groups
     if remainder > 0:
         capacity.append(remainder)
     group_assigned = [[] for _ in range(total_groups)]
+    room = _CapacityIndex(capacity)
 
     def _nearest_group(anchor_rank, need):
         """Return group index whose centre rank is closest to anchor_rank
-        AND whose remaining capacity >= need. -1 if none."""
-        best_g, best_d = -1, float('inf')
-        for g in range(total_groups):
-            if capacity[g] < need:
-                continue
-            centre = g * group_size + (capacity[g] // 2)
-            d = abs(anchor_rank - centre)
-            if d < best_d:
-                best_g, best_d = g, d
-        return best_g
-
-    # 3. Place multi-member clusters first (anchor = avg rank of its members).
-    multi_clusters = [
-        (float(np.mean(members)), members)
-        for members in clusters.values() if len(members) > 1
-    ]
-    multi_clusters.sort(key=lambda t: t[0])
-    for anchor_rank, members in multi_clusters:
+        AND whose remaining capacity >= need (lowest index on a tie). -1 if
+        none. Centres g * group_size + capacity[g] // 2 stay strictly
+        increasing in g, so the closest is either the last group with room
+        at or below the anchor or the first one above it."""
+        lo, hi = 0, total_groups
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if mid * group_size + capacity[mid] // 2 <= anchor_rank:
+                lo = mid + 1
+            else:
+                hi = mid
+        below = room.last_at_most(lo - 1, need)
+        above = room.first_at_least(lo, need)
+        if below < 0 or above < 0:
+            return max(below, above)
+        d_below = anchor_rank - (below * group_size + capacity[below] // 2)
+        d_above = above * group_size + capacity[above] // 2 - anchor_rank
+        return below if d_below <= d_above else above
+
+    def _place(g, members):
+        group_assigned[g].extend(members)
+        capacity[g] -= len(members)
+        room.set(g, capacity[g])
+
+    # 3. Place multi-member clusters first (anchor = avg rank of its members),
+    #    in anchor order with ties broken by lowest member.
+    multi = np.flatnonzero(sizes > 1)
+    anchors = np.add.reduceat(order, starts)[multi] / sizes[multi]
+    by_anchor = np.lexsort((order[starts[multi]], anchors))
+    for c, anchor_rank in zip(multi[by_anchor].tolist(), anchors[by_anchor].tolist()):
+        members = order[starts[c]:starts[c] + sizes[c]].tolist()
         g = _nearest_group(anchor_rank, len(members))
         if g < 0:
-            for i in sorted(members):
+            for i in members:
                 g1 = _nearest_group(i, 1)
                 assert g1 >= 0
-                group_assigned[g1].append(i)
-                capacity[g1] -= 1
+                _place(g1, [i])
         else:
-            for i in members:
-                group_assigned[g].append(i)
-            capacity[g] -= len(members)
+            _place(g, members)
 
     # 4. Place singletons (anchor = own rank).
-    singletons = [members[0] for members in clusters.values() if len(members) == 1]
-    singletons.sort()
-    for i in singletons:
+    for i in order[starts[sizes == 1]].tolist():
         g = _nearest_group(i, 1)
         assert g >= 0
-        group_assigned[g].append(i)
-        capacity[g] -= 1
+        _place(g, [i])
 
     # 5. Build group_of from group_assigned.
     group_of = np.zeros(n, dtype=int)
     for g, members in enumerate(group_assigned):
-        for i in members:
-            group_of[i] = g
+        group_of[members] = g
     assert all(c == 0 for c in capacity), f"residual capacity: {capacity}"
+    if start_group_of is not None:
+        group_of = np.asarray(start_group_of, dtype=int).copy()
+        group_assigned = [np.flatnonzero(group_of == g).tolist()
+                          for g in range(total_groups)]
+    if resumed is not None:
+        # The saved slot layout, not just group_of: Phase 4 draws members
+        # by slot, so the order within each group must come back too.
+        group_assigned = [row[row >= 0].tolist() for row in ck_arrays['group_members']]
+        for g, members in enumerate(group_assigned):
+            group_of[members] = g
 
     MAX_KAR = max_kar
 
     # -----------------------------------------------------------------------
     # Helper functions
     # -----------------------------------------------------------------------
-    # Maintained group → set-of-indices for O(1) membership checks.
-    group_members = {g: set() for g in range(total_groups)}
-    for i in range(n):
-        group_members[group_of[i]].add(i)
-    # Per-group set of member_no values, kept current via do_swap().
-    # friend_satisfied uses this for O(1) membership tests.
-    group_member_nos = {g: set(member_arr[i] for i in group_members[g])
-                        for g in range(total_groups)}
-    # Per-group kår histogram, kept current via do_swap(). Powers O(1)
-    # has_kar_mate / kar_count_in_group lookups used in lonely-count checks.
-    group_kar_counts = [defaultdict(int) for _ in range(total_groups)]
-    for i in range(n):
-        if kars_arr[i]:
-            group_kar_counts[group_of[i]][kars_arr[i]] += 1
-    # Global count of kar-mates available anywhere in the travel set; lets
-    # us short-circuit lonely status for kårs with only one member.
-    global_kar_counts = defaultdict(int)
-    for i in range(n):
-        if kars_arr[i]:
-            global_kar_counts[kars_arr[i]] += 1
+    # Group membership as a fixed-size slot array: group_members[g, :group_len[g]]
+    # holds g's members and slot_of[i] is i's column, so a swap just
+    # exchanges two cells. Sizes never change after Phase 1.
+    group_len = np.array([len(m) for m in group_assigned], dtype=np.int32)
+    group_members = np.full((total_groups, group_size), -1, dtype=np.int32)
+    slot_of = np.zeros(n, dtype=np.int32)
+    for g, members in enumerate(group_assigned):
+        group_members[g, :len(members)] = members
+        slot_of[members] = np.arange(len(members), dtype=np.int32)
+    # Per-group kår histogram (group × kår code), kept current via do_swap().
+    # Powers O(1) has_kar_mate and kår-limit checks. group_kar_idx_sum
+    # holds the sum of member indices per cell: when a kår has one or two
+    # members in a group, that identifies them without scanning the group.
+    group_kar_counts = np.zeros((total_groups, max(n_kar, 1)), dtype=np.int32)
+    group_kar_idx_sum = np.zeros((total_groups, max(n_kar, 1)), dtype=np.int64)
+    has_kar = problem.kar >= 0
+    np.add.at(group_kar_counts, (group_of[has_kar], problem.kar[has_kar]), 1)
+    np.add.at(group_kar_idx_sum, (group_of[has_kar], problem.kar[has_kar]),
+              np.flatnonzero(has_kar))
+
+    group_open = (np.ones(total_groups, dtype=bool) if open_groups is None
+                  else np.asarray(open_groups, dtype=bool))
+    all_open = bool(group_open.all())
+    anchored = anchor is not None and move_penalty > 0
+    if anchored:
+        anchor = np.asarray(anchor)
+        anchor_l = anchor.tolist()
+        move_cost = move_penalty / friend_weight if friend_weight else move_penalty
+
+    # Per-person "has a wished friend in the same group" flag and its running
+    # total, kept current by do_swap() for the swapped pair and everyone who
+    # wished for them, so satisfaction reads and counts are O(1).
+    def _satisfied_flags():
+        fp = friend_pad[:n]
+        return ((fp >= 0) & (group_of[fp] == group_of[:, None])).any(axis=1).tolist()
+
+    sat_flag = _satisfied_flags()
+    sat_total = sum(sat_flag)
+
+    def load_assignment(new_group_of):
+        """Replace the whole assignment (same group sizes) and rebuild the
+        slot arrays and kår tables from it."""
+        group_of[:] = new_group_of
+        for g in range(total_groups):
+            members = np.flatnonzero(group_of == g)
+            group_members[g, :len(members)] = members
+            slot_of[members] = np.arange(len(members), dtype=np.int32)
+        group_kar_counts[:] = 0
+        group_kar_idx_sum[:] = 0
+        np.add.at(group_kar_counts, (group_of[has_kar], problem.kar[has_kar]), 1)
+        np.add.at(group_kar_idx_sum, (group_of[has_kar], problem.kar[has_kar]),
+                  np.flatnonzero(has_kar))
+        nonlocal sat_flag, sat_total
+        sat_flag = _satisfied_flags()
+        sat_total = sum(sat_flag)
 
     def get_group_members(g):
-        return sorted(group_members[g])
+        return np.sort(group_members[g, :group_len[g]]).tolist()
 
     def has_friend_wish(idx):
-        f1, f2 = f1_arr[idx], f2_arr[idx]
-        return bool((f1 and f1 in rundresa_set) or (f2 and f2 in rundresa_set))
+        return bool(friends[idx])
 
     def friend_satisfied(idx):
-        g = group_of[idx]
-        gm_nos = group_member_nos[g]
-        f1, f2 = f1_arr[idx], f2_arr[idx]
-        return (f1 in gm_nos) or (f2 in gm_nos)
-
-    def kar_count_in_group(g, kar):
-        return group_kar_counts[g].get(kar, 0)
+        return sat_flag[idx]
 
     def has_kar_mate(idx):
         """True if at least one other member of idx's kår is in idx's group."""
         kar = kars_arr[idx]
-        if not kar:
+        if kar < 0:
             return False
-        return group_kar_counts[group_of[idx]].get(kar, 0) > 1
+        return group_kar_counts[group_of[idx], kar] > 1
 
     def is_lonely(idx):
         """A person is lonely if they didn't get a friend in their group AND
@@ -1637,14 +3899,14 @@ def _assign_groups_once(df_sorted, group_size, friend_wishes, max_kar=6,
         if friend_satisfied(idx):
             return False
         kar = kars_arr[idx]
-        if not kar or global_kar_counts.get(kar, 0) < 2:
+        if kar < 0 or global_kar_counts[kar] < 2:
             return False
         return not has_kar_mate(idx)
 
     def count_lonely_in_groups(gs):
         """Count lonely people across the given groups. Only need to check
         groups touched by a swap; outside groups can't change."""
-        return sum(1 for g in gs for i in group_members[g] if is_lonely(i))
+        return sum(1 for g in gs for i in get_group_members(g) if is_lonely(i))
 
     def count_lonely_total():
         return sum(1 for i in range(n) if is_lonely(i))
@@ -1655,7 +3917,7 @@ def _assign_groups_once(df_sorted, group_size, friend_wishes, max_kar=6,
         for the consolation-rate metric."""
         return sum(
             1 for i in range(n)
-            if kars_arr[i] and global_kar_counts.get(kars_arr[i], 0) >= 2
+            if kars_arr[i] >= 0 and global_kar_counts[kars_arr[i]] >= 2
         )
 
     def count_unsatisfied_with_kar_options():
@@ -1664,8 +3926,8 @@ def _assign_groups_once(df_sorted, group_size, friend_wishes, max_kar=6,
         all — they also benefit from a kår-mate."""
         return sum(
             1 for i in range(n)
-            if not friend_satisfied(i) and kars_arr[i]
-            and global_kar_counts.get(kars_arr[i], 0) >= 2
+            if not friend_satisfied(i) and kars_arr[i] >= 0
+            and global_kar_counts[kars_arr[i]] >= 2
         )
 
     def can_swap(i1, i2):
@@ -1673,56 +3935,62 @@ def _assign_groups_once(df_sorted, group_size, friend_wishes, max_kar=6,
         g1, g2 = group_of[i1], group_of[i2]
         if g1 == g2:
             return False
+        if not all_open and not (group_open[g1] and group_open[g2]):
+            return False
         k1, k2 = kars_arr[i1], kars_arr[i2]
         if k1 == k2:
             return True
-        if k2 and kar_count_in_group(g1, k2) - (1 if k2 == k1 else 0) + 1 > MAX_KAR:
+        if k2 >= 0 and group_kar_counts[g1, k2] + 1 > MAX_KAR:
             return False
-        if k1 and kar_count_in_group(g2, k1) - (1 if k1 == k2 else 0) + 1 > MAX_KAR:
+        if k1 >= 0 and group_kar_counts[g2, k1] + 1 > MAX_KAR:
             return False
         return True
 
     def do_swap(i1, i2):
         g1, g2 = group_of[i1], group_of[i2]
-        m1, m2 = member_arr[i1], member_arr[i2]
+        s1, s2 = slot_of[i1], slot_of[i2]
+        group_members[g1, s1] = i2
+        group_members[g2, s2] = i1
+        slot_of[i1], slot_of[i2] = s2, s1
         k1, k2 = kars_arr[i1], kars_arr[i2]
-        group_members[g1].discard(i1); group_members[g1].add(i2)
-        group_members[g2].discard(i2); group_members[g2].add(i1)
-        group_member_nos[g1].discard(m1); group_member_nos[g1].add(m2)
-        group_member_nos[g2].discard(m2); group_member_nos[g2].add(m1)
-        if k1:
-            group_kar_counts[g1][k1] -= 1
-            group_kar_counts[g2][k1] += 1
-        if k2:
-            group_kar_counts[g2][k2] -= 1
-            group_kar_counts[g1][k2] += 1
+        if k1 >= 0:
+            group_kar_counts[g1, k1] -= 1
+            group_kar_counts[g2, k1] += 1
+            group_kar_idx_sum[g1, k1] -= i1
+            group_kar_idx_sum[g2, k1] += i1
+        if k2 >= 0:
+            group_kar_counts[g2, k2] -= 1
+            group_kar_counts[g1, k2] += 1
+            group_kar_idx_sum[g2, k2] -= i2
+            group_kar_idx_sum[g1, k2] += i2
         group_of[i1], group_of[i2] = g2, g1
+        nonlocal sat_total
+        for a in (i1, i2, *wished_by[i1], *wished_by[i2]):
+            g = group_of[a]
+            now = any(group_of[f] == g for f in friends[a])
+            if now != sat_flag[a]:
+                sat_flag[a] = now
+                sat_total += 1 if now else -1
 
     def count_friend_satisfied():
-        return sum(1 for i in range(n) if has_friend_wish(i) and friend_satisfied(i))
+        return sat_total
 
     def count_friend_total():
-        return sum(1 for i in range(n) if has_friend_wish(i))
+        return sum(1 for f in friends if f)
 
     def count_kar_violations():
-        total = 0
-        for g in range(total_groups):
-            gm = get_group_members(g)
-            counts = Counter(kars_arr[i] for i in gm if kars_arr[i])
-            total += sum(max(0, c - MAX_KAR) for c in counts.values())
-        return total
+        return int(np.maximum(group_kar_counts - MAX_KAR, 0).sum())
 
     def affected_by_swap(i1, i2):
         """Get all participants whose friend satisfaction could change from a swap."""
         affected = {i1, i2}
-        m1, m2 = member_arr[i1], member_arr[i2]
-        affected.update(friend_of.get(m1, set()))
-        affected.update(friend_of.get(m2, set()))
+        affected.update(wished_by[i1])
+        affected.update(wished_by[i2])
         return affected
 
     def geo_dist_sq(i1, i2):
         """Squared geographic distance (fast, no sqrt needed for comparison)."""
-        return (lats[i1] - lats[i2])**2 + (lngs[i1] - lngs[i2])**2
+        return (lat_l[i1] - lat_l[i2])**2 + (lng_l[i1] - lng_l[i2])**2
 
     def group_geo_spread(g):
         """Mean squared distance to group MEDIAN centroid (geographic compactness).
@@ -1733,12 +4001,11 @@ def _assign_groups_once(df_sorted, group_size, friend_wishes, max_kar=6,
         when it isn't. The median sits in the bulk regardless of how far the
         outliers are, so the metric correctly rewards groups with a tight
         bulk (and only counts outliers' distance from that bulk)."""
-        gm = get_group_members(g)
+        gm = group_members[g, :group_len[g]]
         if len(gm) <= 1:
             return 0.0
-        clat = float(np.median(lats[gm]))
-        clng = float(np.median(lngs[gm]))
-        return np.mean([(lats[i] - clat)**2 + (lngs[i] - clng)**2 for i in gm])
+        glat, glng = lats[gm], lngs[gm]
+        return float(np.mean((glat - np.median(glat))**2 + (glng - np.median(glng))**2))
 
     def group_diversity(g):
         """Diversity score: age + sex + parent-org entropy (higher = more diverse).
@@ -1746,55 +4013,107 @@ def _assign_groups_once(df_sorted, group_size, friend_wishes, max_kar=6,
         Parent-org entropy rewards groups with a mix of Scouterna / Equmenia /
         KFUM / NSF / etc., so that the SA phase nudges toward organisation
         balance alongside age and sex balance."""
-        gm = get_group_members(g)
+        gm = group_members[g, :group_len[g]]
         if len(gm) == 0:
             return 0
-        age_c = Counter(ages_arr[i] for i in gm)
-        total = sum(age_c.values())
-        age_ent = -sum((c / total) * math.log2(c / total) for c in age_c.values() if c > 0)
-        sex_c = Counter(sexes_arr[i] for i in gm)
-        total_s = sum(sex_c.values())
-        sex_ent = -sum((c / total_s) * math.log2(c / total_s) for c in sex_c.values() if c > 0)
-        org_c = Counter(orgs_arr[i] for i in gm if orgs_arr[i])
-        total_o = sum(org_c.values())
-        org_ent = (-sum((c / total_o) * math.log2(c / total_o) for c in org_c.values() if c > 0)
-                   if total_o else 0.0)
-        return age_ent + sex_ent + org_ent
+        return (_code_entropy(problem.age[gm]) + _code_entropy(problem.sex[gm])
+                + _code_entropy(problem.org[gm]))
+
+    if stats is not None:
+        do_swap = stats.counted(do_swap)
+        friend_satisfied = stats.counted(friend_satisfied)
+        group_diversity = stats.counted(group_diversity)
+
+    def _legal_partners(idx, cands):
+        """Vectorized can_swap(idx, c) over an array of candidates."""
+        g1, k1 = group_of[idx], kars_arr[idx]
+        k2 = problem.kar[cands]
+        cg = group_of[cands]
+        ok = (k2 < 0) | (group_kar_counts[g1, k2] < MAX_KAR)
+        if k1 >= 0:
+            ok &= group_kar_counts[cg, k1] < MAX_KAR
+        ok = (ok | (k2 == k1)) & (cg != g1)
+        if not all_open:
+            ok &= group_open[cg] & group_open[g1]
+        return ok
+
+    def _move_gains(movers, dests):
+        """Net friend-satisfaction change of moving movers[r, j] into group
+        dests[r, j], one candidate move per row, scored as a batch without
+        touching group state.
+
+        Per row the affected set is the movers plus everyone wishing for one
+        of them (as in affected_by_swap). Rows of that set are sorted so
+        repeats can be masked out, then satisfaction is evaluated before and
+        after against group_of with the moves applied."""
+        k = movers.shape[1]
+        aff = np.concatenate([movers] + [wished_pad[movers[:, j]] for j in range(k)],
+                             axis=1)
+        aff.sort(axis=1)
+        keep = aff >= 0
+        keep[:, 1:] &= aff[:, 1:] != aff[:, :-1]
+        fr = friend_pad[aff]
+        has_f = fr >= 0
+        old_a, old_f = group_of[aff], group_of[fr]
+        new_a, new_f = old_a, old_f
+        for j in range(k):
+            mj, dj = movers[:, j:j + 1], dests[:, j:j + 1]
+            new_a = np.where(aff == mj, dj, new_a)
+            new_f = np.where(fr == mj[..., None], dj[..., None], new_f)
+        old_sat = (has_f & (old_f == old_a[..., None])).any(axis=-1)
+        new_sat = (has_f & (new_f == new_a[..., None])).any(axis=-1)
+        net = ((new_sat.astype(np.int32) - old_sat) * keep).sum(axis=1)
+        if anchored:
+            home = anchor[movers]
+            moved = (((dests != home) & (home >= 0)).sum(axis=1)
+                     - ((group_of[movers] != home) & (home >= 0)).sum(axis=1))
+            net = net - move_cost * moved
+        return net
+
+    def _swap_moves(i1, i2):
+        """Change in how many anchored people are away from their anchor
+        group if i1 and i2 (in different groups) swap."""
+        g1, g2 = group_of[i1], group_of[i2]
+        a1, a2 = anchor_l[i1], anchor_l[i2]
+        d = 0
+        if a1 >= 0:
+            d += int(g2 != a1) - int(g1 != a1)
+        if a2 >= 0:
+            d += int(g1 != a2) - int(g2 != a2)
+        return d
 
     def _friend_swap_pass(idx_iter):
         """One pass of friend-fixing swaps. Returns count of improving swaps.
 
         For each idx in idx_iter that has an unsatisfied friend wish, finds the
         best legal partner to swap with (closest geographically among swaps
-        that don't reduce total friend satisfaction), and performs it."""
+        that don't reduce total friend satisfaction), and performs it. All
+        members of the target groups are scored at once by _move_gains; ties
+        go to the first candidate in (target group, row) order."""
         n_swaps = 0
         for idx in idx_iter:
             if not has_friend_wish(idx) or friend_satisfied(idx):
                 continue
             target_groups = set()
-            for fid in (f1_arr[idx], f2_arr[idx]):
-                if fid and fid in member_to_idx:
-                    target_groups.add(group_of[member_to_idx[fid]])
+            for f in friends[idx]:
+                target_groups.add(group_of[f])
             target_groups.discard(group_of[idx])
             if not target_groups:
                 continue
-            best_cidx, best_net, best_dist = None, -999, float('inf')
-            for tg in target_groups:
-                for cidx in get_group_members(tg):
-                    if not can_swap(idx, cidx):
-                        continue
-                    affected = affected_by_swap(idx, cidx)
-                    old_sat = sum(1 for a in affected if has_friend_wish(a) and friend_satisfied(a))
-                    do_swap(idx, cidx)
-                    new_sat = sum(1 for a in affected if has_friend_wish(a) and friend_satisfied(a))
-                    do_swap(idx, cidx)  # undo
-                    net = new_sat - old_sat
-                    dist = geo_dist_sq(idx, cidx)
-                    if net > best_net or (net == best_net and dist < best_dist):
-                        best_net, best_cidx, best_dist = net, cidx, dist
-            if best_cidx is not None and best_net >= 0:
-                do_swap(idx, best_cidx)
-                n_swaps += 1
+            cands = np.concatenate([np.sort(group_members[tg, :group_len[tg]])
+                                    for tg in target_groups])
+            cands = cands[_legal_partners(idx, cands)]
+            if len(cands) == 0:
+                continue
+            movers = np.stack([np.full(len(cands), idx, dtype=np.int32), cands], axis=1)
+            net = _move_gains(movers, np.stack([group_of[cands], np.full(len(cands), group_of[idx])], axis=1))
+            best_net = net.max()
+            if best_net < 0:
+                continue
+            top = np.flatnonzero(net == best_net)
+            dist = (lats[cands[top]] - lat_l[idx])**2 + (lngs[cands[top]] - lng_l[idx])**2
+            do_swap(idx, int(cands[top[np.argmin(dist)]]))
+            n_swaps += 1
         return n_swaps
 
     def _criticality_sorted_indices():
@@ -1808,34 +4127,28 @@ def _assign_groups_once(df_sorted, group_size, friend_wishes, max_kar=6,
         for i in range(n):
             if not has_friend_wish(i) or friend_satisfied(i):
                 continue
-            valid = [fid for fid in (f1_arr[i], f2_arr[i])
-                     if fid and fid in member_to_idx]
-            if not valid:
-                continue
-            min_dist = min(geo_dist_sq(i, member_to_idx[fid]) for fid in valid)
+            valid = friends[i]
+            min_dist = min(geo_dist_sq(i, f) for f in valid)
             scored.append((min_dist / len(valid), i))
         scored.sort(reverse=True)  # higher score = more critical = earlier
         return [i for _, i in scored]
 
-    def _rotation_legal(a, b, c, g_a, g_b, g_c):
-        """Check that rotating a→g_b, b→g_c, c→g_a respects kår limits.
-        Sizes are unchanged (3-cycle), so only kår needs checking."""
-        ka, kb, kc = kars_arr[a], kars_arr[b], kars_arr[c]
-        for kar in {ka, kb, kc}:
-            if not kar:
-                continue
-            new_a = (kar_count_in_group(g_a, kar)
-                     - (1 if ka == kar else 0)
-                     + (1 if kc == kar else 0))
-            new_b = (kar_count_in_group(g_b, kar)
-                     - (1 if kb == kar else 0)
-                     + (1 if ka == kar else 0))
-            new_c = (kar_count_in_group(g_c, kar)
-                     - (1 if kc == kar else 0)
-                     + (1 if kb == kar else 0))
-            if max(new_a, new_b, new_c) > MAX_KAR:
-                return False
-        return True
+    def _rotation_legal(a, b, cands, g_a, g_b):
+        """Which C in cands can take part in rotating a→g_b, b→g_c, c→g_a
+        (g_c = group of c) within kår limits. Sizes are unchanged (3-cycle),
+        so only the kår counts of the three groups need checking."""
+        ka, kb = kars_arr[a], kars_arr[b]
+        kc = problem.kar[cands]
+        g_c = group_of[cands]
+        ok = np.ones(len(cands), dtype=bool)
+        for kar in (ka, kb, kc):
+            new_a = group_kar_counts[g_a, kar] - (ka == kar) + (kc == kar)
+            new_b = group_kar_counts[g_b, kar] - (kb == kar) + (ka == kar)
+            new_c = group_kar_counts[g_c, kar] - (kc == kar) + (kb == kar)
+            ok &= (kar < 0) | (np.maximum(np.maximum(new_a, new_b), new_c) <= MAX_KAR)
+        if not all_open:
+            ok &= group_open[g_c] & group_open[g_a] & group_open[g_b]
+        return ok
 
     def _do_rotation(a, b, c):
         """Move a→g_b's group, b→g_c's group, c→g_a's group via two swaps."""
@@ -1846,148 +4159,269 @@ def _assign_groups_once(df_sorted, group_size, friend_wishes, max_kar=6,
         """For each unsatisfied wish, try 3-way rotation A→B→C→A.
 
         For unsatisfied A wanting a friend in group g_b: try every member of
-        g_b as 'B' (would move into g_c) and every member of g_c (any third
-        group) as 'C' (would move into g_a). Accept the first rotation that
-        strictly increases satisfaction within the affected set AND respects
-        all kår limits. Affected set = {a, b, c} ∪ everyone who has a or b
-        or c as a friend wish.
+        g_b as 'B' (would move into g_c) and anyone in a third group as 'C'
+        (would move into g_a). Accept the first rotation that strictly
+        increases satisfaction within the affected set AND respects all kår
+        limits. Affected set = {a, b, c} ∪ everyone who has a or b or c as a
+        friend wish.
+
+        C candidates are ranked by distance to g_a's centroid, so the
+        rotation taken is the most compact one available for that B. Per
+        (A, B) pair, illegal C are pruned against the kår-count table and
+        only the nearest rotation_budget of the rest are tried (all of them
+        when rotation_budget is None).
+
+        Scoring avoids a trial rotation per C. Let S be A, B, everyone
+        wishing for A or B, and everyone those people wish for. For any C
+        outside S the affected set splits into two disjoint parts: A's and
+        B's side, which only sees which group B lands in, and C plus its
+        wishers, which only see C arrive in g_a. The gain is then
+        side_gain[g_c] + join_gain[c], both batched by _move_gains. C inside
+        S is scored as a full rotation.
 
         Returns the number of accepted rotations."""
         rotations = 0
         unsatisfied = [i for i in range(n)
                        if has_friend_wish(i) and not friend_satisfied(i)]
+        all_groups = np.arange(total_groups)
         for a in unsatisfied:
             if friend_satisfied(a):  # may have been solved by an earlier rotation
                 continue
+            if not group_open[group_of[a]]:
+                continue
             g_a = group_of[a]
             target_gbs = set()
-            for fid in (f1_arr[a], f2_arr[a]):
-                if fid and fid in member_to_idx:
-                    target_gbs.add(group_of[member_to_idx[fid]])
+            for f in friends[a]:
+                target_gbs.add(group_of[f])
             target_gbs.discard(g_a)
+            if not target_gbs:
+                continue
+            gm = group_members[g_a, :group_len[g_a]]
+            near = np.argsort((lats - lats[gm].mean())**2 + (lngs - lngs[gm].mean())**2,
+                              kind='stable').astype(np.int32)
+            near = near[group_of[near] != g_a]
+            join_gain = np.zeros(n, dtype=np.int32)
+            join_gain[near] = _move_gains(near[:, None], np.full((len(near), 1), g_a))
             found = False
             for g_b in target_gbs:
                 if found: break
+                pool = near[group_of[near] != g_b]
                 for b in get_group_members(g_b):
-                    if found: break
-                    if b == a: continue
-                    m_a, m_b = member_arr[a], member_arr[b]
-                    for g_c in range(total_groups):
-                        if found: break
-                        if g_c in (g_a, g_b): continue
-                        for c in get_group_members(g_c):
-                            if not _rotation_legal(a, b, c, g_a, g_b, g_c):
-                                continue
-                            m_c = member_arr[c]
-                            affected = {a, b, c}
-                            affected.update(friend_of.get(m_a, set()))
-                            affected.update(friend_of.get(m_b, set()))
-                            affected.update(friend_of.get(m_c, set()))
-
-                            old_sat = sum(1 for x in affected
-                                          if has_friend_wish(x) and friend_satisfied(x))
-                            _do_rotation(a, b, c)
-                            new_sat = sum(1 for x in affected
-                                          if has_friend_wish(x) and friend_satisfied(x))
-                            if new_sat > old_sat:
-                                rotations += 1
-                                found = True
-                            else:
-                                _do_rotation(c, b, a)  # undo (reverse direction)
+                    cands = pool[_rotation_legal(a, b, pool, g_a, g_b)]
+                    if rotation_budget is not None:
+                        cands = cands[:rotation_budget]
+                    if len(cands) == 0:
+                        continue
+                    side = {a, b}
+                    side.update(wished_by[a])
+                    side.update(wished_by[b])
+                    for x in list(side):
+                        side.update(friends[x])
+                    side_gain = _move_gains(
+                        np.tile(np.array([a, b], dtype=np.int32), (total_groups, 1)),
+                        np.stack([np.full(total_groups, g_b), all_groups], axis=1))
+                    gains = side_gain[group_of[cands]] + join_gain[cands]
+                    inside = np.flatnonzero(np.isin(cands, list(side)))
+                    if len(inside):
+                        c_in = cands[inside]
+                        movers = np.empty((len(c_in), 3), dtype=np.int32)
+                        movers[:, 0], movers[:, 1], movers[:, 2] = a, b, c_in
+                        dests = np.empty((len(c_in), 3), dtype=group_of.dtype)
+                        dests[:, 0], dests[:, 1], dests[:, 2] = g_b, group_of[c_in], g_a
+                        gains[inside] = _move_gains(movers, dests)
+                    hit = np.flatnonzero(gains > 0)
+                    if len(hit):
+                        _do_rotation(a, b, int(cands[hit[0]]))
+                        rotations += 1
+                        found = True
+                        break
         return rotations
 
     # -----------------------------------------------------------------------
     # Phase 1: Initial geographic assignment (already done by sort + cut)
     # -----------------------------------------------------------------------
     friend_total = count_friend_total()
-    print("\n=== Phase 1: Geographic sort + cut ===")
-    print(f"  Friend satisfaction: {count_friend_satisfied()}/{friend_total}")
-    print(f"  Kar violations: {count_kar_violations()}")
-    print(f"  Avg geo spread: {np.mean([group_geo_spread(g) for g in range(total_groups)]):.4f}")
+    friend_swaps = rotations = kar_swaps = friend_swaps_2b = consolation_swaps = 0
+    if resumed is not None:
+        (friend_swaps, rotations, kar_swaps, friend_swaps_2b,
+         consolation_swaps) = ck['counters']
+
+    def save_checkpoint(phase, arrays=(), **state):
+        if ckpt is None:
+            return
+        ckpt.save(phase, dict(arrays, group_members=group_members), n=n,
+                  group_size=group_size, seed=seed, run_key=run_key,
+                  counters=[friend_swaps, rotations, kar_swaps, friend_swaps_2b,
+                            consolation_swaps], **state)
+    elig_total = count_consolation_eligible()
+    lap('1' if _runs('1') else 'setup')
+    if _runs('1'):
+        print("\n=== Phase 1: Geographic sort + cut ===")
+        print(f"  Friend satisfaction: {count_friend_satisfied()}/{friend_total}")
+        print(f"  Kar violations: {count_kar_violations()}")
+        print(f"  Avg geo spread: {np.mean([group_geo_spread(g) for g in range(total_groups)]):.4f}")
+        lap('1')
+        save_checkpoint('1')
 
     # -----------------------------------------------------------------------
     # Phase 2: Fix friend wishes (criticality-ordered, iterate)
     # -----------------------------------------------------------------------
-    print("\n=== Phase 2: Fix friend wishes (criticality-ordered, iterate) ===")
-    friend_swaps = 0
-    for pass_num in range(10):
-        order = _criticality_sorted_indices()
-        if not order:
-            print(f"  No unsatisfied wishes; converged after {pass_num} pass(es)")
-            break
-        n_this = _friend_swap_pass(order)
-        friend_swaps += n_this
-        if n_this == 0:
-            print(f"  Converged after {pass_num + 1} pass(es)")
-            break
-    print(f"  Total swaps: {friend_swaps}")
-    print(f"  Friend satisfaction: {count_friend_satisfied()}/{friend_total}")
-    print(f"  Kar violations: {count_kar_violations()}")
-    print(f"  Avg geo spread: {np.mean([group_geo_spread(g) for g in range(total_groups)]):.4f}")
+    if _runs('2'):
+        print("\n=== Phase 2: Fix friend wishes (criticality-ordered, iterate) ===")
+        for pass_num in range(10):
+            order = _criticality_sorted_indices()
+            if not order:
+                print(f"  No unsatisfied wishes; converged after {pass_num} pass(es)")
+                break
+            n_this = _friend_swap_pass(order)
+            friend_swaps += n_this
+            if n_this == 0:
+                print(f"  Converged after {pass_num + 1} pass(es)")
+                break
+        print(f"  Total swaps: {friend_swaps}")
+        print(f"  Friend satisfaction: {count_friend_satisfied()}/{friend_total}")
+        print(f"  Kar violations: {count_kar_violations()}")
+        print(f"  Avg geo spread: {np.mean([group_geo_spread(g) for g in range(total_groups)]):.4f}")
+        lap('2')
+        save_checkpoint('2')
 
     # -----------------------------------------------------------------------
     # Phase 2.5: 3-way rotations for kår-blocked friend wishes
     # -----------------------------------------------------------------------
-    print("\n=== Phase 2.5: 3-way rotations ===")
-    rotations = _friend_rotate_pass()
-    print(f"  Rotations: {rotations}")
-    print(f"  Friend satisfaction: {count_friend_satisfied()}/{friend_total}")
-    print(f"  Kar violations: {count_kar_violations()}")
+    if _runs('2.5'):
+        print("\n=== Phase 2.5: 3-way rotations ===")
+        rotations = _friend_rotate_pass()
+        print(f"  Rotations: {rotations}")
+        print(f"  Friend satisfaction: {count_friend_satisfied()}/{friend_total}")
+        print(f"  Kar violations: {count_kar_violations()}")
+        lap('2.5')
+        save_checkpoint('2.5')
 
     # -----------------------------------------------------------------------
     # Phase 3: Fix kar violations (friend-aware, geo as tiebreaker)
     # -----------------------------------------------------------------------
-    print("\n=== Phase 3: Fix kar violations (friend-aware) ===")
-    kar_swaps = 0
-
-    def _phase3_score(idx, cidx):
-        """Score a candidate: (-net_friend_change, geo_dist_sq).
-        Lower is better. Negating net_friend so that bigger gain → smaller key."""
-        affected = affected_by_swap(idx, cidx)
-        old_sat = sum(1 for a in affected if has_friend_wish(a) and friend_satisfied(a))
-        do_swap(idx, cidx)
-        new_sat = sum(1 for a in affected if has_friend_wish(a) and friend_satisfied(a))
-        do_swap(idx, cidx)  # undo
-        net = new_sat - old_sat
-        return (-net, geo_dist_sq(idx, cidx))
+    if _runs('3'):
+        print("\n=== Phase 3: Fix kar violations (friend-aware) ===")
+
+        # Partner search state, kept current across this phase's swaps: each
+        # group's bounding box (for a lower bound on the distance from a
+        # person to any of its members) and, in incremental runs, the
+        # people anchored to each group.
+        box = np.empty((total_groups, 4))
+
+        def _update_boxes(gs):
+            gm = group_members[gs]
+            valid = gm >= 0
+            glat, glng = lats[gm], lngs[gm]
+            box[gs, 0] = np.where(valid, glat, np.inf).min(axis=1)
+            box[gs, 1] = np.where(valid, glat, -np.inf).max(axis=1)
+            box[gs, 2] = np.where(valid, glng, np.inf).min(axis=1)
+            box[gs, 3] = np.where(valid, glng, -np.inf).max(axis=1)
+
+        _update_boxes(np.arange(total_groups))
+        anchored_to = [[] for _ in range(total_groups)]
+        if anchored:
+            for i in np.flatnonzero(anchor >= 0).tolist():
+                anchored_to[anchor_l[i]].append(i)
+
+        def _phase3_partner(idx, kar):
+            """Best swap partner for kår-excess member idx, or None.
+
+            Partners are anyone outside idx's group, of another kår, who passes
+            can_swap, ranked by (-net_friend_change, geo_dist_sq) with ties
+            going to the lowest (group, row). Only a shortlist is scored, by
+            _move_gains:
+
+            - people linked by a wish to idx (either way, or through someone
+              who wishes for both) or to a member of idx's group, and those
+              anchored to idx's group. Only they can gain from the move;
+            - for everyone else the net change is at most what idx alone
+              gains by moving to their group, and the distance is at least
+              that to their group's bounding box. Groups are taken in order
+              of that bound, best first, until none can beat the best
+              partner found.
+
+            The pick is the same as scoring every candidate."""
+            g = group_of[idx]
+            gm = get_group_members(g)
+            wishers = wished_pad[idx]
+            linked = np.concatenate([friend_pad[idx], wishers, friend_pad[wishers].ravel(),
+                                     friend_pad[gm].ravel(), wished_pad[gm].ravel(),
+                                     np.asarray(anchored_to[g], dtype=np.int32)])
+            x, y = lat_l[idx], lng_l[idx]
+            best = None
+
+            def consider(cands):
+                nonlocal best
+                cands = cands[cands >= 0]
+                cands = cands[problem.kar[cands] != kar]
+                cands = cands[_legal_partners(idx, cands)]
+                if len(cands) == 0:
+                    return
+                cg = group_of[cands]
+                movers = np.stack([np.full(len(cands), idx, dtype=np.int32), cands], axis=1)
+                net = _move_gains(movers, np.stack([cg, np.full(len(cands), g)], axis=1))
+                dist = (lats[cands] - x)**2 + (lngs[cands] - y)**2
+                r = np.lexsort((cands, cg, dist, -net))[0]
+                key = (-net[r], dist[r], cg[r], cands[r])
+                if best is None or key < best:
+                    best = key
+
+            consider(np.unique(linked[linked >= 0]))
+            targets = np.flatnonzero(group_kar_counts[:, kar] < MAX_KAR)
+            if not all_open:
+                targets = targets[group_open[targets]]
+            targets = targets[targets != g]
+            if len(targets):
+                bound = _move_gains(np.full((len(targets), 1), idx, dtype=np.int32),
+                                    targets[:, None])
+                dx = np.maximum(np.maximum(box[targets, 0] - x, x - box[targets, 1]), 0)
+                dy = np.maximum(np.maximum(box[targets, 2] - y, y - box[targets, 3]), 0)
+                near = dx**2 + dy**2
+                order = np.lexsort((targets, near, -bound))
+                for start in range(0, len(order), 8):
+                    batch = order[start:start + 8]
+                    if best is not None:
+                        batch = batch[[(-bound[r], near[r]) <= best[:2] for r in batch]]
+                        if len(batch) == 0:
+                            break
+                    consider(group_members[targets[batch]].ravel())
+            return None if best is None else int(best[3])
 
-    for g in range(total_groups):
-        gm = get_group_members(g)
-        counts = Counter(kars_arr[i] for i in gm if kars_arr[i])
-        for kar, cnt in counts.items():
-            if cnt <= MAX_KAR:
-                continue
-            excess = [i for i in gm if kars_arr[i] == kar]
-            for idx in excess[MAX_KAR:]:
-                candidates = []
-                for og in range(total_groups):
-                    if og == g:
-                        continue
-                    for cidx in get_group_members(og):
-                        if kars_arr[cidx] == kar:
-                            continue
-                        if can_swap(idx, cidx):
-                            candidates.append(cidx)
-                if not candidates:
+        for g in range(total_groups):
+            gm = get_group_members(g)
+            counts = Counter(kars_arr[i] for i in gm if kars_arr[i] >= 0)
+            for kar, cnt in counts.items():
+                if cnt <= MAX_KAR:
                     continue
-                best_cidx = min(candidates, key=lambda c: _phase3_score(idx, c))
-                do_swap(idx, best_cidx)
-                kar_swaps += 1
+                excess = [i for i in gm if kars_arr[i] == kar]
+                for idx in excess[MAX_KAR:]:
+                    best_cidx = _phase3_partner(idx, kar)
+                    if best_cidx is None:
+                        continue
+                    do_swap(idx, best_cidx)
+                    _update_boxes([group_of[idx], group_of[best_cidx]])
+                    kar_swaps += 1
 
-    print(f"  Swaps: {kar_swaps}")
-    print(f"  Kar violations: {count_kar_violations()}")
-    print(f"  Friend satisfaction: {count_friend_satisfied()}/{friend_total}")
-    print(f"  Avg geo spread: {np.mean([group_geo_spread(g) for g in range(total_groups)]):.4f}")
+        print(f"  Swaps: {kar_swaps}")
+        print(f"  Kar violations: {count_kar_violations()}")
+        print(f"  Friend satisfaction: {count_friend_satisfied()}/{friend_total}")
+        print(f"  Avg geo spread: {np.mean([group_geo_spread(g) for g in range(total_groups)]):.4f}")
+        lap('3')
+        save_checkpoint('3')
 
     # -----------------------------------------------------------------------
     # Phase 2b: Re-fix friend wishes lost in Phase 3
     # -----------------------------------------------------------------------
-    print("\n=== Phase 2b: Re-fix friends after kar fix ===")
-    friend_swaps_2b = _friend_swap_pass(range(n))
-    print(f"  Swaps: {friend_swaps_2b}")
-    print(f"  Friend satisfaction: {count_friend_satisfied()}/{friend_total}")
-    print(f"  Kar violations: {count_kar_violations()}")
-    print(f"  Avg geo spread: {np.mean([group_geo_spread(g) for g in range(total_groups)]):.4f}")
+    if _runs('2b'):
+        print("\n=== Phase 2b: Re-fix friends after kar fix ===")
+        friend_swaps_2b = _friend_swap_pass(range(n))
+        print(f"  Swaps: {friend_swaps_2b}")
+        print(f"  Friend satisfaction: {count_friend_satisfied()}/{friend_total}")
+        print(f"  Kar violations: {count_kar_violations()}")
+        print(f"  Avg geo spread: {np.mean([group_geo_spread(g) for g in range(total_groups)]):.4f}")
+        lap('2b')
+        save_checkpoint('2b')
 
     # -----------------------------------------------------------------------
     # Phase 3.5: Kår-konsolation (targeted)
@@ -1998,71 +4432,79 @@ def _assign_groups_once(df_sorted, group_size, friend_wishes, max_kar=6,
     # it strictly decreases the lonely count over the two affected groups
     # and doesn't reduce friend satisfaction. Stricter than the SA term so
     # we don't undo Phase 2 work; SA can do the softer trade-offs later.
-    print("\n=== Phase 3.5: Kår-konsolation (targeted) ===")
-    elig_total = count_consolation_eligible()
-    lonely_before = count_lonely_total()
-    consolation_swaps = 0
+    if _runs('3.5'):
+        print("\n=== Phase 3.5: Kår-konsolation (targeted) ===")
+        lonely_before = count_lonely_total()
 
-    # Pre-compute member_idx grouped by kår, for fast kar-mate lookup.
-    kar_to_idxs = defaultdict(list)
-    for i in range(n):
-        if kars_arr[i]:
-            kar_to_idxs[kars_arr[i]].append(i)
-
-    # Iterate lonely indices most-critical first: those whose friend wish is
-    # geographically distant (least likely to be fixed later by SA).
-    def _lonely_order():
-        scored = []
+        # Pre-compute member_idx grouped by kår, for fast kar-mate lookup.
+        kar_to_idxs = defaultdict(list)
         for i in range(n):
-            if not is_lonely(i):
-                continue
-            valid = [fid for fid in (f1_arr[i], f2_arr[i])
-                     if fid and fid in member_to_idx]
-            min_d = (min(geo_dist_sq(i, member_to_idx[fid]) for fid in valid)
-                     if valid else 0.0)
-            scored.append((min_d, i))
-        scored.sort(reverse=True)
-        return [i for _, i in scored]
-
-    for idx in _lonely_order():
-        if not is_lonely(idx):
-            continue  # already fixed earlier this pass
-        kar = kars_arr[idx]
-        g = group_of[idx]
-        # Candidate K = kar-mate not in g; V = victim in g to swap out.
-        # Try to find any (K, V) that reduces lonely without harming friends.
-        best_swap = None
-        best_score = 0
-        for K in kar_to_idxs[kar]:
-            if group_of[K] == g:
-                continue
-            for V in tuple(group_members[g]):
-                if V == idx or not can_swap(K, V):
+            if kars_arr[i] >= 0:
+                kar_to_idxs[kars_arr[i]].append(i)
+
+        # Iterate lonely indices most-critical first: those whose friend wish is
+        # geographically distant (least likely to be fixed later by SA).
+        def _lonely_order():
+            scored = []
+            for i in range(n):
+                if not is_lonely(i):
                     continue
-                g_k = group_of[K]
-                affected = affected_by_swap(K, V)
-                old_sat = sum(1 for a in affected if has_friend_wish(a) and friend_satisfied(a))
-                old_lonely_local = count_lonely_in_groups({g, g_k})
-                do_swap(K, V)
-                new_sat = sum(1 for a in affected if has_friend_wish(a) and friend_satisfied(a))
-                new_lonely_local = count_lonely_in_groups({g, g_k})
-                do_swap(K, V)  # undo
-                if new_sat < old_sat:
+                valid = friends[i]
+                min_d = min(geo_dist_sq(i, f) for f in valid) if valid else 0.0
+                scored.append((min_d, i))
+            scored.sort(reverse=True)
+            return [i for _, i in scored]
+
+        for idx in _lonely_order():
+            if not is_lonely(idx):
+                continue  # already fixed earlier this pass
+            if not group_open[group_of[idx]]:
+                continue
+            kar = kars_arr[idx]
+            g = group_of[idx]
+            # Candidate K = kar-mate not in g; V = victim in g to swap out.
+            # Try to find any (K, V) that reduces lonely without harming friends.
+            best_swap = None
+            best_score = 0
+            for K in kar_to_idxs[kar]:
+                if group_of[K] == g:
                     continue
-                gain = (old_lonely_local - new_lonely_local) * 10 + (new_sat - old_sat)
-                if gain > best_score:
-                    best_score = gain
-                    best_swap = (K, V)
-        if best_swap is not None:
-            do_swap(*best_swap)
-            consolation_swaps += 1
-
-    lonely_after_phase35 = count_lonely_total()
-    print(f"  Swaps: {consolation_swaps}")
-    print(f"  Lonely (unsatisfied + no kar-mate): {lonely_before} -> {lonely_after_phase35} "
-          f"(of {elig_total} eligible)")
-    print(f"  Friend satisfaction: {count_friend_satisfied()}/{friend_total}")
-    print(f"  Kar violations: {count_kar_violations()}")
+                for V in get_group_members(g):
+                    if V == idx or not can_swap(K, V):
+                        continue
+                    g_k = group_of[K]
+                    old_sat = sat_total
+                    old_lonely_local = count_lonely_in_groups({g, g_k})
+                    do_swap(K, V)
+                    new_sat = sat_total
+                    new_lonely_local = count_lonely_in_groups({g, g_k})
+                    do_swap(K, V)  # undo
+                    if new_sat < old_sat:
+                        continue
+                    gain = (old_lonely_local - new_lonely_local) * 10 + (new_sat - old_sat)
+                    if anchored:
+                        gain -= move_cost * _swap_moves(K, V)
+                    if gain > best_score:
+                        best_score = gain
+                        best_swap = (K, V)
+            if best_swap is not None:
+                do_swap(*best_swap)
+                consolation_swaps += 1
+
+        lonely_after_phase35 = count_lonely_total()
+        print(f"  Swaps: {consolation_swaps}")
+        print(f"  Lonely (unsatisfied + no kar-mate): {lonely_before} -> {lonely_after_phase35} "
+              f"(of {elig_total} eligible)")
+        print(f"  Friend satisfaction: {count_friend_satisfied()}/{friend_total}")
+        print(f"  Kar violations: {count_kar_violations()}")
+        lap('3.5')
+        save_checkpoint('3.5')
+
+    if stats is not None:
+        stats.swaps = {'2': friend_swaps, '2.5': rotations, '3': kar_swaps,
+                       '2b': friend_swaps_2b, '3.5': consolation_swaps}
+    if not _runs('4'):
+        return group_of
 
     # -----------------------------------------------------------------------
     # Phase 4: Weighted SA — gain friends, balance diversity, penalize geo spread
@@ -2081,55 +4523,287 @@ def _assign_groups_once(df_sorted, group_size, friend_wishes, max_kar=6,
     sat_before = count_friend_satisfied()
     lonely_before_sa = count_lonely_total()
     diversity_swaps = 0
-    temperature = 1.0
+    sa_resumed = resumed is not None and ck['phase'] == 'sa'
+    if sa_resumed:
+        (div_before, geo_before, sat_before, lonely_before_sa,
+         diversity_swaps) = ck['before'] + [ck['diversity_swaps']]
+
+    # Running SA state. Every group keeps its age/sex/org histograms with
+    # cached entropies, plus sorted coordinate lists (for the median
+    # centroid) and coordinate sums, so a proposed swap is scored from
+    # deltas without walking either group. Coordinates are centred on the
+    # cohort mean to keep the sum-of-squares arithmetic well conditioned.
+    lat0, lng0 = float(np.mean(lats)), float(np.mean(lngs))
+    c_lats = [x - lat0 for x in lat_l]
+    c_lngs = [x - lng0 for x in lng_l]
+    # (age, sex, org) codes per person; org -1 (none) is not counted.
+    sa_attrs = list(zip(ages_arr, sexes_arr, orgs_arr))
+    n_codes = (len(problem.age_labels), len(problem.sex_labels), len(problem.org_labels))
+    sa_hist = [[[0] * k for k in n_codes] for _ in range(total_groups)]
+    sa_lat_sorted = [[] for _ in range(total_groups)]
+    sa_lng_sorted = [[] for _ in range(total_groups)]
+    sa_sums = [[0.0, 0.0, 0.0, 0.0] for _ in range(total_groups)]
+    for i in range(n):
+        g = group_of[i]
+        for a, v in enumerate(sa_attrs[i]):
+            if v >= 0:
+                sa_hist[g][a][v] += 1
+        sa_lat_sorted[g].append(c_lats[i])
+        sa_lng_sorted[g].append(c_lngs[i])
+        s = sa_sums[g]
+        s[0] += c_lats[i]; s[1] += c_lats[i] ** 2
+        s[2] += c_lngs[i]; s[3] += c_lngs[i] ** 2
+
+    def _geo_spread_from(vals_lat, vals_lng, sums, m_lat, m_lng):
+        k = len(vals_lat)
+        if k <= 1:
+            return 0.0
+        return (_sq_dev(k, sums[0], sums[1], m_lat)
+                + _sq_dev(k, sums[2], sums[3], m_lng)) / k
 
-    for iteration in range(diversity_iterations):
-        i1 = random.randint(0, n - 1)
-        i2 = random.randint(0, n - 1)
-        g1, g2 = group_of[i1], group_of[i2]
-        if g1 == g2 or not can_swap(i1, i2):
-            continue
+    def _median_sorted(vals):
+        k = len(vals)
+        return vals[k // 2] if k % 2 else (vals[k // 2 - 1] + vals[k // 2]) / 2
 
+    sa_ent = []
+    sa_geo = []
+    for g in range(total_groups):
+        sa_lat_sorted[g].sort()
+        sa_lng_sorted[g].sort()
+        sa_ent.append([_entropy(h) for h in sa_hist[g]])
+        sa_geo.append(_geo_spread_from(sa_lat_sorted[g], sa_lng_sorted[g], sa_sums[g],
+                                       _median_sorted(sa_lat_sorted[g]),
+                                       _median_sorted(sa_lng_sorted[g])))
+    if sa_resumed:
+        # The running sums and cached scores as they were, not recomputed:
+        # they carry the rounding of every accepted swap so far.
+        sa_sums = ck_arrays['sa_sums'].tolist()
+        sa_ent = ck_arrays['sa_ent'].tolist()
+        sa_geo = ck_arrays['sa_geo'].tolist()
+
+    def _sa_div_after(g, out_i, in_i):
+        """Diversity of g if out_i leaves and in_i joins. Returns (score, entropies)."""
+        ents = list(sa_ent[g])
+        for a in range(3):
+            v_out, v_in = sa_attrs[out_i][a], sa_attrs[in_i][a]
+            if v_out != v_in:
+                ents[a] = _entropy_after_replace(sa_hist[g][a], v_out, v_in)
+        return sum(ents), ents
+
+    def _sa_geo_after(g, out_i, in_i):
+        """Geo spread of g if out_i leaves and in_i joins. Returns (spread, sums)."""
+        la_o, la_i = c_lats[out_i], c_lats[in_i]
+        ln_o, ln_i = c_lngs[out_i], c_lngs[in_i]
+        if la_o == la_i and ln_o == ln_i:
+            return sa_geo[g], sa_sums[g]
+        s = sa_sums[g]
+        sums = [s[0] - la_o + la_i, s[1] - la_o ** 2 + la_i ** 2,
+                s[2] - ln_o + ln_i, s[3] - ln_o ** 2 + ln_i ** 2]
+        spread = _geo_spread_from(
+            sa_lat_sorted[g], sa_lng_sorted[g], sums,
+            _median_after_replace(sa_lat_sorted[g], la_o, la_i),
+            _median_after_replace(sa_lng_sorted[g], ln_o, ln_i))
+        return spread, sums
+
+    def _sa_commit(g, out_i, in_i, ents, geo, sums):
+        """Fold an accepted swap (out_i leaves g, in_i joins) into the state."""
+        for a in range(3):
+            v_out, v_in = sa_attrs[out_i][a], sa_attrs[in_i][a]
+            if v_out == v_in:
+                continue
+            h = sa_hist[g][a]
+            if v_out >= 0:
+                h[v_out] -= 1
+            if v_in >= 0:
+                h[v_in] += 1
+        sa_ent[g] = ents
+        for vals, v_out, v_in in ((sa_lat_sorted[g], c_lats[out_i], c_lats[in_i]),
+                                  (sa_lng_sorted[g], c_lngs[out_i], c_lngs[in_i])):
+            if v_out != v_in:
+                del vals[bisect.bisect_left(vals, v_out)]
+                bisect.insort(vals, v_in)
+        sa_sums[g] = sums
+        sa_geo[g] = geo
+
+    def _lonely_candidates(i1, i2, affected):
+        """Everyone whose lonely status the swap i1<->i2 could flip: the
+        friend-affected set, plus a kår-mate left alone by a mover or a lone
+        member joined by one. When i1 and i2 share a kår, no count changes."""
+        g1, g2 = group_of[i1], group_of[i2]
+        cands = set(affected)
+        k1, k2 = kars_arr[i1], kars_arr[i2]
+        if k1 == k2:
+            return cands
+        for g_from, g_to, mover, kar in ((g1, g2, i1, k1), (g2, g1, i2, k2)):
+            if kar < 0:
+                continue
+            if group_kar_counts[g_from, kar] == 2:
+                cands.add(int(group_kar_idx_sum[g_from, kar]) - mover)
+            if group_kar_counts[g_to, kar] == 1:
+                cands.add(int(group_kar_idx_sum[g_to, kar]))
+        return cands
+
+    def _sa_evaluate(i1, i2):
+        """Apply swap i1<->i2 and score it. Returns (score_delta, pending):
+        the caller either undoes the swap or passes pending to _sa_accept."""
+        g1, g2 = group_of[i1], group_of[i2]
         affected = affected_by_swap(i1, i2)
-        old_sat = sum(1 for a in affected if has_friend_wish(a) and friend_satisfied(a))
-        old_div = group_diversity(g1) + group_diversity(g2)
-        old_geo = group_geo_spread(g1) + group_geo_spread(g2)
-        old_lonely_local = count_lonely_in_groups({g1, g2})
+        lonely_cands = _lonely_candidates(i1, i2, affected)
+        old_sat = sat_total
+        old_lonely_local = sum(1 for x in lonely_cands if is_lonely(x))
+        div1, ents1 = _sa_div_after(g1, i1, i2)
+        div2, ents2 = _sa_div_after(g2, i2, i1)
+        geo1, sums1 = _sa_geo_after(g1, i1, i2)
+        geo2, sums2 = _sa_geo_after(g2, i2, i1)
+        moves = _swap_moves(i1, i2) if anchored else 0
 
         do_swap(i1, i2)
 
-        new_sat = sum(1 for a in affected if has_friend_wish(a) and friend_satisfied(a))
-        new_div = group_diversity(g1) + group_diversity(g2)
-        new_geo = group_geo_spread(g1) + group_geo_spread(g2)
-        new_lonely_local = count_lonely_in_groups({g1, g2})
-
+        new_sat = sat_total
+        new_lonely_local = sum(1 for x in lonely_cands if is_lonely(x))
+
+        # Deltas below rounding noise count as "no change", so a swap of
+        # interchangeable people is accepted without drawing from the RNG.
+        div_delta = (div1 + div2) - (sum(sa_ent[g1]) + sum(sa_ent[g2]))
+        geo_delta = (geo1 + geo2) - (sa_geo[g1] + sa_geo[g2])
+        if abs(div_delta) < _SA_DELTA_EPS:
+            div_delta = 0.0
+        if abs(geo_delta) < _SA_DELTA_EPS:
+            geo_delta = 0.0
         score_delta = (FRIEND_WEIGHT * (new_sat - old_sat)
-                       + DIV_WEIGHT * (new_div - old_div)
-                       - GEO_WEIGHT * (new_geo - old_geo)
+                       + DIV_WEIGHT * div_delta
+                       - GEO_WEIGHT * geo_delta
                        - LONELY_WEIGHT * (new_lonely_local - old_lonely_local))
+        if moves:
+            score_delta -= move_penalty * moves
+        return score_delta, (g1, g2, ents1, geo1, sums1, ents2, geo2, sums2)
+
+    def _sa_accept(i1, i2, pending):
+        g1, g2, ents1, geo1, sums1, ents2, geo2, sums2 = pending
+        _sa_commit(g1, i1, i2, ents1, geo1, sums1)
+        _sa_commit(g2, i2, i1, ents2, geo2, sums2)
+
+    # Proposals draw from everyone, or in an incremental run from the
+    # members of open groups (swaps keep that set fixed).
+    sa_pool = None if all_open else np.flatnonzero(group_open[group_of]).tolist()
+    n_pick = n if sa_pool is None else len(sa_pool)
+    # Local proposals: the partner is a random member of one of i1's
+    # nearest (open) groups, from a neighbour table built once from the
+    # Phase 3.5 centroids.
+    near_groups = None
+    if sa_resumed and 'near_groups' in ck_arrays:
+        near_groups = ck_arrays['near_groups'].tolist()
+        n_near = len(near_groups[0])
+    elif sa_neighbours > 0:
+        cand_groups = np.flatnonzero(group_open)
+        if len(cand_groups) > 1:
+            near_groups = _nearest_groups(group_members, group_len, lats, lngs,
+                                          cand_groups, sa_neighbours).tolist()
+            n_near = len(near_groups[0])
+
+    def _sa_propose():
+        i1 = random.randint(0, n_pick - 1)
+        if sa_pool is not None:
+            i1 = sa_pool[i1]
+        if near_groups is not None and random.random() < _SA_LOCAL_SHARE:
+            g2 = near_groups[group_of[i1]][random.randrange(n_near)]
+            return i1, int(group_members[g2, random.randrange(group_len[g2])])
+        i2 = random.randint(0, n_pick - 1)
+        return i1, (i2 if sa_pool is None else sa_pool[i2])
+
+    uphill = ck['uphill'] if sa_resumed else []
+    if schedule != 'fixed' and not sa_resumed:
+        # Calibrate T0 on a sample of legal swaps, each scored and undone.
+        for _ in range(4000):
+            if len(uphill) >= 200:
+                break
+            i1, i2 = _sa_propose()
+            if group_of[i1] == group_of[i2] or not can_swap(i1, i2):
+                continue
+            score_delta, _ = _sa_evaluate(i1, i2)
+            do_swap(i1, i2)
+            if score_delta < 0:
+                uphill.append(-score_delta)
+    if isinstance(schedule, str):
+        sched = _AnnealSchedule(schedule, max_iterations=diversity_iterations,
+                                time_budget_s=time_budget_s, uphill_deltas=uphill)
+    else:
+        sched = schedule
+        sched.start(uphill)
+
+    # Non-fixed schedules run hot enough to wander off the Phase 3.5
+    # result, so they hand back the best assignment seen, not the last.
+    keep_best = sched.mode != 'fixed'
+    best_group_of = group_of.copy() if keep_best else None
+    if sa_resumed:
+        _Checkpoint.restore_sched(sched, ck['sched'])
+        if keep_best:
+            best_group_of = ck_arrays['best_group_of']
+
+    def _sa_checkpoint():
+        arrays = {'sa_sums': np.array(sa_sums), 'sa_ent': np.array(sa_ent),
+                  'sa_geo': np.array(sa_geo)}
+        if near_groups is not None:
+            arrays['near_groups'] = np.array(near_groups)
+        if keep_best:
+            arrays['best_group_of'] = best_group_of
+        save_checkpoint('sa', arrays, sched=_Checkpoint.sched_state(sched), uphill=uphill,
+                        before=[float(div_before), float(geo_before), sat_before,
+                                lonely_before_sa],
+                        diversity_swaps=diversity_swaps)
+
+    while True:
+        # Checkpoint between proposals, before running() counts the next.
+        if ckpt is not None and sched.proposals and sched.proposals % ckpt.every == 0:
+            _sa_checkpoint()
+        if not sched.running():
+            break
+        i1, i2 = _sa_propose()
+        g1, g2 = group_of[i1], group_of[i2]
+        if g1 == g2 or not can_swap(i1, i2):
+            continue
 
-        if score_delta < 0 and random.random() > math.exp(score_delta / max(temperature, 0.01)):
+        score_delta, pending = _sa_evaluate(i1, i2)
+        temperature = max(sched.temperature, sched.t_min)
+        if score_delta < 0 and random.random() > math.exp(score_delta / temperature):
             do_swap(i1, i2)  # reject
+            sched.record(score_delta, False)
         else:
             diversity_swaps += 1
-
-        temperature *= 0.9995
+            _sa_accept(i1, i2, pending)
+            if sched.record(score_delta, True) and keep_best:
+                best_group_of = group_of.copy()
+    sched.finish()
+    if keep_best and sched.score < sched.best:
+        load_assignment(best_group_of)
 
     div_after = sum(group_diversity(g) for g in range(total_groups))
     geo_after = np.mean([group_geo_spread(g) for g in range(total_groups)])
     sat_after = count_friend_satisfied()
     lonely_after = count_lonely_total()
+    print(f"  Schedule: {sched.mode}, T0={sched.t0:.4g}"
+          + (f" (calibrated from {len(uphill)} worsening swaps)" if uphill else "")
+          + f"; stopped on {sched.stop_reason} after {sched.proposals} proposals"
+          + f" ({sched.elapsed():.1f}s)")
+    print(f"  Accepted/rejected: {sched.accepted}/{sched.rejected}"
+          + (f"; kept best (score {sched.best:+.2f} vs final {sched.score:+.2f})"
+             if keep_best and sched.score < sched.best else ""))
+    traj = sched.trajectory
+    if traj:
+        print(f"  {'proposals':>10} {'temp':>9} {'accepted':>9} {'rejected':>9} "
+              f"{'uphill%':>8} {'score':>9}")
+        step = max(1, len(traj) // 8)
+        rows = traj[step - 1::step]
+        if rows[-1] is not traj[-1]:
+            rows.append(traj[-1])
+        for prop, temp, acc, rej, up, score in rows:
+            print(f"  {prop:>10} {temp:>9.4g} {acc:>9} {rej:>9} {up * 100:>7.1f}% {score:>9.2f}")
     print(f"  Swaps: {diversity_swaps}")
     print(f"  Friend satisfaction: {sat_before} -> {sat_after}")
     print(f"  Diversity score:     {div_before:.2f} -> {div_after:.2f}")
     print(f"  Avg geo spread:      {geo_before:.4f} -> {geo_after:.4f}")
     print(f"  Lonely:              {lonely_before_sa} -> {lonely_after} (of {elig_total} eligible)")
 
-    # -----------------------------------------------------------------------
-    # Write results back to DataFrame
-    # -----------------------------------------------------------------------
-    df_sorted['group'] = group_of
-
     print(f"\n{'=' * 50}")
     print(f"=== FINAL RESULTS ===")
     print(f"{'=' * 50}")
@@ -2146,8 +4820,14 @@ def _assign_groups_once(df_sorted, group_size, friend_wishes, max_kar=6,
     print(f"Total swaps: {friend_swaps + kar_swaps + friend_swaps_2b + consolation_swaps + diversity_swaps}")
     print(f"Diversity: {div_after:.2f}")
     print(f"Avg geo spread: {geo_after:.4f}")
+    lap('4')
+    save_checkpoint('4', {'group_of': group_of})
+    if stats is not None:
+        stats.swaps['4'] = diversity_swaps
+        stats.record_schedule(sched, len(uphill), diversity_swaps)
+        stats.result = problem.metrics(group_of, MAX_KAR)
 
-    return df_sorted
+    return group_of
 
 
 # =============================================================================
@@ -2392,6 +5072,15 @@ def export_results(df_sorted, group_of, total_groups, output_dir, prefix='wsj27'
     return csv_path, json_path
 
 
+def load_previous_groups(csv_path):
+    """Read a published assignment back from export_results' CSV.
+
+    Returns {member_no: 0-indexed group}, ready for
+    assign_groups(..., previous=...)."""
+    df_prev = pd.read_csv(csv_path, dtype={'member_no': str}, encoding='utf-8-sig')
+    return dict(zip(df_prev['member_no'], df_prev['group'].astype(int) - 1))
+
+
 # =============================================================================
 # 9. Map Generation (using direct CDN HTML, not keplergl Python)
 # =============================================================================